@@ -0,0 +1,158 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+import generate_data
+from database_structs import StockCatalog, stock_table_columns
+
+
+def time_call(function, repeat=5):
+    """Calls function repeat times, returning the timings in seconds and the last result."""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return timings, result
+
+
+def summarise(name, size, timings, result=None):
+    summary = {"name": name,
+               "items": size,
+               "runs": len(timings),
+               "min": min(timings),
+               "median": statistics.median(timings),
+               "max": max(timings)}
+    if result is not None:
+        summary["result_size"] = result if isinstance(result, int) else len(result)
+    return summary
+
+
+def format_rows(items, formatters):
+    return [["" if getattr(i, a) is None else f(getattr(i, a)) for a, f in formatters] for i in items]
+
+
+def run_benchmarks(database, size, repeat=5, seed=0):
+    """Times the DatabaseHandler methods and the stock list filter and format paths on a database.
+    Returns a list of result dicts.
+    :type database: database_io.DatabaseHandler
+    """
+    rng = random.Random(seed)
+    results = []
+
+    def bench(name, function, times=repeat):
+        timings, result = time_call(function, times)
+        results.append(summarise(name, size, timings, result))
+        return result
+
+    with database.open_database_connection(read_only=True) as con:
+        skus = con.all("SELECT sku FROM stock_items")
+        show_ids = con.all("SELECT show_id FROM shows")
+        categories = database.get_categories(con)
+        classifications = database.get_classifications(con)
+
+        items = bench("get_all_items", lambda: database.get_all_items(con))
+        bench("get_items_by_category", lambda: list(database.get_items_by_category(con)))
+        bench("get_items_by_category first page", lambda: list(database.get_items_by_category(con, limit=100)))
+        bench("get_items_by_category filtered",
+              lambda: list(database.get_items_by_category(con, categories=[0, 3], classifications=[3],
+                                                          show_hidden=False)))
+        bench("get_item", lambda: [database.get_item(con, s) for s in rng.sample(skus, min(100, len(skus)))])
+        bench("get_stock_levels", lambda: [database.get_stock_levels(con, s)
+                                           for s in rng.sample(skus, min(100, len(skus)))])
+        bench("get_stock_levels_bulk", lambda: database.get_stock_levels_bulk(con))
+        window = (datetime.datetime.now(), datetime.datetime.now() + datetime.timedelta(days=1))
+        bench("get_stock_levels_bulk window", lambda: database.get_stock_levels_bulk(con, window=window))
+        bench("get_stock_levels window", lambda: [database.get_stock_levels(con, s, window)
+                                                  for s in rng.sample(skus, min(100, len(skus)))])
+        bench("search_items", lambda: database.search_items(con, "red", None))
+        bench("get_shows open", lambda: database.get_shows(con, True))
+        bench("get_shows all", lambda: database.get_shows(con, False))
+        bench("get_upcoming_shows", lambda: database.get_upcoming_shows(con, 20))
+        bench("get_show_items", lambda: [database.get_show_items(con, s)
+                                         for s in rng.sample(show_ids, min(20, len(show_ids)))])
+        bench("get_show_rollups", lambda: database.get_show_rollups(con, rng.sample(show_ids, min(20, len(show_ids)))))
+        bench("get_venue_rollups", lambda: database.get_venue_rollups(con, generate_data.VENUES[0]))
+        bench("get_show_changes", lambda: [database.get_show_changes(con, s)
+                                           for s in rng.sample(show_ids, min(20, len(show_ids)))])
+
+    catalog = bench("StockCatalog build", lambda: StockCatalog(items))
+
+    def filter_stock():
+        # The same calls StockList.apply_filters and populate_table make.
+        mask = catalog.all_of(catalog.code_mask("category", [0, 1, 3]),
+                              catalog.code_mask("classification", [2, 3]),
+                              catalog.code_mask("hidden", (False, None)),
+                              catalog.range_mask("stock_on_hand", 1))
+        return catalog.positions(mask)
+    positions = bench("StockList filter", filter_stock)
+
+    formatters = [(a, f) for a, f, _ in stock_table_columns(categories.__getitem__,
+                                                            classifications.__getitem__).values()]
+    visible = [catalog.items[p] for p in positions]
+    bench("StockList format visible page", lambda: format_rows(visible[:50], formatters))
+    bench("StockList format all", lambda: format_rows(visible, formatters), max(1, repeat // 2))
+
+    with database.open_database_connection() as con:
+        item = database.get_item(con, rng.choice(skus))
+
+        def update():
+            item.notes = str(rng.random())
+            database.update_item(con, item)
+        bench("update_item", update)
+
+    return results
+
+
+def run_suite(sizes=(1000, 10000, 100000), repeat=5, seed=0, directory=None, source=generate_data.DEFAULT_SOURCE):
+    """Generates a database for each size of stock, and benchmarks it. Shows, show items and users are scaled
+    from the stock size. Returns the results and the environment they were run in as a dict.
+    """
+    results = []
+    with tempfile.TemporaryDirectory(dir=directory) as temp:
+        for size in sizes:
+            path = os.path.join(temp, "bench-{}.sqlite".format(size))
+            start = time.perf_counter()
+            database = generate_data.generate_database(path,
+                                                       items=size,
+                                                       shows=max(10, size // 20),
+                                                       items_per_show=20,
+                                                       changes_per_show=5,
+                                                       users=max(5, size // 1000),
+                                                       seed=seed,
+                                                       source=source)
+            results.append(summarise("generate_database", size, [time.perf_counter() - start]))
+            try:
+                results.extend(run_benchmarks(database, size, repeat, seed))
+            finally:
+                database.pool.close()
+    return {"python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times the database and stock list paths on synthetic data.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--source", default=generate_data.DEFAULT_SOURCE)
+    parser.add_argument("--output", help="File to write the JSON results to, instead of stdout.")
+    args = parser.parse_args()
+    report = run_suite(args.sizes, args.repeat, args.seed, source=args.source)
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+        for r in report["results"]:
+            print("{items:>7} {name:<36} {median:.6f}s".format(**r))
+    else:
+        print(json.dumps(report, indent=2))
@@ -3,6 +3,7 @@ from os import path, environ
 # Constants
 TITLE = "Fuzed"
 CONFIG_PATH = path.join(environ["APPDATA"], TITLE, "config.cfg")
+UPCOMING_SHOWS = 20  # How many shows the launcher lists.
 
 AUTH_LEVELS = ["Super-user",
                "Administrator",
@@ -1,41 +1,462 @@
 import binascii
+import collections
+import concurrent.futures
 import hashlib
+import json
+import logging
+import logging.handlers
 import random
+import re
 import sqlite3
 import sql
 import os
-import pickle
+import sys
+import threading
 import time
 from custom_globals import *
 from database_structs import *
-from contextlib import closing
+from contextlib import closing, contextmanager
+from urllib.request import pathname2url
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+    import fcntl
 
 DATABASE_PATH = ""
+SLOW_QUERY_LOG = ""
+SLOW_QUERY_SECONDS = ""
+# Settings read from the config file if present, and only written back if they are set.
+OPTIONAL_CONFIG = ["SLOW_QUERY_LOG", "SLOW_QUERY_SECONDS"]
+MAX_QUERY_PARAMETERS = 999
+# How long the changes journal is kept for. A workstation which hasn't synced for longer than this reloads.
+CHANGE_RETENTION = datetime.timedelta(days=7)
+
+ALLOCATION_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS show_items_allocate AFTER INSERT ON show_items
+    BEGIN
+        INSERT OR IGNORE INTO stock_allocations (sku, allocated) VALUES (NEW.sku, 0);
+        UPDATE stock_allocations SET allocated = allocated + NEW.quantity WHERE sku = NEW.sku;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS show_items_deallocate AFTER DELETE ON show_items
+    BEGIN
+        UPDATE stock_allocations SET allocated = allocated - OLD.quantity WHERE sku = OLD.sku;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS show_items_reallocate AFTER UPDATE OF sku, quantity ON show_items
+    BEGIN
+        UPDATE stock_allocations SET allocated = allocated - OLD.quantity WHERE sku = OLD.sku;
+        INSERT OR IGNORE INTO stock_allocations (sku, allocated) VALUES (NEW.sku, 0);
+        UPDATE stock_allocations SET allocated = allocated + NEW.quantity WHERE sku = NEW.sku;
+    END"""
+]
 
 
 class DatabaseTimeoutError(Exception):
     pass
 
 
+class DatabaseVersionError(Exception):
+    pass
+
+
+class DatabaseCancelledError(Exception):
+    pass
+
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS stock_categories
+    (
+        category_no integer not null
+            constraint stock_categories_pk
+                primary key,
+        category_text varchar not null
+    )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS stock_categories_category_text_uindex on stock_categories (category_text)",
+    """CREATE TABLE IF NOT EXISTS stock_classifications
+    (
+        classification_id integer not null
+            constraint stock_classifications_pk
+                primary key,
+        classification_text varchar not null
+    )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS stock_classifications_classification_text_uindex "
+    "on stock_classifications (classification_text)",
+    """CREATE TABLE IF NOT EXISTS users
+    (
+        user_id integer not null
+            constraint users_pk
+                primary key autoincrement,
+        name varchar not null,
+        auth_level integer default 0 not null,
+        pass_hash varchar,
+        pass_salt varchar,
+        last_login_time datetime
+    )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS users_name_uindex on users (name)",
+    """CREATE TABLE IF NOT EXISTS shows
+    (
+        show_id integer not null
+            constraint table_name_pk
+                primary key autoincrement,
+        show_title varchar,
+        show_description varchar,
+        supervisor varchar,
+        date_time datetime,
+        complete boolean default False,
+        venue varchar
+    )""",
+    """CREATE TABLE IF NOT EXISTS show_changes
+    (
+        change_no integer not null
+            constraint show_changes_pk
+                primary key autoincrement,
+        show_id int not null
+            constraint show_changes_shows_show_id_fk
+                references shows,
+        date_time datetime not null,
+        text varchar not null
+    )""",
+    """CREATE TABLE IF NOT EXISTS stock_items
+    (
+        sku integer not null
+            constraint table_name_pk
+                primary key autoincrement,
+        description varchar,
+        classification integer
+            references stock_classifications,
+        calibre float,
+        unit_cost float,
+        unit_weight float,
+        nec_weight float,
+        case_size integer,
+        hse_no varchar,
+        ce_no varchar,
+        serial_no varchar,
+        duration float,
+        low_noise integer,
+        notes varchar,
+        preview_link varchar,
+        category integer
+            references stock_categories,
+        hidden boolean default FALSE not null,
+        product_id varchar,
+        stock_on_hand integer default 0 not null,
+        shots int
+    )""",
+    """CREATE TABLE IF NOT EXISTS show_items
+    (
+        show_id int not null
+            references shows,
+        sku integer not null
+            references stock_items,
+        quantity int not null,
+        constraint show_items_pk
+            primary key (show_id, sku)
+    )""",
+    # Indexes for the hot queries. show_items is keyed on (show_id, sku), so lookups by sku need their own.
+    "CREATE INDEX IF NOT EXISTS show_items_sku_index on show_items (sku)",
+    "CREATE INDEX IF NOT EXISTS show_changes_show_id_index on show_changes (show_id, change_no)",
+    "CREATE INDEX IF NOT EXISTS shows_complete_date_time_index on shows (complete, date_time)",
+    "CREATE INDEX IF NOT EXISTS stock_items_category_index on stock_items (category, classification, hidden)"
+]
+
+CHANGE_JOURNAL_TABLE = """CREATE TABLE IF NOT EXISTS changes
+(
+    seq integer not null
+        constraint changes_pk
+            primary key autoincrement,
+    table_name varchar not null,
+    row_id integer not null,
+    sub_id integer,
+    operation varchar not null,
+    changed_at integer not null
+)"""
+
+# The journalled tables, and the columns identifying a row. show_items rows are identified by show_id and sku.
+JOURNALLED_TABLES = {"stock_items": ("sku", None),
+                     "shows": ("show_id", None),
+                     "users": ("user_id", None),
+                     "show_items": ("show_id", "sku")}
+
+
+def change_journal_triggers(tables):
+    journal = "INSERT INTO changes (table_name, row_id, sub_id, operation, changed_at) " \
+              "VALUES ('{table}', {row}.{key}, {sub}, '{operation}', " \
+              "CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER));"
+    triggers = []
+    for table, (key, sub_key) in tables.items():
+        def entry(row, operation):
+            return journal.format(table=table,
+                                  row=row,
+                                  key=key,
+                                  sub="NULL" if sub_key is None else row + "." + sub_key,
+                                  operation=operation)
+        # An update which changes a row's key journals the old key as deleted.
+        key_changed = "OLD.{0} IS NOT NEW.{0}".format(key)
+        if sub_key is not None:
+            key_changed += " OR OLD.{0} IS NOT NEW.{0}".format(sub_key)
+        triggers += ["CREATE TRIGGER IF NOT EXISTS {0}_journal_insert AFTER INSERT ON {0}\n"
+                     "BEGIN\n    {1}\nEND".format(table, entry("NEW", "insert")),
+                     "CREATE TRIGGER IF NOT EXISTS {0}_journal_delete AFTER DELETE ON {0}\n"
+                     "BEGIN\n    {1}\nEND".format(table, entry("OLD", "delete")),
+                     "CREATE TRIGGER IF NOT EXISTS {0}_journal_rekey AFTER UPDATE ON {0} WHEN {1}\n"
+                     "BEGIN\n    {2}\nEND".format(table, key_changed, entry("OLD", "delete")),
+                     "CREATE TRIGGER IF NOT EXISTS {0}_journal_update AFTER UPDATE ON {0}\n"
+                     "BEGIN\n    {1}\nEND".format(table, entry("NEW", "update"))]
+    return triggers
+
+
+# Reference tables, journalled by a later migration so cached copies can be invalidated.
+JOURNALLED_REFERENCE_TABLES = {"stock_categories": ("category_no", None),
+                               "stock_classifications": ("classification_id", None)}
+
+CHANGE_JOURNAL_TRIGGERS = change_journal_triggers(JOURNALLED_TABLES)
+REFERENCE_JOURNAL_TRIGGERS = change_journal_triggers(JOURNALLED_REFERENCE_TABLES)
+
+DEFAULT_CATEGORIES = ["Shell", "Mine", "Candle", "Rocket", "Fountain", "Bengal/Strobe", "Wheel", "Other"]
+DEFAULT_CLASSIFICATIONS = ["CAT1", "CAT2", "CAT3", "CAT4"]
+
+
+SEARCH_FIELDS = ("description", "notes", "product_id", "hse_no", "ce_no", "serial_no")
+
+SEARCH_INDEX_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS stock_items_fts_insert AFTER INSERT ON stock_items
+    BEGIN
+        INSERT INTO stock_items_fts (rowid, {0}) VALUES (NEW.sku, {1});
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS stock_items_fts_delete AFTER DELETE ON stock_items
+    BEGIN
+        INSERT INTO stock_items_fts (stock_items_fts, rowid, {0}) VALUES ('delete', OLD.sku, {2});
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS stock_items_fts_update AFTER UPDATE ON stock_items
+    BEGIN
+        INSERT INTO stock_items_fts (stock_items_fts, rowid, {0}) VALUES ('delete', OLD.sku, {2});
+        INSERT INTO stock_items_fts (rowid, {0}) VALUES (NEW.sku, {1});
+    END"""
+]
+SEARCH_INDEX_TRIGGERS = [t.format(", ".join(SEARCH_FIELDS),
+                                  ", ".join("NEW." + f for f in SEARCH_FIELDS),
+                                  ", ".join("OLD." + f for f in SEARCH_FIELDS)) for t in SEARCH_INDEX_TRIGGERS]
+
+# How long an open show holds its stock for, either side of its date_time. Fired stock never comes back, but
+# anything unused is only back on the shelf once the show is cleared down.
+SHOW_STOCK_OUT_MINUTES = 24 * 60
+SHOW_STOCK_BACK_MINUTES = 24 * 60
+
+# show_periods holds the minutes each open show has its stock booked out for, as an interval index.
+SHOW_PERIOD_VALUES = "NEW.show_id, NEW.date_time / 60000 - {0}, (NEW.date_time + 59999) / 60000 + {1}".format(
+    SHOW_STOCK_OUT_MINUTES, SHOW_STOCK_BACK_MINUTES)
+SHOW_PERIOD_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS shows_period_insert AFTER INSERT ON shows
+    WHEN NEW.complete = 0 AND NEW.date_time IS NOT NULL
+    BEGIN
+        INSERT INTO show_periods (id, starts, ends) VALUES ({0});
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS shows_period_delete AFTER DELETE ON shows
+    BEGIN
+        DELETE FROM show_periods WHERE id = OLD.show_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS shows_period_update AFTER UPDATE OF show_id, date_time, complete ON shows
+    BEGIN
+        DELETE FROM show_periods WHERE id = OLD.show_id;
+        INSERT INTO show_periods (id, starts, ends) SELECT {0} WHERE NEW.complete = 0 AND NEW.date_time IS NOT NULL;
+    END"""
+]
+SHOW_PERIOD_TRIGGERS = [t.format(SHOW_PERIOD_VALUES) for t in SHOW_PERIOD_TRIGGERS]
+
+# Totals of the stock booked onto each show, and onto all the shows at a venue on a day, per classification.
+# Items without a classification are totalled under -1, as key columns can't be NULL.
+ROLLUP_COLUMNS = ("quantity", "nec_weight", "cost", "shots", "duration")
+ROLLUP_TABLES = [
+    """CREATE TABLE IF NOT EXISTS show_rollups
+    (
+        show_id integer not null
+            references shows,
+        classification integer not null,
+        quantity integer default 0 not null,
+        nec_weight float default 0 not null,
+        cost float default 0 not null,
+        shots integer default 0 not null,
+        duration float default 0 not null,
+        constraint show_rollups_pk
+            primary key (show_id, classification)
+    )""",
+    """CREATE TABLE IF NOT EXISTS venue_rollups
+    (
+        venue varchar not null,
+        day varchar not null,
+        classification integer not null,
+        quantity integer default 0 not null,
+        nec_weight float default 0 not null,
+        cost float default 0 not null,
+        shots integer default 0 not null,
+        duration float default 0 not null,
+        constraint venue_rollups_pk
+            primary key (venue, day, classification)
+    )""",
+    "CREATE INDEX IF NOT EXISTS venue_rollups_day_index on venue_rollups (day)"
+]
+
+
+def rollup_amounts(item, quantity):
+    """The SQL for what quantity of the stock_items row item adds to each of ROLLUP_COLUMNS."""
+    return [quantity,
+            "{} * IFNULL({}.nec_weight, 0)".format(quantity, item),
+            "{} * IFNULL({}.unit_cost, 0)".format(quantity, item),
+            "{} * IFNULL({}.shots, 0)".format(quantity, item),
+            "{} * IFNULL({}.duration, 0)".format(quantity, item)]
+
+
+def venue_day(show):
+    """The SQL for the venue_rollups venue and day of the shows row show."""
+    return "IFNULL({0}.venue, ''), IFNULL(date({0}.date_time / 1000, 'unixepoch', 'localtime'), '')".format(show)
+
+
+def rollup_triggers():
+    """The triggers which keep show_rollups in step with show_items, stock_items and shows, and venue_rollups in
+    step with show_rollups. Only shows which exist are totalled, so a show's rollups are dropped before it is
+    deleted, and worked out from any show_items already there when it is inserted."""
+    columns = ", ".join(ROLLUP_COLUMNS)
+
+    def set_columns(table, amounts, sign):
+        return ", ".join("{0}.{1} {2} {3}".format(table, c, sign, a) for c, a in zip(ROLLUP_COLUMNS, amounts))
+
+    def show_item(row, sign):
+        # Adds or takes off a show_items row's quantity of its item in the show's rollup for its classification.
+        insert = ("INSERT OR IGNORE INTO show_rollups (show_id, classification) "
+                  "SELECT shows.show_id, IFNULL(s.classification, -1) FROM shows "
+                  "JOIN stock_items AS s ON s.sku = {0}.sku WHERE shows.show_id = {0}.show_id;\n    ").format(row)
+        return ((insert if sign == "+" else "") +
+                "UPDATE show_rollups SET ({1}) = (SELECT {2} FROM stock_items AS s WHERE s.sku = {0}.sku) "
+                "WHERE show_rollups.show_id = {0}.show_id AND show_rollups.classification = "
+                "(SELECT IFNULL(classification, -1) FROM stock_items WHERE sku = {0}.sku);\n"
+                "    DELETE FROM show_rollups WHERE show_id = {0}.show_id AND quantity = 0;"
+                ).format(row, columns, set_columns("show_rollups", rollup_amounts("s", row + ".quantity"), sign))
+
+    def stock_item(item, sign):
+        # Adds or takes off the item's amounts for every show it is booked onto.
+        insert = ("INSERT OR IGNORE INTO show_rollups (show_id, classification) "
+                  "SELECT i.show_id, IFNULL({0}.classification, -1) FROM show_items AS i "
+                  "JOIN shows ON shows.show_id = i.show_id WHERE i.sku = {0}.sku;\n    ").format(item)
+        return ((insert if sign == "+" else "") +
+                "UPDATE show_rollups SET ({1}) = (SELECT {2} FROM show_items AS i "
+                "WHERE i.show_id = show_rollups.show_id AND i.sku = {0}.sku) "
+                "WHERE show_rollups.classification = IFNULL({0}.classification, -1) "
+                "AND show_rollups.show_id IN (SELECT show_id FROM show_items WHERE sku = {0}.sku);"
+                ).format(item, columns, set_columns("show_rollups", rollup_amounts(item, "i.quantity"), sign))
+
+    def venue(rollup, sign):
+        # Adds or takes off a show_rollups row's totals at the show's venue and day.
+        insert = ("INSERT OR IGNORE INTO venue_rollups (venue, day, classification) "
+                  "SELECT {0}, {1}.classification FROM shows WHERE shows.show_id = {1}.show_id;\n    "
+                  ).format(venue_day("shows"), rollup)
+        return ((insert if sign == "+" else "") +
+                "UPDATE venue_rollups SET ({0}) = ({1}) WHERE (venue, day, classification) = "
+                "(SELECT {2}, {3}.classification FROM shows WHERE shows.show_id = {3}.show_id);\n"
+                "    DELETE FROM venue_rollups WHERE quantity = 0 AND (venue, day) = "
+                "(SELECT {2} FROM shows WHERE shows.show_id = {3}.show_id);"
+                ).format(columns, set_columns("venue_rollups", [rollup + "." + c for c in ROLLUP_COLUMNS], sign),
+                         venue_day("shows"), rollup)
+
+    def move_show(show, sign):
+        # Adds or takes off all of a show's rollups at its venue and day, as they are in show.
+        insert = ("INSERT OR IGNORE INTO venue_rollups (venue, day, classification) "
+                  "SELECT {0}, classification FROM show_rollups WHERE show_id = {1}.show_id;\n    "
+                  ).format(venue_day(show), show)
+        return ((insert if sign == "+" else "") +
+                "UPDATE venue_rollups SET ({0}) = (SELECT {1} FROM show_rollups AS r "
+                "WHERE r.show_id = {3}.show_id AND r.classification = venue_rollups.classification) "
+                "WHERE (venue, day) = ({2}) "
+                "AND classification IN (SELECT classification FROM show_rollups WHERE show_id = {3}.show_id);\n"
+                "    DELETE FROM venue_rollups WHERE quantity = 0 AND (venue, day) = ({2});"
+                ).format(columns, set_columns("venue_rollups", ["r." + c for c in ROLLUP_COLUMNS], sign),
+                         venue_day(show), show)
+
+    triggers = [
+        ("show_items_rollup_insert", "AFTER INSERT ON show_items",
+         [show_item("NEW", "+")]),
+        ("show_items_rollup_delete", "AFTER DELETE ON show_items",
+         [show_item("OLD", "-")]),
+        ("show_items_rollup_update", "AFTER UPDATE OF show_id, sku, quantity ON show_items",
+         [show_item("OLD", "-"), show_item("NEW", "+")]),
+        ("stock_items_rollup_update",
+         "AFTER UPDATE OF classification, nec_weight, unit_cost, shots, duration ON stock_items WHEN " +
+         " OR ".join("OLD.{0} IS NOT NEW.{0}".format(c)
+                     for c in ("classification", "nec_weight", "unit_cost", "shots", "duration")),
+         [stock_item("OLD", "-"), stock_item("NEW", "+"),
+          "DELETE FROM show_rollups WHERE quantity = 0 "
+          "AND show_id IN (SELECT show_id FROM show_items WHERE sku = OLD.sku);"]),
+        ("stock_items_rollup_delete", "AFTER DELETE ON stock_items",
+         [stock_item("OLD", "-"),
+          "DELETE FROM show_rollups WHERE quantity = 0 "
+          "AND show_id IN (SELECT show_id FROM show_items WHERE sku = OLD.sku);"]),
+        ("shows_rollup_insert", "AFTER INSERT ON shows",
+         ["INSERT INTO show_rollups (show_id, classification, {0}) "
+          "SELECT NEW.show_id, IFNULL(s.classification, -1), {1} FROM show_items AS i "
+          "JOIN stock_items AS s ON s.sku = i.sku WHERE i.show_id = NEW.show_id "
+          "GROUP BY IFNULL(s.classification, -1);".format(
+              columns, ", ".join("SUM({})".format(a) for a in rollup_amounts("s", "i.quantity")))]),
+        ("shows_rollup_delete", "BEFORE DELETE ON shows",
+         ["DELETE FROM show_rollups WHERE show_id = OLD.show_id;"]),
+        ("shows_rollup_move",
+         "AFTER UPDATE OF venue, date_time ON shows "
+         "WHEN OLD.venue IS NOT NEW.venue OR OLD.date_time IS NOT NEW.date_time",
+         [move_show("OLD", "-"), move_show("NEW", "+")]),
+        ("show_rollups_venue_insert", "AFTER INSERT ON show_rollups",
+         [venue("NEW", "+")]),
+        ("show_rollups_venue_delete", "AFTER DELETE ON show_rollups",
+         [venue("OLD", "-")]),
+        ("show_rollups_venue_update", "AFTER UPDATE ON show_rollups",
+         [venue("OLD", "-"), venue("NEW", "+")])
+    ]
+    return ["CREATE TRIGGER IF NOT EXISTS {} {}\nBEGIN\n    {}\nEND".format(name, when, "\n    ".join(body))
+            for name, when, body in triggers]
+
+
+ROLLUP_TRIGGERS = rollup_triggers()
+
+
+def to_minutes(date_time, round_up=False):
+    """The whole minutes since the epoch of a datetime, as stored in show_periods."""
+    seconds = date_time.timestamp()
+    return int(seconds // 60) + (1 if round_up and seconds % 60 else 0)
+
+
 class NewSQL(sql.SQL):
-    def __init__(self, connection, handle_path, uid):
+    def __init__(self, connection, lock, pool=None, instrumentation=None, cancelled=None, timeout=None):
 
         super().__init__(connection)
 
-        self._handle_path = handle_path
-        self._uid = uid
+        self._lock = lock
+        self._pool = pool
+        self._cancelled = cancelled
+        self._timeout = timeout
+        self._has_lock = False
+        self._unit_depth = 0
+        self.handle_wait = 0.0
+        self._unreported_wait = 0.0
+        self.instrumentation = instrumentation
 
     def __enter__(self):
-        self._take_handle()
+        if self._lock is not None:
+            try:
+                self.handle_wait = self._lock.acquire(self._cancelled, self._timeout)
+            except BaseException:
+                self.close()
+                raise
+            self._unreported_wait = self.handle_wait
+            self._has_lock = True
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.close()
+        self.close(broken=exc_type is not None and issubclass(exc_type, sqlite3.Error))
 
     def run(self, query, parameters=None, return_id=False):
         """
         execute or executemany depending on parameters
         """
+        start = time.perf_counter()
         new_id = None
         with closing(self.connection.cursor()) as cursor:
             execute = getattr(cursor, self.which_execute(parameters))
@@ -45,59 +466,222 @@ class NewSQL(sql.SQL):
                 execute(query)
             if return_id:
                 new_id = cursor.lastrowid
+            rows = cursor.rowcount
+        if self.instrumentation is not None:
+            self._record(query, parameters, start, rows)
         if return_id:
             return new_id
 
-    def close(self):
-        self.connection.close()
-        self._release_handle()
-
-    def _take_handle(self, attempts=30, delay=1):
-        # Get the handle that currently exists.
-        if attempts == 0:
-            raise DatabaseTimeoutError
-        current_handle = self._get_handle()
-
-        # If we can take the handle:
-        if (current_handle is None) or current_handle.expired() or (current_handle.holder == self._uid):
-            new_handle = Handle(self._uid)
-            with open(self._handle_path, "bw") as fh:
-                pickle.dump(new_handle, fh)
-        # Else wait and try again.
-        else:
-            time.sleep(delay)
-            self._take_handle(attempts=attempts - 1)
+    def one(self, query, parameters=None):
+        start = time.perf_counter()
+        result = super().one(query, parameters)
+        if self.instrumentation is not None:
+            self._record(query, parameters, start, 0 if result is None else 1)
+        return result
 
-    def _release_handle(self):
-        current_handle = self._get_handle()
+    def all(self, query, parameters=None):
+        start = time.perf_counter()
+        result = super().all(query, parameters)
+        if self.instrumentation is not None:
+            self._record(query, parameters, start, len(result))
+        return result
 
-        if current_handle is None:
-            pass
-        else:
-            if current_handle.holder != self._uid:
-                pass
+    def all_as(self, cls, query, parameters=None):
+        """
+        fetchall returning cls objects, built by a row factory generated for the query's columns
+        """
+        start = time.perf_counter()
+        with closing(self.connection.cursor()) as cursor:
+            if parameters:
+                cursor.execute(query, parameters)
             else:
-                # The only case in which the program needs to make any changes.
-                with open(self._handle_path, "bw") as fh:
-                    pickle.dump(None, fh)
+                cursor.execute(query)
+            cursor.row_factory = row_factory(cls, [d[0] for d in cursor.description])
+            result = cursor.fetchall()
+        if self.instrumentation is not None:
+            self._record(query, parameters, start, len(result))
+        return result
+
+    def one_as(self, cls, query, parameters=None):
+        """
+        fetchone returning a cls object, or None
+        """
+        start = time.perf_counter()
+        with closing(self.connection.cursor()) as cursor:
+            if parameters:
+                cursor.execute(query, parameters)
+            else:
+                cursor.execute(query)
+            cursor.row_factory = row_factory(cls, [d[0] for d in cursor.description])
+            result = cursor.fetchone()
+        if self.instrumentation is not None:
+            self._record(query, parameters, start, 0 if result is None else 1)
+        return result
+
+    def rows(self, query, parameters=None):
+        """
+        fetchall returning the column names and plain row tuples
+        """
+        start = time.perf_counter()
+        with closing(self.connection.cursor()) as cursor:
+            if parameters:
+                cursor.execute(query, parameters)
+            else:
+                cursor.execute(query)
+            columns, result = [d[0] for d in cursor.description], cursor.fetchall()
+        if self.instrumentation is not None:
+            self._record(query, parameters, start, len(result))
+        return columns, result
+
+    def _record(self, query, parameters, start, rows):
+        # The time spent waiting for the handle is put against the first statement run after getting it.
+        handle_wait, self._unreported_wait = self._unreported_wait, 0.0
+        self.instrumentation.record(self, query, parameters, time.perf_counter() - start, rows, handle_wait)
+
+    def close(self, broken=False):
+        if self._pool is None:
+            self.connection.close()
+        else:
+            self._pool.put(self.connection, broken)
+        if self._has_lock:
+            self._has_lock = False
+            self._lock.release()
 
     def last_row_id(self):
         return
 
-    def _get_handle(self):
-        try:
-            with open(self._handle_path, "br") as fh:
-                current_handle = pickle.load(fh)
-        except FileNotFoundError:
-            current_handle = None
-        return current_handle
-
     def has_handle(self):
-        current_handle = self._get_handle()
-        return (current_handle is not None) and (current_handle.holder == self._uid) and (not current_handle.expired())
+        return self._has_lock
 
     def commit(self):
-        self.connection.commit()
+        """Commits, unless inside a unit of work, which commits once when it ends."""
+        if self._unit_depth == 0:
+            self.connection.commit()
+
+    @contextmanager
+    def unit_of_work(self):
+        """Runs everything done inside it as one transaction, committed once at the end
+        and rolled back as a whole if an exception escapes.
+        Units of work can be nested, and a nested unit is a savepoint which rolls back on its own.
+        A unit started while the caller already has a transaction open joins it as a savepoint too,
+        so it's committed along with the rest of the caller's transaction, not on its own.
+        """
+        outermost = self._unit_depth == 0 and not self.connection.in_transaction
+        savepoint = "unit_of_work_{}".format(self._unit_depth)
+        if outermost:
+            self.connection.execute("BEGIN IMMEDIATE")
+        else:
+            self.connection.execute("SAVEPOINT " + savepoint)
+        self._unit_depth += 1
+
+        try:
+            yield self
+        except BaseException:
+            self._unit_depth -= 1
+            if outermost:
+                self.connection.rollback()
+            else:
+                self.connection.execute("ROLLBACK TO " + savepoint)
+                self.connection.execute("RELEASE " + savepoint)
+            raise
+        else:
+            self._unit_depth -= 1
+            if outermost:
+                self.connection.commit()
+            else:
+                self.connection.execute("RELEASE " + savepoint)
+
+
+class QueryInstrumentation:
+    """Collects timings for the statements run through NewSQL connections which are given it.
+
+    Counters are kept per call site and SQL text, where the call site is the first caller outside the connection,
+    e.g. DatabaseHandler.get_shows. Statements taking at least threshold seconds are written, along with their
+    EXPLAIN QUERY PLAN, to a rotating log of JSON lines if a log path is given.
+    """
+    def __init__(self, log_path=None, threshold=0.1, max_bytes=1024 * 1024, backup_count=3):
+        self.threshold = threshold
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._handler = None
+        self.logger = logging.getLogger("fuzed.slow_queries")
+        if log_path:
+            self._handler = logging.handlers.RotatingFileHandler(log_path,
+                                                                 maxBytes=max_bytes,
+                                                                 backupCount=backup_count,
+                                                                 encoding="utf-8")
+            self.logger.addHandler(self._handler)
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+
+    def record(self, con, query, parameters, seconds, rows, handle_wait=0.0):
+        """
+        :type con: NewSQL
+        """
+        site = self.call_site(con)
+        sql_text = " ".join(query.split())
+        with self._lock:
+            counter = self.counters.get((site, sql_text))
+            if counter is None:
+                counter = self.counters[(site, sql_text)] = {"calls": 0,
+                                                             "seconds": 0.0,
+                                                             "max_seconds": 0.0,
+                                                             "rows": 0,
+                                                             "handle_wait": 0.0,
+                                                             "slow_calls": 0}
+            counter["calls"] += 1
+            counter["seconds"] += seconds
+            counter["max_seconds"] = max(counter["max_seconds"], seconds)
+            counter["rows"] += max(rows, 0)
+            counter["handle_wait"] += handle_wait
+            if seconds >= self.threshold:
+                counter["slow_calls"] += 1
+
+        if seconds >= self.threshold and self._handler is not None:
+            self.logger.info(json.dumps({"time": datetime.datetime.now().isoformat(timespec="seconds"),
+                                         "site": site,
+                                         "sql": sql_text,
+                                         "seconds": round(seconds, 6),
+                                         "rows": rows,
+                                         "handle_wait": round(handle_wait, 6),
+                                         "plan": self.query_plan(con, query, parameters)}))
+
+    @staticmethod
+    def call_site(con):
+        frame = sys._getframe(2)
+        while frame is not None and frame.f_locals.get("self") is con:
+            frame = frame.f_back
+        if frame is None:
+            return "?"
+        return "{}:{}:{}".format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name, frame.f_lineno)
+
+    @staticmethod
+    def query_plan(con, query, parameters):
+        """Returns the EXPLAIN QUERY PLAN details for a statement, or an empty list if it can't be explained."""
+        if parameters and sql.SQL.which_execute(parameters) == "executemany":
+            parameters = parameters[0]
+        try:
+            with closing(con.connection.cursor()) as cursor:
+                cursor.execute("EXPLAIN QUERY PLAN " + query, parameters or ())
+                return [r[-1] for r in cursor.fetchall()]
+        except sqlite3.Error:
+            return []
+
+    def stats(self):
+        """Returns the counters as a list of dicts, slowest total first."""
+        with self._lock:
+            stats = [dict(counter, site=site, sql=sql_text) for (site, sql_text), counter in self.counters.items()]
+        return sorted(stats, key=lambda s: s["seconds"], reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+
+    def close(self):
+        if self._handler is not None:
+            self.logger.removeHandler(self._handler)
+            self._handler.close()
+            self._handler = None
 
 
 class DatabaseHandler:
@@ -105,95 +689,465 @@ class DatabaseHandler:
         self.database_path = database_path
         self.uid = os.environ["USERNAME"] + "@" + os.environ["COMPUTERNAME"]
         self._handle_path = self.database_path + "-handle.dat"
+        self.lock = LeaseLock(self._handle_path, self.uid)
+        self.pool = ConnectionPool(self.database_path)
+        self._has_search_index = None
+        self.instrumentation = None
+
+        # Caches, kept in step with the changes journal. See check_caches.
+        self.item_cache = LRUCache(1000)
+        self.reference_cache = LRUCache(16)
+        self.cache_check_interval = 1.0
+        self._cache_lock = threading.Lock()  # Guards the fields below, shared by the executor's workers.
+        self._cache_seq = None
+        self._cache_checked = 0.0
+        # Bumped whenever anything is dropped from the caches. A row read before a bump may be stale, so it isn't
+        # put in the cache.
+        self._cache_generation = 0
+
+        self.executor = DatabaseExecutor(self)
 
         self.__signed_in_user = None
 
-    def open_database_connection(self):
-        sql_conn = sqlite3.connect(self.database_path)
-        return NewSQL(sql_conn, self._handle_path, self.uid)
+    def open_database_connection(self, read_only=False, cancelled=None, timeout=None):
+        """Opens a connection for use as a context manager.
+        Writing connections hold the handle for their lifetime, read only connections never touch it,
+        so browsing on one workstation doesn't block the others.
+        Setting the cancelled Event, if given, abandons waiting for the handle with a DatabaseCancelledError.
+        timeout overrides how many seconds to wait for the handle before a DatabaseTimeoutError.
+        """
+        sql_conn = self.pool.get(read_only)
+        return NewSQL(sql_conn, None if read_only else self.lock, self.pool, self.instrumentation, cancelled,
+                      timeout)
+
+    @contextmanager
+    def unit_of_work(self):
+        """Opens a writing connection and runs everything done with it as one transaction.
+        e.g. with database.unit_of_work() as con: ...
+        """
+        with self.open_database_connection() as con:
+            with con.unit_of_work():
+                yield con
+
+    def pool_stats(self):
+        return self.pool.stats()
+
+    def enable_instrumentation(self, log_path=None, threshold=0.1):
+        """Times every statement run on connections opened from now on, logging those slower than threshold
+        seconds to log_path. Returns the QueryInstrumentation, whose stats() gives the counters.
+        """
+        self.disable_instrumentation()
+        self.instrumentation = QueryInstrumentation(log_path, threshold)
+        return self.instrumentation
+
+    def disable_instrumentation(self):
+        if self.instrumentation is not None:
+            self.instrumentation.close()
+            self.instrumentation = None
+
+    def cache_stats(self):
+        return {"items": self.item_cache.stats(),
+                "reference": self.reference_cache.stats()}
+
+    def clear_caches(self):
+        with self._cache_lock:
+            self._cache_generation += 1
+            self.item_cache.clear()
+            self.reference_cache.clear()
+
+    def _drop_item(self, sku):
+        with self._cache_lock:
+            self._cache_generation += 1
+            self.item_cache.pop(sku)
+
+    def check_caches(self, con, force=False):
+        """Drops the cached rows changed by any workstation since the caches were last checked against the
+        changes journal. Checks at most once every cache_check_interval seconds unless forced.
+        :type con: NewSQL
+        """
+        now = time.monotonic()
+        with self._cache_lock:
+            seq = self._cache_seq
+            if not force and seq is not None and now - self._cache_checked < self.cache_check_interval:
+                return
+            self._cache_checked = now
+        if seq is None:
+            latest = self.latest_change(con)
+            with self._cache_lock:
+                if self._cache_seq is None:
+                    self._cache_generation += 1
+                    self.item_cache.clear()
+                    self.reference_cache.clear()
+                    self._cache_seq = latest
+            return
+        changes = self.changes_since(con, seq)
+        with self._cache_lock:
+            # Another worker may have checked meanwhile. Dropping the same rows again does no harm.
+            if changes.reload:
+                self._cache_generation += 1
+                self.item_cache.clear()
+                self.reference_cache.clear()
+            else:
+                skus = changes.changed_ids("stock_items") | changes.deleted_ids("stock_items")
+                tables = [t for t in JOURNALLED_REFERENCE_TABLES if changes.changed_ids(t) or changes.deleted_ids(t)]
+                if skus or tables:
+                    self._cache_generation += 1
+                for sku in skus:
+                    self.item_cache.pop(sku)
+                for table in tables:
+                    self.reference_cache.pop(table)
+            self._cache_seq = max(self._cache_seq or 0, changes.seq)
+
+    def _cache_put(self, cache, key, value, generation):
+        # Skipped if anything was dropped since the value was read, as it may be the stale copy.
+        with self._cache_lock:
+            if self._cache_generation == generation:
+                cache.put(key, value)
+
+    def _use_cache(self, con):
+        # Rows read inside a transaction may be uncommitted, so they're neither cached nor served from the cache.
+        if con.connection.in_transaction:
+            return False
+        self.check_caches(con)
+        return True
+
+    def query_stats(self):
+        if self.instrumentation is None:
+            return []
+        return self.instrumentation.stats()
 
     def who_has_handle(self):
-        with open(self._handle_path, "br") as fh:
-            handle: Handle = pickle.load(fh)
+        lease = self.lock.lease()
 
-        if handle is None:
+        if lease is None:
             print("Handle not currently held.")
         else:
+            holder, expiry = lease
             print("Handle {} currently held by {} until {}, expired: {}".format(self._handle_path,
-                                                                                handle.holder,
-                                                                                handle.expiry.ctime(),
-                                                                                handle.expired()))
+                                                                                holder,
+                                                                                expiry.ctime(),
+                                                                                datetime.datetime.now() > expiry))
 
     def get_item(self, con: NewSQL, sku: str) -> StockItem:
-        record = con.one("SELECT * FROM stock_items WHERE sku IS ?", (sku,))
-        return StockItem(record)
+        """Returns the item with the SKU, or None. Items are cached, and each call returns a separate copy."""
+        if not self._use_cache(con):
+            return con.one_as(StockItem, "SELECT * FROM stock_items WHERE sku IS ?", (sku,))
+        try:
+            key = int(sku)
+        except (TypeError, ValueError):
+            return None
+        item = self.item_cache.get(key)
+        if item is None:
+            generation = self._cache_generation
+            item = con.one_as(StockItem, "SELECT * FROM stock_items WHERE sku IS ?", (key,))
+            if item is None:
+                return None
+            self._cache_put(self.item_cache, key, item, generation)
+        return item.copy()
+
+    def get_items(self, con, skus):
+        """Returns the stock items with the given SKUs, in SKU order, skipping any which don't exist.
+        :type con: NewSQL
+        """
+        skus = list(skus)
+        items = []
+        for i in range(0, len(skus), MAX_QUERY_PARAMETERS):
+            chunk = skus[i:i + MAX_QUERY_PARAMETERS]
+            items += con.all_as(StockItem, "SELECT * FROM stock_items WHERE sku IN ({})".format(
+                ", ".join("?" * len(chunk))), chunk)
+        items.sort(key=lambda i: i.sku)
+        return items
 
     def add_item(self, con: NewSQL, item):
-        item_attributes = dict(item.__dict__)
-        item_attributes.pop("sku")
+        item_attributes = {f: getattr(item, f) for f in item.FIELDS if f != "sku"}
         q = "INSERT INTO stock_items ({}) VALUES ({})".format(", ".join(item_attributes.keys()),
                                                               ("?, " * len(item_attributes)).strip(", "))
         new_id = con.run(q, list(item_attributes.values()), True)
         con.commit()
+        self._drop_item(new_id)
         return new_id
 
     def update_item(self, con: NewSQL, item):
-        q = "UPDATE stock_items SET"
-        args = []
-        for k in item.__dict__.keys():
-            if k != "sku":
-                q += " " + k + "=?,"
-                args.append(item.__dict__[k])
-        q = q.strip(",")
-        args.append(item.sku)
-        q += " WHERE sku=?"
-        con.run(q, args)
+        """Writes the fields of the item changed since it was loaded, if any, then marks it clean."""
+        fields = [f for f in item.dirty_fields() if f != "sku"]
+        if len(fields) == 0:
+            return
+        q = "UPDATE stock_items SET {} WHERE sku=?".format(", ".join(f + "=?" for f in fields))
+        con.run(q, [getattr(item, f) for f in fields] + [item.sku])
         con.commit()
+        self._drop_item(int(item.sku))
+        item.mark_clean()
 
-    def get_items_by_category(self, con, categories, text_filter=""):
-        if type(categories) in (list, tuple):
-            q = "SELECT * FROM stock_items WHERE category IN ({})"
-            q.format(str(categories).strip("()[],"))
-        elif categories == "*":
+    def get_items_by_category(self, con, categories="*", text_filter="", classifications="*", show_hidden=True,
+                              after_sku=None, limit=None, page_size=500):
+        """Yields the matching StockItems in SKU order, fetching them from the database a page at a time.
+        Must be consumed while the connection is open.
+        :type con: NewSQL
+        :param categories: list or tuple of category numbers, or '*' for any.
+        :param text_filter: str, matched case insensitively within the description or notes.
+        :param classifications: list or tuple of classification ids, or '*' for any.
+        :param show_hidden: bool, whether hidden items are included.
+        :param after_sku: int, start after this SKU, i.e. the last SKU of the previous page.
+        :param limit: int, the most items to yield, or None for all of them.
+        :param page_size: int, the number of rows fetched by each query.
+        """
+        conditions = []
+        parameters = []
+        for field, values in (("category", categories), ("classification", classifications)):
+            if type(values) in (list, tuple):
+                conditions.append("{} IN ({})".format(field, ", ".join("?" * len(values))))
+                parameters += list(values)
+            elif values != "*":
+                raise ValueError("Parameters categories and classifications must be list, tuple or '*'.")
+        if not show_hidden:
+            conditions.append("hidden NOT IN (1, 'True')")
+        if text_filter != "":
+            pattern = "%" + re.sub(r"([\\%_])", r"\\\1", text_filter) + "%"
+            conditions.append("(description LIKE ? ESCAPE '\\' OR notes LIKE ? ESCAPE '\\')")
+            parameters += [pattern, pattern]
+
+        while limit is None or limit > 0:
+            page_conditions = conditions if after_sku is None else conditions + ["sku > ?"]
+            page_parameters = parameters if after_sku is None else parameters + [after_sku]
+            page_limit = page_size if limit is None else min(page_size, limit)
             q = "SELECT * FROM stock_items"
+            if len(page_conditions) > 0:
+                q += " WHERE " + " AND ".join(page_conditions)
+            q += " ORDER BY sku LIMIT ?"
+
+            records = con.all_as(StockItem, q, page_parameters + [page_limit])
+            yield from records
+
+            if len(records) < page_limit:
+                break
+            after_sku = records[-1].sku
+            if limit is not None:
+                limit -= len(records)
+
+    def search_items(self, con, query, limit=50):
+        """Takes a free text query and returns the SKUs of matching items, best matches first.
+        Every word in the query must match the start of a word in one of the searched fields.
+        Falls back to a substring search if this SQLite build has no FTS5.
+        :type con: NewSQL
+        :param limit: int, or None for all matches.
+        """
+        words = re.findall(r"\w+", query.lower())
+        if len(words) == 0:
+            return []
+        if limit is None:
+            limit = -1
+
+        if self._has_search_index is None:
+            self._has_search_index = con.one("SELECT name FROM sqlite_master "
+                                             "WHERE type='table' AND name='stock_items_fts'") is not None
+
+        if self._has_search_index:
+            match = " ".join('"{}"*'.format(w) for w in words)
+            return con.all("SELECT rowid FROM stock_items_fts WHERE stock_items_fts MATCH ? ORDER BY rank LIMIT ?",
+                           (match, limit))
+        else:
+            field_match = "(" + " OR ".join("{} LIKE ?".format(f) for f in SEARCH_FIELDS) + ")"
+            parameters = []
+            for w in words:
+                parameters += ["%" + w + "%"] * len(SEARCH_FIELDS)
+            return con.all("SELECT sku FROM stock_items WHERE {} ORDER BY sku LIMIT ?".format(
+                " AND ".join([field_match] * len(words))), parameters + [limit])
+
+    def get_stock_levels(self, con, sku, window=None):
+        """Takes a SKU and returns the stock on hand and the available stock, during the window if given.
+        :type con: NewSQL
+        """
+        return self.get_stock_levels_bulk(con, (sku,), window).get(int(sku), (0, 0))
+
+    def get_stock_levels_bulk(self, con, skus=None, window=None):
+        """Takes a list of SKUs, or None for every item, and returns a dict of SKU: (stock on hand, available).
+        Without a window, everything ever booked onto a show is taken off, read from the stock_allocations totals
+        so no show_items are scanned. With a window of (start, end) datetimes, only the quantities booked onto
+        open shows holding their stock at some point in it are taken off, found through show_periods.
+        An end of None leaves the window open, covering every open show still holding its stock at the start.
+        :type con: NewSQL
+        :type window: (datetime.datetime, datetime.datetime | None)
+        """
+        if window is None:
+            q = "SELECT stock_items.sku, stock_items.stock_on_hand, " \
+                "stock_items.stock_on_hand - IFNULL(stock_allocations.allocated, 0) AS available " \
+                "FROM stock_items LEFT JOIN stock_allocations ON stock_allocations.sku = stock_items.sku{}"
+            parameters = []
+        else:
+            period = "show_periods.ends >= ?"
+            parameters = [to_minutes(window[0])]
+            if window[1] is not None:
+                period += " AND show_periods.starts <= ?"
+                parameters.append(to_minutes(window[1], round_up=True))
+            q = "SELECT stock_items.sku, stock_items.stock_on_hand, " \
+                "stock_items.stock_on_hand - IFNULL(booked.quantity, 0) AS available " \
+                "FROM stock_items LEFT JOIN " \
+                "(SELECT show_items.sku, SUM(show_items.quantity) AS quantity FROM show_periods " \
+                "JOIN show_items ON show_items.show_id = show_periods.id " \
+                "WHERE " + period + " GROUP BY show_items.sku) AS booked " \
+                "ON booked.sku = stock_items.sku{}"
+        if skus is None:
+            records = con.all(q.format(""), parameters)
         else:
-            raise (ValueError("Parameter categories must be list, tuple or '*'."))
+            skus = list(skus)
+            records = []
+            step = MAX_QUERY_PARAMETERS - len(parameters)
+            for i in range(0, len(skus), step):
+                chunk = skus[i:i + step]
+                records += con.all(q.format(" WHERE stock_items.sku IN ({})".format(", ".join("?" * len(chunk)))),
+                                   parameters + chunk)
+        return {r.sku: (r.stock_on_hand, r.available) for r in records}
+
+    def get_shows_in_window(self, con, start, end):
+        """Returns the ids of the open shows holding their stock at some point between the start and end datetimes.
+        :type con: NewSQL
+        """
+        return con.all("SELECT id FROM show_periods WHERE starts <= ? AND ends >= ?",
+                       (to_minutes(end, round_up=True), to_minutes(start)))
+
+    def get_show_rollups(self, con, show_ids):
+        """Takes a list of show ids and returns a dict of show id: list of Rollup, one per classification booked.
+        The totals are kept up to date by triggers, so nothing is summed here.
+        :type con: NewSQL
+        """
+        show_ids = list(show_ids)
+        rollups = {i: [] for i in show_ids}
+        for i in range(0, len(show_ids), MAX_QUERY_PARAMETERS):
+            chunk = show_ids[i:i + MAX_QUERY_PARAMETERS]
+            for r in con.all_as(Rollup, "SELECT * FROM show_rollups WHERE show_id IN ({}) "
+                                        "ORDER BY show_id, classification".format(", ".join("?" * len(chunk))),
+                                chunk):
+                rollups[r.show_id].append(r)
+        return rollups
+
+    def get_venue_rollups(self, con, venue=None, day=None):
+        """Returns a Rollup per venue, day and classification booked, for the venue and day if given.
+        Shows without a venue are under "", and without a date under a day of None.
+        :type con: NewSQL
+        :type day: datetime.date
+        """
+        where = []
+        parameters = []
+        if venue is not None:
+            where.append("venue = ?")
+            parameters.append(venue)
+        if day is not None:
+            where.append("day = ?")
+            parameters.append(day.isoformat())
+        return con.all_as(Rollup, "SELECT * FROM venue_rollups{} ORDER BY venue, day, classification".format(
+            " WHERE " + " AND ".join(where) if where else ""), parameters)
+
+    def rebuild_rollups(self):
+        """Works the rollups out from scratch, clearing any rounding built up by the incremental updates."""
+        with self.unit_of_work() as con:
+            fill_rollups(con)
 
-        items = [StockItem(i) for i in con.all(q)]
+    def get_shows(self, con, open_only=True, text_filter=""):
+        where = ""
+        if open_only:
+            where = " WHERE complete=0"
+
+        shows = self.load_shows(con, where)
 
         if text_filter != "":
-            for i in items:
-                if text_filter.lower() in i.description.lower() or text_filter.lower() in i.notes.lower():
-                    pass
-                else:
-                    items.remove(i)
+            text_filter = text_filter.lower()
+            shows = [s for s in shows if text_filter in (s.show_title or "").lower() or
+                     text_filter in (s.show_description or "").lower() or
+                     text_filter in (s.supervisor or "").lower()]
 
-        return items
+        return shows
 
-    def get_stock_levels(self, con, sku):
-        """Takes a SKU and returns the stock pn hand and the available stock.
+    def get_upcoming_shows(self, con, limit, after=None):
+        """Returns ShowSummary objects for the first limit open shows in date order, from after if given.
+        Uses shows_complete_date_time_index, so only the rows returned are read.
         :type con: NewSQL
+        :type after: datetime.datetime
         """
-        stock_on_hand = sum(con.all("SELECT stock_on_hand FROM stock_items WHERE sku=?", (sku,)))
-        available = stock_on_hand - sum(con.all("SELECT quantity FROM show_items WHERE sku=?", (sku,)))
-        return stock_on_hand, available
+        where = "WHERE complete=0"
+        parameters = []
+        if after is not None:
+            where += " AND date_time >= ?"
+            parameters.append(int(after.timestamp() * 1000))
+        parameters.append(limit)
+        return con.all_as(ShowSummary, "SELECT show_id, show_title, show_description, date_time FROM shows "
+                                       "{} ORDER BY date_time LIMIT ?".format(where), parameters)
+
+    def get_shows_by_id(self, con, show_ids):
+        """Returns the shows with the given ids, with their items and changes, skipping any which don't exist.
+        :type con: NewSQL
+        """
+        show_ids = list(show_ids)
+        shows = []
+        for i in range(0, len(show_ids), MAX_QUERY_PARAMETERS):
+            chunk = show_ids[i:i + MAX_QUERY_PARAMETERS]
+            shows += self.load_shows(con, " WHERE show_id IN ({})".format(", ".join("?" * len(chunk))), chunk)
+        return shows
 
-    def get_shows(self, con, open_only=True, text_filter=""):
-        q = "SELECT * FROM shows"
-        if open_only:
-            q += " WHERE complete=0"
+    def latest_change(self, con):
+        """Returns the sequence number of the newest change in the journal.
+        Read it before loading data, then pass it to changes_since to get what changed after the load.
+        :type con: NewSQL
+        """
+        return con.one("SELECT seq FROM sqlite_sequence WHERE name='changes'") or 0
 
-        shows = [self.record_to_show(con, s) for s in con.all(q)]
+    def changes_since(self, con, seq):
+        """Returns a ChangeSet of the rows in stock_items, shows, show_items and users changed after seq.
+        :type con: NewSQL
+        """
+        oldest = con.one("SELECT MIN(seq) FROM changes")
+        rows = con.rows("SELECT seq, table_name, row_id, sub_id, operation FROM changes WHERE seq > ? ORDER BY seq",
+                        (seq,))[1]
+        latest = rows[-1][0] if rows else max(seq, self.latest_change(con))
+        change_set = ChangeSet(latest, reload=oldest is not None and seq < oldest - 1)
+        for _, table, row_id, sub_id, operation in rows:
+            change_set.add(table, row_id if sub_id is None else (row_id, sub_id), operation)
+        return change_set
+
+    def prune_changes(self, con, before_seq=None):
+        """Deletes the journalled changes up to and including before_seq, or if it isn't given, those older than
+        CHANGE_RETENTION. Changes this handler's caches haven't been checked against yet are never deleted, and
+        nor is the newest change, so a client asking for changes from before the pruned point can be told to reload.
+        Returns the number of changes deleted.
+        :type con: NewSQL
+        """
+        if before_seq is None:
+            cutoff = int((datetime.datetime.now() - CHANGE_RETENTION).timestamp() * 1000)
+            before_seq = con.one("SELECT MAX(seq) FROM changes WHERE changed_at < ?", (cutoff,))
+            if before_seq is None:
+                return 0
+        with self._cache_lock:
+            if self._cache_seq is not None:
+                before_seq = min(before_seq, self._cache_seq)
+        count = con.one("SELECT COUNT(*) FROM changes WHERE seq <= ? AND seq < (SELECT MAX(seq) FROM changes)",
+                        (before_seq,))
+        con.run("DELETE FROM changes WHERE seq <= ? AND seq < (SELECT MAX(seq) FROM changes)", (before_seq,))
+        con.commit()
+        return count
 
-        if text_filter != "":
-            for s in shows:
-                text_filter = text_filter.lower()
-                if text_filter in s.show_title.lower() or \
-                        text_filter in s.show_description.lower() or \
-                        text_filter in s.supervisor.lower():
-                    pass
-                else:
-                    shows.remove(s)
+    def load_shows(self, con, where="", parameters=None):
+        """Builds the shows selected by the where clause, prefetching all of their items and changes.
+        Three queries are run in total, no matter how many shows or items are selected.
+        :type con: NewSQL
+        :param where: str, a WHERE clause on the shows table, e.g. " WHERE complete=0"
+        :param parameters: parameters for any placeholders in the where clause
+        """
+        show_ids = "SELECT show_id FROM shows" + where
+
+        shows = con.all_as(Show, "SELECT * FROM shows" + where, parameters)
+        by_id = {s.show_id: s for s in shows}
+
+        columns, rows = con.rows("SELECT show_id, date_time, text FROM show_changes "
+                                 "WHERE show_id IN ({}) ORDER BY change_no".format(show_ids), parameters)
+        build = row_builder(ShowChange, columns)
+        for r in rows:
+            by_id[r[0]].changes.append(build(r))
+
+        columns, rows = con.rows("SELECT stock_items.*, show_items.show_id, show_items.quantity FROM show_items "
+                                 "JOIN stock_items ON stock_items.sku = show_items.sku "
+                                 "WHERE show_items.show_id IN ({})".format(show_ids), parameters)
+        build = row_builder(StockItem, columns)
+        for r in rows:
+            by_id[r[-2]].items.append((build(r), r[-1]))
 
         return shows
 
@@ -210,7 +1164,7 @@ class DatabaseHandler:
         con.commit()
 
     def get_users(self, con: NewSQL):
-        return [User(r) for r in con.all("SELECT user_id, name, auth_level FROM users")]
+        return con.all_as(User, "SELECT user_id, name, auth_level FROM users")
 
     def validate_user(self, con, user_name, password, sign_in=False):
         assert type(user_name) in (str, int)
@@ -255,7 +1209,7 @@ class DatabaseHandler:
 
         con.run("UPDATE users SET pass_hash=?, pass_salt=? WHERE name=?",
                 (new_hash, new_salt, user_name.lower()))
-        con.connection.commit()
+        con.commit()
 
         return new_password
 
@@ -271,7 +1225,7 @@ class DatabaseHandler:
 
         con.run("UPDATE users SET pass_hash=?, pass_salt=? WHERE user_id=?",
                 (new_hash, new_salt, user_id))
-        con.connection.commit()
+        con.commit()
 
         return True
 
@@ -300,46 +1254,365 @@ class DatabaseHandler:
         self.__signed_in_user = None
 
     def get_show_changes(self, con, show_id):
-        raw_changes = con.all("SELECT date_time, text FROM show_changes WHERE show_id=?", (show_id,))
-
-        return [ShowChange(datetime.datetime.fromtimestamp(c.date_time / 1000), c.text) for c in raw_changes]
+        return con.all_as(ShowChange, "SELECT date_time, text FROM show_changes WHERE show_id=? ORDER BY change_no",
+                          (show_id,))
 
     def get_show_items(self, con, show_id):
-        raw_items = con.all("SELECT sku, quantity FROM show_items WHERE show_id=?", (show_id,))
-        items = [(StockItem(con.one("SELECT * FROM stock_items WHERE sku=?", (i.sku,))),
-                  i.quantity) for i in raw_items]
-        return items
+        columns, rows = con.rows("SELECT stock_items.*, show_items.quantity FROM show_items "
+                                 "JOIN stock_items ON stock_items.sku = show_items.sku WHERE show_items.show_id=?",
+                                 (show_id,))
+        build = row_builder(StockItem, columns)
+        return [(build(r), r[-1]) for r in rows]
 
     def get_categories(self, con):
-        return con.all("SELECT category_text FROM stock_categories")
+        return self._get_reference(con, "stock_categories", "SELECT category_text FROM stock_categories")
 
     def get_classifications(self, con):
-        return con.all("SELECT classification_text FROM stock_classifications")
-
-    def record_to_show(self, con, record):
-        changes = self.get_show_changes(con, record.show_id)
-        items = self.get_show_items(con, record.show_id)
-        return Show(record.show_id,
-                    record.show_title,
-                    record.show_description,
-                    record.supervisor,
-                    datetime.datetime.fromtimestamp(record.date_time / 1000),
-                    bool(record.complete),
-                    changes,
-                    items,
-                    record.venue)
+        return self._get_reference(con, "stock_classifications",
+                                   "SELECT classification_text FROM stock_classifications")
+
+    def _get_reference(self, con, table, query):
+        if not self._use_cache(con):
+            return con.all(query)
+        values = self.reference_cache.get(table)
+        if values is None:
+            generation = self._cache_generation
+            values = con.all(query)
+            self._cache_put(self.reference_cache, table, values, generation)
+        return list(values)
 
     def get_all_items(self, con):
-        return [StockItem(i) for i in con.all("SELECT * FROM stock_items")]
+        return con.all_as(StockItem, "SELECT * FROM stock_items")
+
+
+class DatabaseTask:
+    """A call submitted to a DatabaseExecutor. cancel() stops it from starting, or from waiting any longer for the
+    handle, in which case result() raises DatabaseCancelledError. A call already holding its connection finishes."""
+    def __init__(self, future, cancelled):
+        self.future = future
+        self.cancelled = cancelled
+
+    def cancel(self):
+        self.cancelled.set()
+        self.future.cancel()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        try:
+            return self.future.result(timeout)
+        except concurrent.futures.CancelledError:
+            raise DatabaseCancelledError("Cancelled before it started")
+
+    def add_done_callback(self, callback):
+        """Calls callback(task) on the worker thread once the call has finished, failed or been cancelled."""
+        self.future.add_done_callback(lambda f: callback(self))
+
+
+class DatabaseExecutor:
+    """Runs database calls on a few worker threads, so that waiting for the handle never blocks the caller.
+    submit(work, *args) calls work(con, *args) on a worker with a connection from the database's pool,
+    and returns a DatabaseTask for its result.
+    :type database: DatabaseHandler
+    """
+    def __init__(self, database, workers=3):
+        self.database = database
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="database")
+
+    def submit(self, work, *args, read_only=False):
+        cancelled = threading.Event()
+        return DatabaseTask(self._executor.submit(self._run, work, args, read_only, cancelled), cancelled)
+
+    def _run(self, work, args, read_only, cancelled):
+        if cancelled.is_set():
+            raise DatabaseCancelledError("Cancelled before it started")
+        with self.database.open_database_connection(read_only, cancelled) as con:
+            return work(con, *args)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait)
+
+
+class LRUCache:
+    """A thread safe mapping of at most max_size entries, which evicts the least recently used."""
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            return self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {"size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions}
+
+
+class PooledConnection(sqlite3.Connection):
+    """A connection which remembers its mode and which database file it was opened on."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.read_only = False
+        self.file_identity = None
+
+
+class ConnectionPool:
+    """Keeps idle connections to one database for reuse, separately for writing and read only connections.
+
+    Idle connections are health checked before being handed out. They are dropped after an error,
+    and all of them are dropped if the database file is replaced."""
+
+    def __init__(self, database_path, size=4):
+        self.database_path = database_path
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.discards = 0
+
+        self._idle = {False: [], True: []}
+        self._lock = threading.Lock()
+
+    def get(self, read_only=False):
+        identity = _file_identity(self.database_path)
+        with self._lock:
+            idle = self._idle[read_only]
+            while len(idle) > 0:
+                connection = idle.pop()
+                if connection.file_identity == identity and self._healthy(connection):
+                    self.hits += 1
+                    return connection
+                self.discards += 1
+                connection.close()
+            self.misses += 1
+
+        if read_only:
+            connection = sqlite3.connect("file:{}?mode=ro".format(pathname2url(os.path.abspath(self.database_path))),
+                                         uri=True, factory=PooledConnection, check_same_thread=False)
+        else:
+            connection = sqlite3.connect(self.database_path, factory=PooledConnection, check_same_thread=False)
+        connection.read_only = read_only
+        connection.file_identity = identity
+        return connection
+
+    def put(self, connection, broken=False):
+        """Returns a connection to the pool, rolling back anything left uncommitted."""
+        if not broken:
+            try:
+                connection.rollback()
+            except sqlite3.Error:
+                broken = True
+        with self._lock:
+            idle = self._idle[connection.read_only]
+            if not broken and len(idle) < self.size and \
+                    connection.file_identity == _file_identity(self.database_path):
+                idle.append(connection)
+                return
+            self.discards += 1
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for connection in idle:
+                    connection.close()
+                idle.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "discards": self.discards,
+                    "idle": sum(len(i) for i in self._idle.values())}
+
+    @staticmethod
+    def _healthy(connection):
+        try:
+            connection.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+
+def _file_identity(path):
+    """Identifies the file at path, so a database which has been replaced by a copy can be spotted."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    # st_ctime is the creation time on Windows, where st_ino may be 0 on network shares.
+    return stat.st_dev, stat.st_ino, stat.st_ctime if os.name == "nt" else None
+
+
+class LeaseLock:
+    """Exclusive writer lock on the database, shared between workstations through the handle file.
+
+    The lock itself is an OS lock on the file, so taking it is atomic and it is dropped if the holder dies.
+    While held, the holder's uid and lease expiry are written into the file and renewed in the background,
+    so anyone waiting can see who has the database and whether they are still alive.
+    The lock is re-entrant within a process."""
+    _LOCK_OFFSET = 4096  # Lock a byte past the lease record, so it can still be read on Windows.
+
+    def __init__(self, path, uid, ttl=30, timeout=30, base_delay=0.05, max_delay=1.0):
+        self.path = path
+        self.uid = uid
+        self.ttl = ttl
+        self.timeout = timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.wait_times = collections.deque(maxlen=100)  # Seconds each recent caller waited for the lock.
+
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+        self._stop_renewing = threading.Event()
+        self._renewer = None
+
+    def acquire(self, cancelled=None, timeout=None):
+        """Takes the lock, retrying with jittered exponential backoff until the timeout, which defaults to
+        the lock's own. A timeout of 0 makes a single attempt.
+        If the cancelled Event is given and gets set while waiting, gives up with a DatabaseCancelledError.
+        Returns the number of seconds spent waiting.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        start = time.monotonic()
+        while not self._thread_lock.acquire(timeout=0.1):
+            if cancelled is not None and cancelled.is_set():
+                raise DatabaseCancelledError("Cancelled waiting for {}".format(self.path))
+            if time.monotonic() - start >= timeout:
+                raise DatabaseTimeoutError("Timed out waiting for another thread to release {}".format(self.path))
+        try:
+            if self._depth == 0:
+                self._acquire_file(start, timeout, cancelled)
+        except BaseException:
+            self._thread_lock.release()
+            raise
+        self._depth += 1
+
+        waited = time.monotonic() - start
+        self.wait_times.append(waited)
+        return waited
+
+    def release(self):
+        assert self._depth > 0
+        self._depth -= 1
+        if self._depth == 0:
+            self._stop_renewing.set()
+            self._renewer.join()
+            try:
+                self._write_lease(None)
+            finally:
+                _unlock_file(self._fd, self._LOCK_OFFSET)
+                os.close(self._fd)
+                self._fd = None
+        self._thread_lock.release()
+
+    def lease(self):
+        """Returns the (holder, expiry) written by the current holder, or None if the lock is free."""
+        try:
+            with open(self.path, "rb") as fh:
+                holder, expiry = fh.read(self._LOCK_OFFSET).decode().splitlines()[:2]
+            return holder, datetime.datetime.fromtimestamp(float(expiry))
+        except (OSError, ValueError):
+            return None
+
+    def _acquire_file(self, start, timeout, cancelled=None):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        attempt = 0
+        while True:
+            try:
+                _lock_file(fd, self._LOCK_OFFSET)
+                break
+            except OSError:
+                if cancelled is not None and cancelled.is_set():
+                    os.close(fd)
+                    raise DatabaseCancelledError("Cancelled waiting for {}".format(self.path))
+                elapsed = time.monotonic() - start
+                if elapsed >= timeout:
+                    os.close(fd)
+                    lease = self.lease()
+                    if lease is None:
+                        raise DatabaseTimeoutError("Timed out after {:.1f}s waiting for {}".format(elapsed,
+                                                                                                   self.path))
+                    raise DatabaseTimeoutError("Timed out after {:.1f}s waiting for {}, held by {} "
+                                               "(lease expires {:%H:%M:%S})".format(elapsed, self.path, *lease))
+                delay = min(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)),
+                            timeout - elapsed)
+                if cancelled is not None:
+                    cancelled.wait(delay)
+                else:
+                    time.sleep(delay)
+                attempt += 1
+
+        self._fd = fd
+        self._write_lease(self.uid)
+        self._stop_renewing.clear()
+        self._renewer = threading.Thread(target=self._renew, name="LeaseLock renewer", daemon=True)
+        self._renewer.start()
+
+    def _renew(self):
+        while not self._stop_renewing.wait(self.ttl / 3):
+            self._write_lease(self.uid)
+
+    def _write_lease(self, holder):
+        if holder is None:
+            record = b""
+        else:
+            record = "{}\n{}\n".format(holder, time.time() + self.ttl).encode()
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        os.write(self._fd, record)
+        os.ftruncate(self._fd, len(record))
+
 
+if msvcrt is not None:
+    def _lock_file(fd, offset):
+        os.lseek(fd, offset, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
 
-class Handle:
-    def __init__(self, uid, ttl=30):
-        self.holder = uid
-        self.expiry = datetime.datetime.now() + datetime.timedelta(seconds=ttl)
+    def _unlock_file(fd, offset):
+        os.lseek(fd, offset, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+else:
+    # flock rather than lockf, as fcntl locks are dropped when any descriptor for the file is closed.
+    def _lock_file(fd, offset):
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
 
-    def expired(self):
-        return datetime.datetime.now() > self.expiry
+    def _unlock_file(fd, offset):
+        fcntl.flock(fd, fcntl.LOCK_UN)
 
 
 def load_config(config_path="config.cfg"):
@@ -361,10 +1634,13 @@ def load_config(config_path="config.cfg"):
             globals()[v] = values[v]
         except KeyError:
             raise KeyError(v)
+    for v in OPTIONAL_CONFIG:
+        if v in values:
+            globals()[v] = values[v]
 
 
 def save_config(config_path="config.cfg"):
-    values_to_save = ["DATABASE_PATH"]
+    values_to_save = ["DATABASE_PATH"] + [v for v in OPTIONAL_CONFIG if globals()[v]]
     if not os.path.exists(config_path):
         if not os.path.exists(os.path.dirname(config_path)):
             os.makedirs(os.path.dirname(config_path))
@@ -381,8 +1657,8 @@ def save_config(config_path="config.cfg"):
             if parts[0] in values_to_save:
                 values_to_save.remove(parts[0])
                 new_lines.append("=".join([parts[0], globals()[parts[0]]]))
-        else:
-            pass
+            else:
+                new_lines.append(l)
     for v in values_to_save:
         new_lines.append("=".join([v, globals()[v]]))
     with open(config_path, "w") as fh:
@@ -390,9 +1666,164 @@ def save_config(config_path="config.cfg"):
 
 
 def create_database(path):
-    # Make tables
-    # Create default user
-    pass
+    """Creates a new database at path with the current schema, default lookups and the default user."""
+    with NewSQL(sqlite3.connect(path), None) as con:
+        migrate(con)
+
+
+def create_schema(con):
+    """Migration 1. Creates any missing tables and the indexes the hot queries use.
+    Every statement is conditional, so this also brings an existing unversioned database up to the same state.
+    :type con: NewSQL
+    """
+    for statement in SCHEMA:
+        con.run(statement)
+    con.run("INSERT OR IGNORE INTO stock_categories (category_no, category_text) VALUES (?, ?)",
+            list(enumerate(DEFAULT_CATEGORIES)))
+    con.run("INSERT OR IGNORE INTO stock_classifications (classification_id, classification_text) VALUES (?, ?)",
+            list(enumerate(DEFAULT_CLASSIFICATIONS)))
+    con.run("INSERT OR IGNORE INTO users (user_id, name, auth_level) VALUES (0, 'default', 0)")
+
+
+def create_allocation_totals(con):
+    """Migration 2. Creates the stock_allocations table, filling it from show_items if it is new,
+    along with the triggers which keep it current.
+    :type con: NewSQL
+    """
+    if con.one("SELECT name FROM sqlite_master WHERE type='table' AND name='stock_allocations'") is None:
+        con.run("CREATE TABLE stock_allocations ("
+                "sku integer not null constraint stock_allocations_pk primary key references stock_items, "
+                "allocated integer default 0 not null)")
+        con.run("INSERT INTO stock_allocations (sku, allocated) SELECT sku, SUM(quantity) FROM show_items GROUP BY sku")
+    for t in ALLOCATION_TRIGGERS:
+        con.run(t)
+
+
+def create_search_index(con):
+    """Migration 3. Creates the stock_items_fts full text index, filling it if it is new, along with the triggers
+    which keep it in step with stock_items. Returns False if this SQLite build has no FTS5, in which case
+    migrate tries again each time the database is opened, and search_items falls back to a substring search.
+    :type con: NewSQL
+    """
+    if con.one("SELECT name FROM sqlite_master WHERE type='table' AND name='stock_items_fts'") is None:
+        try:
+            con.run("CREATE VIRTUAL TABLE stock_items_fts USING fts5({}, "
+                    "content='stock_items', content_rowid='sku')".format(", ".join(SEARCH_FIELDS)))
+        except sqlite3.OperationalError:
+            return False
+        con.run("INSERT INTO stock_items_fts (stock_items_fts) VALUES ('rebuild')")
+    for t in SEARCH_INDEX_TRIGGERS:
+        con.run(t)
+    return True
+
+
+def create_change_journal(con):
+    """Migration 4. Creates the changes journal and the triggers which write to it.
+    :type con: NewSQL
+    """
+    con.run(CHANGE_JOURNAL_TABLE)
+    for t in CHANGE_JOURNAL_TRIGGERS:
+        con.run(t)
+
+
+def journal_reference_tables(con):
+    """Migration 5. Journals changes to the categories and classifications, so cached copies can be dropped.
+    :type con: NewSQL
+    """
+    for t in REFERENCE_JOURNAL_TRIGGERS:
+        con.run(t)
+
+
+def create_show_periods(con):
+    """Migration 6. Creates the show_periods interval index of the open shows, and the triggers which keep it
+    in step with shows. An R*Tree is used if this SQLite build has one, otherwise a table indexed on the ends.
+    :type con: NewSQL
+    """
+    try:
+        con.run("CREATE VIRTUAL TABLE show_periods USING rtree_i32(id, starts, ends)")
+    except sqlite3.OperationalError:
+        con.run("CREATE TABLE show_periods (id integer not null constraint show_periods_pk primary key, "
+                "starts integer not null, ends integer not null)")
+        con.run("CREATE INDEX show_periods_ends_index on show_periods (ends, starts)")
+    con.run("INSERT INTO show_periods (id, starts, ends) SELECT {} FROM shows AS NEW "
+            "WHERE NEW.complete = 0 AND NEW.date_time IS NOT NULL".format(SHOW_PERIOD_VALUES))
+    for t in SHOW_PERIOD_TRIGGERS:
+        con.run(t)
+
+
+def fill_rollups(con):
+    """Works show_rollups, and through its triggers venue_rollups, out again from scratch.
+    :type con: NewSQL
+    """
+    con.run("DELETE FROM show_rollups")
+    con.run("DELETE FROM venue_rollups")
+    con.run("INSERT INTO show_rollups (show_id, classification, {0}) "
+            "SELECT i.show_id, IFNULL(s.classification, -1), {1} FROM show_items AS i "
+            "JOIN stock_items AS s ON s.sku = i.sku JOIN shows ON shows.show_id = i.show_id "
+            "GROUP BY i.show_id, IFNULL(s.classification, -1)".format(
+                ", ".join(ROLLUP_COLUMNS), ", ".join("SUM({})".format(a) for a in rollup_amounts("s", "i.quantity"))))
+
+
+def create_rollups(con):
+    """Migration 7. Creates the show_rollups and venue_rollups totals, the triggers which keep them current,
+    and fills them.
+    :type con: NewSQL
+    """
+    for statement in ROLLUP_TABLES:
+        con.run(statement)
+    for t in ROLLUP_TRIGGERS:
+        con.run(t)
+    fill_rollups(con)
+
+
+# Ordered schema migrations. A database's PRAGMA user_version is the number of these it has had applied,
+# so new migrations must only ever be appended.
+MIGRATIONS = [create_schema,
+              create_allocation_totals,
+              create_search_index,
+              create_change_journal,
+              journal_reference_tables,
+              create_show_periods,
+              create_rollups]
+
+
+def check_schema_version(version):
+    if version > len(MIGRATIONS):
+        raise DatabaseVersionError("The database is at schema version {}, but this version of the "
+                                   "program only knows up to {}.".format(version, len(MIGRATIONS)))
+
+
+def migration_pending(con):
+    """Returns whether migrate has anything to do. Only reads, so it can be asked on a read only connection
+    without taking the handle.
+    :type con: NewSQL
+    """
+    version = con.one("PRAGMA user_version")
+    check_schema_version(version)
+    if version < len(MIGRATIONS):
+        return True
+    return (con.one("SELECT name FROM sqlite_master WHERE type='table' AND name='stock_items_fts'") is None
+            and con.one("SELECT sqlite_compileoption_used('ENABLE_FTS5') AS fts5") == 1)
+
+
+def migrate(con):
+    """Applies the migrations newer than the database's schema version, each in its own transaction
+    along with the version bump, then makes the search index if it's missing. Returns the schema version.
+    :type con: NewSQL
+    """
+    while True:
+        with con.unit_of_work():
+            # Read inside the transaction, so two processes starting at once can't both apply a migration.
+            version = con.one("PRAGMA user_version")
+            check_schema_version(version)
+            if version == len(MIGRATIONS):
+                # The search index is skipped by migration 3 on SQLite builds without FTS5, so it's made
+                # whenever the database is opened by one which has it.
+                if con.one("SELECT name FROM sqlite_master WHERE type='table' AND name='stock_items_fts'") is None:
+                    create_search_index(con)
+                return version
+            MIGRATIONS[version](con)
+            con.run("PRAGMA user_version = {}".format(version + 1))
 
 
 def hash_salt_gen(password):
@@ -408,7 +1839,23 @@ def hash_salt_gen(password):
 def init():
     if not os.path.exists(DATABASE_PATH):
         create_database(DATABASE_PATH)
-    return DatabaseHandler(DATABASE_PATH)
+    database = DatabaseHandler(DATABASE_PATH)
+    if SLOW_QUERY_LOG:
+        database.enable_instrumentation(SLOW_QUERY_LOG, float(SLOW_QUERY_SECONDS or 0.1))
+    # Only take the handle when there is a migration to apply, so opening the program doesn't queue behind
+    # another workstation's save.
+    with database.open_database_connection(read_only=True) as con:
+        pending = migration_pending(con)
+    if pending:
+        with database.open_database_connection() as con:
+            migrate(con)
+    try:
+        # Pruning can wait for the next start if someone else has the handle.
+        with database.open_database_connection(timeout=0) as con:
+            database.prune_changes(con)
+    except DatabaseTimeoutError:
+        pass
+    return database
 
 
 if __name__ == "__main__":
@@ -1,7 +1,107 @@
+import array
 import datetime
+import itertools
+import math
+
+TRUE_VALUES = ("True", 1, True)
+
+
+def db_bool(value):
+    return value in TRUE_VALUES
+
+
+def from_timestamp(value):
+    return datetime.datetime.fromtimestamp(value / 1000)
+
+
+def from_iso_date(value):
+    return datetime.date.fromisoformat(value) if value else None
+
+
+_row_builders = {}
+
+
+def row_builder(cls, columns):
+    """Returns a function which builds a cls object from a row tuple with the given column names.
+
+    The function is generated once per class and column list, with each field's slot setter and converter
+    from cls.CONVERTERS bound in, so nothing is looked up per row. Converters are only called on values
+    which aren't None, unless the field is in cls.CONVERT_NONE. Columns which aren't in cls.FIELDS are ignored,
+    and fields without a column are set to None. cls.finish_loading is called on the built object if it exists."""
+    key = (cls, tuple(columns))
+    builder = _row_builders.get(key)
+    if builder is None:
+        namespace = {"new": object.__new__, "cls": cls}
+        lines = ["def build(row):",
+                 "    obj = new(cls)"]
+        for f in cls.FIELDS:
+            namespace["set_" + f] = getattr(cls, f).__set__
+            if f not in columns:
+                lines.append("    set_{}(obj, None)".format(f))
+                continue
+            i = columns.index(f)
+            converter = cls.CONVERTERS.get(f)
+            if converter is None:
+                value = "row[{}]".format(i)
+            elif f in cls.CONVERT_NONE:
+                value = "convert_{}(row[{}])".format(f, i)
+            else:
+                value = "None if row[{0}] is None else convert_{1}(row[{0}])".format(i, f)
+            if converter is not None:
+                namespace["convert_" + f] = converter
+            lines.append("    set_{}(obj, {})".format(f, value))
+        if hasattr(cls, "finish_loading"):
+            namespace["finish"] = cls.finish_loading
+            lines.append("    finish(obj)")
+        lines.append("    return obj")
+        exec("\n".join(lines), namespace)
+        builder = _row_builders[key] = namespace["build"]
+    return builder
+
+
+def row_factory(cls, columns):
+    """Returns a sqlite3 row_factory building cls objects for a cursor with the given columns."""
+    build = row_builder(cls, columns)
+    return lambda cursor, row: build(row)
 
 
 class StockItem:
+    FIELDS = ("sku",
+              "product_id",
+              "description",
+              "category",
+              "classification",
+              "calibre",
+              "unit_cost",
+              "unit_weight",
+              "nec_weight",
+              "case_size",
+              "hse_no",
+              "ce_no",
+              "serial_no",
+              "duration",
+              "low_noise",
+              "notes",
+              "preview_link",
+              "hidden",
+              "stock_on_hand",
+              "shots")
+    __slots__ = FIELDS + ("_original", "_dirty")
+
+    CONVERTERS = {"classification": int,
+                  "calibre": int,
+                  "unit_cost": float,
+                  "unit_weight": float,
+                  "nec_weight": float,
+                  "case_size": int,
+                  "duration": float,
+                  "low_noise": db_bool,
+                  "category": int,
+                  "hidden": db_bool,
+                  "stock_on_hand": int,
+                  "shots": int}
+    CONVERT_NONE = ("low_noise", "hidden")
+
     def __init__(self,
                  sku,
                  product_id=None,
@@ -46,6 +146,9 @@ class StockItem:
             self.product_id = product_id
             self.stock_on_hand = stock_on_hand
             self.shots = shots
+            # Not loaded from the database, so every field is unsaved.
+            self.mark_clean()
+            self._dirty = set(self.FIELDS)
         else:
             record = sku
             self.sku = record.sku
@@ -60,20 +163,199 @@ class StockItem:
             self.ce_no = record.ce_no
             self.serial_no = record.serial_no
             self.duration = float(record.duration) if record.duration is not None else None
-            self.low_noise = record.low_noise in ("True", 1, True)
+            self.low_noise = db_bool(record.low_noise)
             self.notes = record.notes
             self.preview_link = record.preview_link
             self.category = int(record.category) if record.category is not None else None
-            self.hidden = record.hidden in ("True", 1, True)
+            self.hidden = db_bool(record.hidden)
             self.product_id = record.product_id
             self.stock_on_hand = int(record.stock_on_hand) if record.stock_on_hand is not None else None
             self.shots = int(record.shots) if record.shots is not None else None
+            self.mark_clean()
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        original = getattr(self, "_original", None)
+        if original is not None and name in original:
+            if self.same_value(original[name], value):
+                self._dirty.discard(name)
+            else:
+                self._dirty.add(name)
 
     def __repr__(self):
         return "sku: {}, desc: {}".format(self.sku, self.description)
 
+    def __getstate__(self):
+        return {s: getattr(self, s) for s in self.__slots__}
+
+    def __setstate__(self, state):
+        for s in self.__slots__:
+            object.__setattr__(self, s, state[s])
+
+    def copy(self):
+        """Returns an independent copy, with the same saved values and dirty fields."""
+        new = object.__new__(StockItem)
+        for f in self.FIELDS:
+            object.__setattr__(new, f, getattr(self, f))
+        object.__setattr__(new, "_original", dict(self._original))
+        object.__setattr__(new, "_dirty", set(self._dirty))
+        return new
+
+    def mark_clean(self):
+        """Takes the current values as the saved ones, e.g. after loading or saving the item."""
+        object.__setattr__(self, "_original", {f: getattr(self, f) for f in self.FIELDS})
+        object.__setattr__(self, "_dirty", set())
+
+    finish_loading = mark_clean
+
+    def is_dirty(self):
+        return len(self._dirty) > 0
+
+    def dirty_fields(self):
+        """Returns the fields changed since the item was loaded or last marked clean, in FIELDS order."""
+        return [f for f in self.FIELDS if f in self._dirty]
+
+    @staticmethod
+    def same_value(old, new):
+        # A control holding 0 or "" for a field with no value isn't a change.
+        return old == new or (old is None and new in (0, ""))
+
+
+
+def stock_table_columns(category_text, classification_text):
+    """The stock list's columns, as header: (attribute, formatter, width).
+    category_text and classification_text map an id to its name."""
+    return {"SKU": ("sku", lambda x: str(x).zfill(6), 50),
+            "Product ID": ("product_id", lambda x: x, 70),
+            "Description": ("description", lambda x: x.replace("\n", " "), 250),
+            "Category": ("category", category_text, 70),
+            "Classification": ("classification", classification_text, 85),
+            "Unit Cost": ("unit_cost", lambda x: "£{:.2f}".format(x), 65),
+            "Unit Weight": ("unit_weight", lambda x: "{:.2f}kg".format(x), 80),
+            "NEC Weight": ("nec_weight", lambda x: "{:.2f}kg".format(x), 80),
+            "Calibre": ("calibre", lambda x: "{}mm".format(x), 75),
+            "Duration": ("duration", lambda x: "{}s".format(x), 60),
+            "Low Noise": ("low_noise", lambda x: "Yes" if x else "No", 70)}
+
+
+
+class StockCatalog:
+    """A column oriented copy of a list of StockItems, for filtering without touching each item.
+
+    Numeric fields are held in arrays of doubles, with NaN for None, and integer id fields such as category
+    in arrays of ints, with NONE_CODE for None. Text is left to the search index.
+    Filters return masks of one byte per row, which are built, combined and applied in single C level passes.
+    Given a start position, they only cover the rows from there on, for filtering rows as they are added."""
+
+    NUMERIC_FIELDS = ("calibre", "unit_cost", "unit_weight", "nec_weight", "case_size", "duration",
+                      "stock_on_hand", "shots")
+    CODE_FIELDS = ("category", "classification", "low_noise", "hidden")
+    NONE_CODE = -1  # Ids are list indices, so never negative.
+
+    def __init__(self, items=()):
+        self.items = []
+        self.skus = array.array("q")
+        self.numeric = {f: array.array("d") for f in self.NUMERIC_FIELDS}
+        self.codes = {f: array.array("i") for f in self.CODE_FIELDS}
+        self.extend(items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def extend(self, items):
+        for item in items:
+            self.items.append(item)
+            self.skus.append(int(item.sku))
+            for f in self.NUMERIC_FIELDS:
+                self.numeric[f].append(self._number(getattr(item, f)))
+            for f in self.CODE_FIELDS:
+                self.codes[f].append(self._code(getattr(item, f)))
+
+    def replace(self, position, item):
+        self.items[position] = item
+        self.skus[position] = int(item.sku)
+        for f in self.NUMERIC_FIELDS:
+            self.numeric[f][position] = self._number(getattr(item, f))
+        for f in self.CODE_FIELDS:
+            self.codes[f][position] = self._code(getattr(item, f))
+
+    def code_mask(self, field, allowed, start=0):
+        """Returns a mask of the rows whose code field is one of the allowed values, which may include None."""
+        allowed = {self._code(a) for a in allowed}
+        return bytearray(map(allowed.__contains__, self._rows(self.codes[field], start)))
+
+    def range_mask(self, field, low=None, high=None, start=0):
+        """Returns a mask of the rows whose numeric field is between low and high inclusive, either of which may be
+        None for no bound. Rows with None for the field are never in range."""
+        column = self._rows(self.numeric[field], start)
+        masks = [bytearray(map(float(low).__le__, column)) if low is not None else self._present(column)]
+        if high is not None:
+            masks.append(bytearray(map(float(high).__ge__, column)))
+        return self.all_of(*masks)
+
+    def total(self, field, mask=None, start=0):
+        """Returns the sum of the numeric field over the rows in the mask, or all of them, skipping None."""
+        column = self._rows(self.numeric[field], start)
+        present = self._present(column)
+        return math.fsum(itertools.compress(column, present if mask is None else self.all_of(present, mask)))
+
+    def position_mask(self, positions, start=0):
+        mask = bytearray(len(self.items) - start)
+        for p in positions:
+            if p >= start:
+                mask[p - start] = 1
+        return mask
+
+    def all_mask(self):
+        return bytearray(b"\x01" * len(self.items))
+
+    @staticmethod
+    def all_of(*masks):
+        """Combines masks of equal length, keeping the rows set in all of them."""
+        combined = int.from_bytes(masks[0], "little")
+        for m in masks[1:]:
+            combined &= int.from_bytes(m, "little")
+        return bytearray(combined.to_bytes(len(masks[0]), "little"))
+
+    @staticmethod
+    def positions(mask):
+        return list(itertools.compress(range(len(mask)), mask))
+
+    def select(self, mask):
+        return list(itertools.compress(self.items, mask))
+
+    @staticmethod
+    def _rows(column, start):
+        return column[start:] if start else column
+
+    @staticmethod
+    def _number(value):
+        return float("nan") if value is None else float(value)
+
+    @classmethod
+    def _code(cls, value):
+        return cls.NONE_CODE if value is None else int(value)
+
+    @staticmethod
+    def _present(column):
+        # NaN, standing in for None, is the only value not equal to itself.
+        return bytearray(map(float.__eq__, column, column))
+
 
 class Show:
+    FIELDS = ("show_id",
+              "show_title",
+              "show_description",
+              "supervisor",
+              "date_time",
+              "complete",
+              "venue")
+    __slots__ = FIELDS + ("items", "changes")
+
+    CONVERTERS = {"date_time": from_timestamp,
+                  "complete": bool}
+    CONVERT_NONE = ()
+
     def __init__(self,
                  show_id,
                  show_title="",
@@ -95,13 +377,36 @@ class Show:
         self.complete = complete
         self.venue = venue
 
+    def finish_loading(self):
+        self.items = []
+        self.changes = []
+
     def add_change_log(self, date_time, user_id, action_text):
         self.changes.append({'date_time': date_time,
                              'user_id': user_id,
                              'action_text': action_text})
 
 
+class ShowSummary:
+    """The columns of a show listed on the launcher, without its items or changes."""
+    FIELDS = ("show_id",
+              "show_title",
+              "show_description",
+              "date_time")
+    __slots__ = FIELDS
+
+    CONVERTERS = {"date_time": from_timestamp}
+    CONVERT_NONE = ()
+
+
 class ShowChange:
+    FIELDS = ("date_time",
+              "text")
+    __slots__ = FIELDS
+
+    CONVERTERS = {"date_time": from_timestamp}
+    CONVERT_NONE = ()
+
     def __init__(self,
                  date_time,
                  text):
@@ -109,7 +414,81 @@ class ShowChange:
         self.text = text
 
 
+class Rollup:
+    """The totals of the stock booked onto a show, or onto every show at a venue on a day, for one classification.
+    classification is None for items without one. Fields the rollup isn't keyed on are None."""
+    FIELDS = ("show_id",
+              "venue",
+              "day",
+              "classification",
+              "quantity",
+              "nec_weight",
+              "cost",
+              "shots",
+              "duration")
+    __slots__ = FIELDS
+
+    CONVERTERS = {"day": from_iso_date,
+                  "classification": lambda x: None if x == -1 else x}
+    CONVERT_NONE = ()
+
+    def __repr__(self):
+        return "Rollup: {} - {} {} - Class {} - {:.2f}kg NEC".format(self.show_id, self.venue, self.day,
+                                                                     self.classification, self.nec_weight)
+
+
+class ChangeSet:
+    """The rows changed after a sequence number in the changes journal, with each row's last operation.
+    seq is the newest change included, to pass back next time. If reload is True, changes after the
+    requested sequence number have been pruned, so the client must reload everything instead."""
+    __slots__ = ("seq", "changed", "deleted", "reload")
+
+    def __init__(self, seq, reload=False):
+        self.seq = seq
+        self.changed = {}  # table name: set of row ids inserted or updated.
+        self.deleted = {}  # table name: set of row ids deleted.
+        self.reload = reload
+
+    def add(self, table, row_id, operation):
+        if operation == "delete":
+            self.changed.get(table, set()).discard(row_id)
+            self.deleted.setdefault(table, set()).add(row_id)
+        else:
+            self.deleted.get(table, set()).discard(row_id)
+            self.changed.setdefault(table, set()).add(row_id)
+
+    def changed_ids(self, table):
+        return self.changed.get(table, set())
+
+    def deleted_ids(self, table):
+        return self.deleted.get(table, set())
+
+    def show_ids(self):
+        """Returns the ids of the shows changed directly or through their items, and not deleted."""
+        ids = set(self.changed_ids("shows"))
+        ids.update(show_id for show_id, sku in self.changed_ids("show_items") | self.deleted_ids("show_items"))
+        return ids - self.deleted_ids("shows")
+
+    def is_empty(self):
+        return not self.reload and not any(self.changed.values()) and not any(self.deleted.values())
+
+    def __repr__(self):
+        return "ChangeSet: seq {} - Changed: {} - Deleted: {}".format(self.seq,
+                                                                      {t: len(i) for t, i in self.changed.items()},
+                                                                      {t: len(i) for t, i in self.deleted.items()})
+
+
 class User:
+    FIELDS = ("user_id",
+              "name",
+              "auth_level")
+    __slots__ = FIELDS
+
+    CONVERTERS = {"user_id": int,
+                  "name": str,
+                  "auth_level": int}
+    CONVERT_NONE = ()
+
     def __init__(self,
                  user_id,
                  name=None,
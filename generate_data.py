@@ -0,0 +1,146 @@
+import argparse
+import datetime
+import os
+import random
+import re
+import time
+import database_io
+import stock_import
+
+SHOW_WORDS = ("Bonfire Night", "New Year", "Wedding", "Festival", "Fireworks Spectacular", "Gala", "Birthday",
+              "Diwali", "Corporate Event", "Charity Night", "Summer Fair", "Proms")
+VENUES = ("Castle Park", "Town Hall", "Racecourse", "Cricket Club", "Manor House", "Harbour", "Showground",
+          "Football Ground", "Country Club", "Beach")
+DEFAULT_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dict_stock.json")
+CHANGE_TEXTS = ("Added items to the show.", "Removed items from the show.", "Changed quantities.",
+                "Updated the description.", "Moved the show time.", "Changed the supervisor.",
+                "Marked the show as complete.")
+
+
+class StockDistributions:
+    """The values seen in a stock item file, such as dict_stock.json, for drawing realistic synthetic items."""
+
+    def __init__(self, path=DEFAULT_SOURCE):
+        self.values = {}
+        self.words = []
+        self.prefixes = []
+        for record in stock_import.read_records(path):
+            for field, value in record.items():
+                if value is not None and value != "":
+                    self.values.setdefault(field, []).append(value)
+            if record.get("description"):
+                self.words.extend(w for w in re.split(r"\s+", record["description"]) if w.isalpha())
+            if record.get("product_id"):
+                self.prefixes.append(re.match(r"[A-Za-z-]*", record["product_id"]).group().rstrip("-") or "P")
+
+    def choice(self, rng, field, default=None):
+        values = self.values.get(field)
+        return rng.choice(values) if values else default
+
+    def number(self, rng, field, default=None, spread=0.25):
+        """Draws an observed value of a numeric field and scales it by up to spread either way."""
+        value = self.choice(rng, field)
+        if value is None:
+            return default
+        return value * rng.uniform(1 - spread, 1 + spread)
+
+    def item(self, rng, n):
+        """Returns a synthetic stock item record, in the form stock_import reads."""
+        nec_weight = round(self.number(rng, "nec_weight", 1.0), 2)
+        calibre = self.choice(rng, "calibre")
+        return {"product_id": "{}-{}".format(rng.choice(self.prefixes or ["P"]), n),
+                "description": " ".join(rng.choice(self.words) for _ in range(rng.randint(2, 8))),
+                "category": self.choice(rng, "category"),
+                "classification": self.choice(rng, "classification"),
+                "calibre": calibre,
+                # The source file has no costs or weights, so they're derived from the explosive content.
+                "unit_cost": round(self.number(rng, "unit_cost", nec_weight * rng.uniform(8, 20)), 2),
+                "unit_weight": round(self.number(rng, "unit_weight", nec_weight * rng.uniform(2, 4)), 2),
+                "nec_weight": nec_weight,
+                "case_size": self.choice(rng, "case_size", rng.choice((1, 6, 12, 24, 36))),
+                "hse_no": self.choice(rng, "hse_no"),
+                "duration": self.choice(rng, "duration"),
+                "low_noise": self.choice(rng, "low_noise", False),
+                "hidden": rng.random() < 0.05,
+                "stock_on_hand": int(self.number(rng, "stock_on_hand", 100, spread=0.9)),
+                "shots": self.choice(rng, "shots")}
+
+
+def generate_database(path,
+                      items=1000,
+                      shows=100,
+                      items_per_show=20,
+                      changes_per_show=5,
+                      users=10,
+                      seed=0,
+                      source=DEFAULT_SOURCE):
+    """Creates a database at path filled with synthetic stock, shows and users drawn from the source file.
+    The same seed always gives the same data. Returns the DatabaseHandler for it.
+    """
+    if os.path.exists(path):
+        raise FileExistsError(path)
+    rng = random.Random(seed)
+    distributions = StockDistributions(source)
+    database_io.create_database(path)
+    database = database_io.DatabaseHandler(path)
+
+    with database.unit_of_work() as con:
+        stock_import.import_items(con, (distributions.item(rng, n) for n in range(items)), batch_size=5000)
+
+        pass_hash, pass_salt = database_io.hash_salt_gen("password")
+        con.run("INSERT INTO users (name, auth_level, pass_hash, pass_salt) VALUES (?, ?, ?, ?)",
+                [("user{}".format(n), rng.choice((1, 2, 2, 2)), pass_hash, pass_salt) for n in range(users)])
+        user_names = ["user{}".format(n) for n in range(users)] or ["default"]
+
+        skus = con.all("SELECT sku FROM stock_items")
+        now = time.time()
+        show_rows = []
+        for n in range(shows):
+            # Spread over the two years either side of now, with the past ones mostly complete.
+            date_time = now + rng.uniform(-2, 2) * 365 * 24 * 3600
+            show_rows.append((n + 1,
+                              "{} {}".format(rng.choice(SHOW_WORDS), datetime.date.fromtimestamp(date_time).year),
+                              "Synthetic show {}".format(n + 1),
+                              rng.choice(user_names),
+                              int(date_time * 1000),
+                              date_time < now and rng.random() < 0.9,
+                              rng.choice(VENUES)))
+        con.run("INSERT INTO shows (show_id, show_title, show_description, supervisor, date_time, complete, venue) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", show_rows)
+
+        show_items = []
+        changes = []
+        for show_id, _, _, _, date_time, _, _ in show_rows:
+            for sku in rng.sample(skus, min(len(skus), rng.randint(items_per_show // 2, items_per_show * 3 // 2))):
+                show_items.append((show_id, sku, rng.randint(1, 12)))
+            for c in range(rng.randint(0, changes_per_show * 2)):
+                changes.append((show_id,
+                                date_time - int(rng.uniform(1, 60) * 24 * 3600 * 1000),
+                                rng.choice(CHANGE_TEXTS)))
+        changes.sort(key=lambda c: c[1])
+        if show_items:
+            con.run("INSERT INTO show_items (show_id, sku, quantity) VALUES (?, ?, ?)", show_items)
+        if changes:
+            con.run("INSERT INTO show_changes (show_id, date_time, text) VALUES (?, ?, ?)", changes)
+
+    with database.open_database_connection() as con:
+        con.run("ANALYZE")
+        con.commit()
+    return database
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds a database of synthetic stock, shows and users.")
+    parser.add_argument("path")
+    parser.add_argument("--items", type=int, default=1000)
+    parser.add_argument("--shows", type=int, default=100)
+    parser.add_argument("--items-per-show", type=int, default=20)
+    parser.add_argument("--changes-per-show", type=int, default=5)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--source", default=DEFAULT_SOURCE)
+    args = parser.parse_args()
+    start = time.monotonic()
+    generate_database(args.path, args.items, args.shows, args.items_per_show, args.changes_per_show, args.users,
+                      args.seed, args.source)
+    print("Created {} in {:.2f}s.".format(args.path, time.monotonic() - start))
@@ -1,4 +1,9 @@
+import concurrent.futures
+import datetime
+import functools
 import re
+import sqlite3
+import threading
 import database_io
 import wx
 import webbrowser
@@ -7,7 +12,7 @@ from custom_globals import *
 from wx.richtext import RichTextCtrl
 from wx.lib import sized_controls
 from copy import deepcopy
-from database_structs import StockItem
+from database_structs import StockItem, StockCatalog, stock_table_columns
 
 
 class Launcher(wx.Frame):
@@ -38,7 +43,14 @@ class Launcher(wx.Frame):
                     return
                 database_io.save_config(CONFIG_PATH)
 
-        self.database = database_io.init()
+        try:
+            self.database = database_io.init()
+        except (database_io.DatabaseTimeoutError, database_io.DatabaseVersionError, sqlite3.Error) as e:
+            # Only a pending migration waits for the handle, so this is another workstation mid-save or
+            # a database from a newer version.
+            show_database_error(None, e)
+            self.Destroy()
+            return
 
         panel = wx.Panel(self, -1)
 
@@ -110,71 +122,49 @@ class Launcher(wx.Frame):
         self.Bind(wx.EVT_BUTTON, self.user_button_clicked, self.user_button)
 
         # TODO: #### DELETE THIS ####
-        with self.database.open_database_connection() as con:
-            self.database.validate_user(con, "louis", "password", True)
-            self.login()
+        DatabaseCall(self, self.database, self.database.validate_user, "louis", "password", True,
+                     done=lambda valid: self.login())
 
         self.Show()
 
     def update_upcoming(self):
-        with self.database.open_database_connection() as con:
-            shows = self.database.get_shows(con)
-
+        # Open shows from the start of today, so any on today are still listed after they've begun.
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        DatabaseCall(self, self.database, self.database.get_upcoming_shows, UPCOMING_SHOWS, today, read_only=True,
+                     busy=False, done=self.show_upcoming)
+
+    def show_upcoming(self, shows):
+        """Writes the shows into upcoming_text in one pass, with each part's style set as it's written.
+        :type shows: list[database_structs.ShowSummary]
+        """
+        text = self.upcoming_text
+        text.Freeze()
+        text.BeginSuppressUndo()
+        text.Clear()
         if len(shows) == 0:
-            text = "No Upcoming Shows"
-            self.upcoming_text.SetValue(text)
-            bold_style = wx.TextAttr()
-            bold_style.SetFontWeight(wx.FONTWEIGHT_BOLD)
-            self.upcoming_text.SetStyle(0, len(text) - 1, bold_style)
-        else:
-            text = ""
-            underlines = []
-            headers = []
-            bodies = []
-            for s in shows:
-                underline = [len(text), 0]
-                text += "{:%d/%m/%Y %H:%M}".format(s.date_time) + "\n"
-                underline[1] = len(text) - 1
-
-                header = [len(text), 0]
-                text += s.show_title + "\n"
-                header[1] = len(text) - 1
-
-                body = [len(text), 0]
-                text += s.show_description
-                body[1] = len(text) - 1
-
-                text += "\n\n"
-
-                underlines.append(underline)
-                headers.append(header)
-                bodies.append(body)
-
-            self.upcoming_text.SetValue(text)
-
-            for i, u in enumerate(underlines):
-                new_style = wx.TextAttr()
-                new_style.SetFontUnderlined(True)
-                new_style.SetURL(str(shows[i].show_id))
-                self.upcoming_text.SetStyle(u[0],
-                                            u[1],
-                                            new_style)
-
-            head_style = wx.TextAttr()
-            head_style.SetFontWeight(wx.FONTWEIGHT_BOLD)
-
-            for h in headers:
-                self.upcoming_text.SetStyle(h[0],
-                                            h[1],
-                                            head_style)
-
-            body_style = wx.TextAttr()
-            body_style.SetFontStyle(wx.FONTSTYLE_ITALIC)
-
-            for b in bodies:
-                self.upcoming_text.SetStyle(b[0],
-                                            b[1],
-                                            body_style)
+            text.BeginBold()
+            text.WriteText("No Upcoming Shows")
+            text.EndBold()
+        for s in shows:
+            text.BeginURL(str(s.show_id))
+            text.BeginUnderline()
+            text.WriteText("{:%d/%m/%Y %H:%M}".format(s.date_time))
+            text.EndUnderline()
+            text.EndURL()
+            text.Newline()
+
+            text.BeginBold()
+            text.WriteText(s.show_title or "")
+            text.EndBold()
+            text.Newline()
+
+            text.BeginItalic()
+            text.WriteText(s.show_description or "")
+            text.EndItalic()
+            text.Newline()
+            text.Newline()
+        text.EndSuppressUndo()
+        text.Thaw()
 
     def event_clicked(self, e):
         self.view_show(int(e.String))
@@ -229,23 +219,24 @@ class Launcher(wx.Frame):
 
             credentials = input_dlg.GetValues()
 
-            with self.database.open_database_connection() as con:
-                valid = self.database.validate_user(con, credentials[0], credentials[1], True)
-
-            if valid:
-                print("Valid")
-            else:
-                print("Invalid")
-                dlg = wx.MessageDialog(self, "Login Failed\n\n"
-                                             "Invalid credentials.",
-                                       style=wx.OK | wx.ICON_EXCLAMATION,
-                                       caption="Login Failed")
-                dlg.ShowModal()
-                return
-            self.login()
+            DatabaseCall(self, self.database, self.database.validate_user, credentials[0], credentials[1], True,
+                         message="Checking your login...", done=self.login_checked)
         else:
             self.logout()
 
+    def login_checked(self, valid):
+        if valid:
+            print("Valid")
+        else:
+            print("Invalid")
+            dlg = wx.MessageDialog(self, "Login Failed\n\n"
+                                         "Invalid credentials.",
+                                   style=wx.OK | wx.ICON_EXCLAMATION,
+                                   caption="Login Failed")
+            dlg.ShowModal()
+            return
+        self.login()
+
     def login(self):
         assert self.database.signed_in_user() is not None
         if self.database.signed_in_user().auth_level <= 1:
@@ -324,6 +315,7 @@ class Launcher(wx.Frame):
             v.Destroy()
         for v in self.show_viewers:
             v.Destroy()
+        self.database.executor.shutdown(wait=False)
         if e is not None:
             e.Skip()
 
@@ -342,42 +334,38 @@ class StockList(wx.Frame):
 
         controls_panel = wx.Panel(self, -1)
 
-        with self.database.open_database_connection() as con:
-            self.categories = self.database.get_categories(con)
-            self.classifications = self.database.get_classifications(con)
-            self.categories_select = wx.CheckListBox(controls_panel,
-                                                     wx.ID_ANY,
-                                                     size=(200, 100),
-                                                     choices=self.database.get_categories(con))
-
-            self.classifications_select = wx.CheckListBox(controls_panel,
-                                                          wx.ID_ANY,
-                                                          size=(200, 75),
-                                                          choices=self.database.get_classifications(con))
-            self.stock_items = self.database.get_all_items(con)
-        self.filtered_item_flags = [True for i in range(len(self.stock_items))]
+        # Filled in by reference_loaded.
+        self.categories = []
+        self.classifications = []
+        self.categories_select = wx.CheckListBox(controls_panel,
+                                                 wx.ID_ANY,
+                                                 size=(200, 100),
+                                                 choices=self.categories)
+
+        self.classifications_select = wx.CheckListBox(controls_panel,
+                                                      wx.ID_ANY,
+                                                      size=(200, 75),
+                                                      choices=self.classifications)
+        # The catalog is filled a page at a time by load_catalog, on a worker thread.
+        self.catalog = StockCatalog()
+        self.synced_seq = None
+        self.loading = False
+        self._load_cancelled = threading.Event()
+        self.filter_mask = self.catalog.all_mask()
+        self.units_shown = 0.0
+        self.text_matches = None  # Positions of the items matching the search box, None if it is empty.
+        # The text of the last search and the skus the search index matched for it, so rows loaded afterwards can
+        # be matched without searching again.
+        self.searched = None
+        self._search_skus = None, set()  # Set by search_items on the worker, for search_finished to pick up.
+        self.search_filter = BackgroundFilter(self, self.search_items, self.search_finished)
 
         # Setup ListCtrl
-        self.stock_list = wx.ListCtrl(self,
-                                      size=(-1, -1),
-                                      style=wx.LC_REPORT | wx.LC_HRULES)
-
-        self.table_headers = {"SKU": ("sku", lambda x: str(x).zfill(6), 50),
-                              "Product ID": ("product_id", lambda x: x, 70),
-                              "Description": ("description", lambda x: x.replace("\n", " "), 250),
-                              "Category": ("category", lambda x: self.categories[x], 70),
-                              "Classification": ("classification", lambda x: self.classifications[x], 85),
-                              "Unit Cost": ("unit_cost", lambda x: "£{:.2f}".format(x), 65),
-                              "Unit Weight": ("unit_weight", lambda x: "{:.2f}kg".format(x), 80),
-                              "NEC Weight": ("nec_weight", lambda x: "{:.2f}kg".format(x), 80),
-                              "Calibre": ("calibre", lambda x: "{}mm".format(x), 75),
-                              "Duration": ("duration", lambda x: "{}s".format(x), 60),
-                              "Low Noise": ("low_noise", lambda x: "Yes" if x else "No", 70)}
+        # Looked up on each call, as the lists are replaced when they are reloaded.
+        self.table_headers = stock_table_columns(lambda x: self.categories[x], lambda x: self.classifications[x])
         self.column_to_expand = 2
 
-        for i, h in enumerate(self.table_headers.keys()):
-            self.stock_list.InsertColumn(i, h)
-            self.stock_list.SetColumnWidth(i, self.table_headers[h][2])
+        self.stock_list = VirtualList(self, self.table_headers, self.catalog.items)
 
         # Create and populate the controls area.
         controls_sizer = wx.BoxSizer(wx.VERTICAL)
@@ -455,8 +443,28 @@ class StockList(wx.Frame):
         controls_sizer.Add(self.show_hidden_box, 0, wx.LEFT | wx.RIGHT, padding)
 
         controls_sizer.AddSpacer(padding)
+        self.in_stock_box = wx.CheckBox(controls_panel,
+                                        wx.ID_ANY,
+                                        label="Only items in stock.")
+        controls_sizer.Add(self.in_stock_box, 0, wx.LEFT | wx.RIGHT, padding)
+
+        controls_sizer.AddSpacer(padding * 2)
+        self.summary_label = wx.StaticText(controls_panel,
+                                           wx.ID_ANY,
+                                           label="")
+        controls_sizer.Add(self.summary_label, 0, wx.LEFT | wx.RIGHT, padding)
+
+        controls_sizer.AddSpacer(padding)
+
+        self.load_label = wx.StaticText(controls_panel,
+                                        wx.ID_ANY,
+                                        label="Loading items...")
+        controls_sizer.Add(self.load_label, 0, wx.LEFT | wx.RIGHT, padding)
+        self.load_gauge = wx.Gauge(controls_panel, wx.ID_ANY, range=1, size=(200, 15))
+        controls_sizer.Add(self.load_gauge, 0, wx.LEFT | wx.RIGHT | wx.BOTTOM, padding)
 
         controls_panel.SetSizerAndFit(controls_sizer)
+        self.controls_panel = controls_panel
 
         # Add things to the main sizer, and assign it to a main panel.
         main_sizer = wx.BoxSizer(wx.HORIZONTAL)
@@ -488,46 +496,148 @@ class StockList(wx.Frame):
         self.Bind(wx.EVT_SIZING, self.update_table_size)
         self.Bind(wx.EVT_LIST_ITEM_ACTIVATED, self.edit_button_clicked, self.stock_list)
         self.Bind(wx.EVT_CHECKBOX, self.apply_filters, self.show_hidden_box)
-        self.Bind(wx.EVT_TEXT, self.apply_filters, self.search_box)
+        self.Bind(wx.EVT_CHECKBOX, self.apply_filters, self.in_stock_box)
+        self.Bind(wx.EVT_TEXT, self.search_changed, self.search_box)
+        self.Bind(wx.EVT_TEXT_ENTER, self.search_changed, self.search_box)
 
         self.apply_filters()
         self.update_table_size(None)
 
+        DatabaseCall(self, self.database, self.load_reference, read_only=True, busy=False,
+                     done=self.reference_loaded)
+
+    def load_reference(self, con):
+        return self.database.get_categories(con), self.database.get_classifications(con)
+
+    def reference_loaded(self, reference):
+        self.categories, self.classifications = reference
+        self.categories_select.Set(self.categories)
+        self.classifications_select.Set(self.classifications)
+        self.select_all_categories(None)
+        self.select_all_classifications(None)
+        # The items are only loaded now, as formatting them needs the category and classification names.
+        self.start_loading()
+
+    def start_loading(self):
+        """Empties the list and starts filling it from the database in the background."""
+        self._load_cancelled.set()
+        self._load_cancelled = threading.Event()
+        self.loading = True
+        self.search_filter.cancel()
+        self.catalog = StockCatalog()
+        self.filter_mask = self.catalog.all_mask()
+        self.units_shown = 0.0
+        # Positions from an earlier load mean nothing now, so any search is rerun once the load finishes.
+        if self.text_matches is not None:
+            self.text_matches = set()
+        self.search_filter.forget()
+        self.stock_list.set_rows([])
+        self.load_label.SetLabel("Loading items...")
+        self.load_label.Show()
+        self.load_gauge.SetValue(0)
+        self.load_gauge.Show()
+        self.controls_panel.Layout()
+        DatabaseCall(self, self.database, self.load_catalog, self._load_cancelled, read_only=True, busy=False)
+
+    def load_catalog(self, con, cancelled, page_size=500):
+        """Runs on a database worker, passing the stock items to the window a page at a time."""
+        # Read before the items, so changes made during the load are picked up by the next sync.
+        synced_seq = self.database.latest_change(con)
+        total = con.one("SELECT COUNT(*) FROM stock_items")
+        page = []
+        for item in self.database.get_items_by_category(con, page_size=page_size):
+            if cancelled.is_set():
+                return
+            page.append(item)
+            if len(page) == page_size:
+                wx.CallAfter(self.page_loaded, page, total, None, cancelled)
+                page = []
+        if not cancelled.is_set():
+            wx.CallAfter(self.page_loaded, page, total, synced_seq, cancelled)
+
+    def page_loaded(self, items, total, synced_seq, cancelled):
+        """Adds a page of items from load_catalog, which gives synced_seq with the last page only."""
+        if not self or cancelled.is_set():
+            return
+        start = len(self.catalog)
+        self.catalog.extend(items)
+        self.stock_list.append_rows(items)
+        if self.text_matches is not None and self.searched is not None:
+            self.text_matches.update(self.match_positions(*self.searched, range(start, len(self.catalog))))
+            self.search_filter.forget()
+        # Only the new page is filtered, as the rows before it are unchanged.
+        mask = self.filter_rows(start)
+        self.filter_mask += mask
+        self.stock_list.append_index(start + p for p in self.catalog.positions(mask))
+        self.units_shown += self.catalog.total("stock_on_hand", mask, start)
+        self.update_summary()
+        self.load_gauge.SetRange(max(total, len(self.catalog), 1))
+        self.load_gauge.SetValue(len(self.catalog))
+        self.load_label.SetLabel("Loading items... {} of {}".format(len(self.catalog), total))
+        if synced_seq is not None:
+            self.synced_seq = synced_seq
+            self.loading = False
+            self.load_label.Hide()
+            self.load_gauge.Hide()
+            self.controls_panel.Layout()
+            # Rows which arrived during a search haven't been searched yet, and a search started before the load
+            # was cancelled by it.
+            if self.search_box.GetValue().strip() != "":
+                self.search_filter.forget()
+                self.search_filter.request(self.search_box.GetValue().strip().lower(), immediate=True)
+
     def create_button_clicked(self, e=None):
         self.parent.add_item_viewer(None)
 
     def edit_button_clicked(self, e=None):
         if self.stock_list.GetFirstSelected() == -1:
             return
-        sku = self.stock_list.GetItem(self.stock_list.GetFirstSelected(), 0).GetText()
+        sku = self.stock_list.get_object(self.stock_list.GetFirstSelected()).sku
         self.parent.add_item_viewer(sku)
 
+    def search_changed(self, e):
+        self.search_filter.request(self.search_box.GetValue().strip().lower(),
+                                   immediate=e.GetEventType() == wx.wxEVT_TEXT_ENTER)
+
+    def search_items(self, text_filter, candidates, cancelled):
+        """Runs on the filter's worker thread, returning the positions of the candidates matching the text."""
+        skus = set(self.database.executor.submit(self.database.search_items, text_filter, None,
+                                                 read_only=True).result())
+        self._search_skus = text_filter, skus
+        if candidates is None:
+            candidates = range(len(self.catalog))
+        return self.match_positions(text_filter, skus, candidates, cancelled)
+
+    def match_positions(self, text_filter, skus, positions, cancelled=None):
+        """Returns the positions whose item is in skus or has the text in its SKU, or None if cancelled."""
+        matches = []
+        for n, i in enumerate(positions):
+            if n % 1000 == 0 and cancelled is not None and cancelled.is_set():
+                return None
+            sku = self.catalog.skus[i]
+            if sku in skus or text_filter in str(sku).zfill(6):
+                matches.append(i)
+        return matches
+
+    def search_finished(self, text_filter, matches):
+        self.text_matches = None if matches is None else set(matches)
+        self.searched = self._search_skus if matches is not None and self._search_skus[0] == text_filter else None
+        self.apply_filters()
+
+    def filter_rows(self, start=0):
+        """Returns the mask of the rows from start on which pass the search or the filter boxes."""
+        if self.text_matches is not None:
+            return self.catalog.position_mask(self.text_matches, start)
+        masks = [self.catalog.code_mask("category", self.categories_select.GetCheckedItems(), start),
+                 self.catalog.code_mask("classification", self.classifications_select.GetCheckedItems(), start)]
+        if not self.show_hidden_box.GetValue():
+            masks.append(self.catalog.code_mask("hidden", (False, None), start))
+        if self.in_stock_box.GetValue():
+            masks.append(self.catalog.range_mask("stock_on_hand", 1, start=start))
+        return self.catalog.all_of(*masks)
+
     def apply_filters(self, e=None):
-        fields_to_text_filter = [("sku", lambda x: str(x).zfill(6)),
-                                 ("description", lambda x: x.lower()),
-                                 ("hse_no", lambda x: x.lower() if x is not None else ""),
-                                 ("ce_no", lambda x: x.lower() if x is not None else ""),
-                                 ("serial_no", lambda x: x.lower() if x is not None else ""),
-                                 ("notes", lambda x: x.lower() if x is not None else ""),
-                                 ("product_id", lambda x: x.lower() if x is not None else "")]
-        text_filter = self.search_box.GetValue().strip().lower()
-        search = re.compile(text_filter, re.MULTILINE)
-        for i, s in enumerate(self.stock_items):
-            show = True
-            if text_filter is not "":
-                show = False
-                for f in fields_to_text_filter:
-                    val = f[1](getattr(s, f[0]))
-                    if search.search(val) is not None:
-                        show = True
-                        break
-            elif s.category not in self.categories_select.GetCheckedItems():
-                show = False
-            elif s.classification not in self.classifications_select.GetCheckedItems():
-                show = False
-            elif s.hidden and not self.show_hidden_box.GetValue():
-                show = False
-            self.filtered_item_flags[i] = show
+        self.filter_mask = self.filter_rows()
         self.populate_table()
 
     def category_filter_highlight(self, e):
@@ -557,12 +667,53 @@ class StockList(wx.Frame):
         self.apply_filters()
 
     def populate_table(self, e=None):
-        self.stock_list.DeleteAllItems()
-        for i, s in enumerate(self.stock_items):
-            if self.filtered_item_flags[i]:
-                self.stock_list.Append(["" if getattr(s, self.table_headers[h][0]) is None else
-                                        self.table_headers[h][1](getattr(s, self.table_headers[h][0]))
-                                        for h in self.table_headers])
+        self.stock_list.set_index(self.catalog.positions(self.filter_mask))
+        self.units_shown = self.catalog.total("stock_on_hand", self.filter_mask)
+        self.update_summary()
+
+    def update_summary(self):
+        self.summary_label.SetLabel("{} items shown, {:,.0f} units in stock".format(len(self.stock_list.index),
+                                                                                   self.units_shown))
+
+    def sync(self):
+        """Brings the list up to date with the items changed since it was loaded or last synced."""
+        if self.loading:
+            return
+        DatabaseCall(self, self.database, self.fetch_changes, self.synced_seq, read_only=True, busy=False,
+                     done=self.apply_changes)
+
+    def fetch_changes(self, con, synced_seq):
+        """Runs on a database worker, returning the changes and the changed items, or None if a reload is needed."""
+        changes = self.database.changes_since(con, synced_seq)
+        if changes.reload or changes.deleted_ids("stock_items"):
+            return changes, None
+        return changes, self.database.get_items(con, changes.changed_ids("stock_items"))
+
+    def apply_changes(self, result):
+        changes, changed = result
+        if self.loading or changes.is_empty():
+            return
+        if changed is None:
+            self.start_loading()
+            return
+        self.synced_seq = changes.seq
+
+        positions = {sku: p for p, sku in enumerate(self.catalog.skus)}
+        replaced = {}
+        added = []
+        for item in changed:
+            if item.sku in positions:
+                replaced[positions[item.sku]] = item
+                self.catalog.replace(positions[item.sku], item)
+            else:
+                added.append(item)
+        self.catalog.extend(added)
+        self.stock_list.replace_rows(replaced)
+        self.stock_list.append_rows(added)
+        self.apply_filters()
+        if self.text_matches is not None:
+            self.search_filter.forget()
+            self.search_filter.request(self.search_box.GetValue().strip().lower(), immediate=True)
 
     def update_table_size(self, e=None):
         list_size = self.stock_list.GetSize()
@@ -575,19 +726,20 @@ class StockList(wx.Frame):
     def on_close(self, e=None):
         self.parent.purge_viewers()
 
+        self._load_cancelled.set()
         self.open = False
         if e is not None:
             e.Skip()
 
     def Refresh(self, eraseBackground=True, rect=None):
-        self.populate_table()
+        self.sync()
         super().Refresh(eraseBackground, rect)
 
 
 class ItemViewer(wx.Frame):
     def __init__(self, parent, frame_id, title, database: database_io.DatabaseHandler, sku):
         if title is None:
-            self.title = TITLE + " - Stock Viewer - {}".format(sku)
+            self.title = TITLE + " - Stock Viewer - {}".format(str(sku).zfill(6))
         else:
             self.title = title
         super().__init__(parent,
@@ -604,11 +756,12 @@ class ItemViewer(wx.Frame):
         self.item = None
         self.live_item = None
 
-        with self.database.open_database_connection() as con:
-            category_choices = con.all("SELECT category_text FROM stock_categories") + [""]
-            classification_choices = con.all("SELECT classification_text FROM stock_classifications") + [""]
+        # The choices are filled in by item_loaded.
+        category_choices = [""]
+        classification_choices = [""]
 
         panel = wx.Panel(self)
+        self.panel = panel
 
         self.required_fields = ["description",
                                 "category",
@@ -809,14 +962,18 @@ class ItemViewer(wx.Frame):
             dlg.ShowModal()
             return
 
-        with self.database.open_database_connection() as con:
-            if self.sku_val is None:
-                self.sku_val = self.database.add_item(con, self.live_item)
-            else:
-                self.database.update_item(con, self.live_item)
+        # The worker saves a copy, as it marks the item clean and this one could be edited meanwhile.
+        if self.sku_val is None:
+            DatabaseCall(self, self.database, self.database.add_item, self.live_item.copy(),
+                         message="Saving item...", done=self.item_saved)
+        else:
+            DatabaseCall(self, self.database, self.database.update_item, self.live_item.copy(),
+                         message="Saving item...", done=self.item_saved)
 
+    def item_saved(self, new_sku):
+        if self.sku_val is None:
+            self.sku_val = new_sku
         self.refresh_information()
-        self.check_for_changes()
 
     def check_for_changes(self, e=None):
         if e is not None:
@@ -828,16 +985,13 @@ class ItemViewer(wx.Frame):
                 value = bool(event_obj.GetSelection())
             else:
                 value = event_obj.GetValue()
+            if self.live_item is None:
+                return
             self.live_item.__setattr__(attr, value)
 
-        for k in self.item.__dict__.keys():
-            old = self.item.__dict__[k]
-            new = self.live_item.__dict__[k]
-            if old != new and not (old is None and new in (0, "")):
-                self.unsaved_changes = True
-                break
-        else:
-            self.unsaved_changes = False
+        if self.live_item is None:
+            return
+        self.unsaved_changes = self.live_item.is_dirty()
 
         if self.unsaved_changes:
             self.save_button.Enable()
@@ -852,12 +1006,28 @@ class ItemViewer(wx.Frame):
         webbrowser.open_new(self.preview_link.GetValue().strip())
 
     def refresh_information(self, e=None):
-        if self.sku_val is not None:
-            with self.database.open_database_connection() as con:
-                self.item = self.database.get_item(con, self.sku_val)
-                self.available.SetLabelText("  " + str(self.database.get_stock_levels(con, self.sku_val)[1]))
+        DatabaseCall(self, self.database, self.load_item, self.sku_val, read_only=True, done=self.item_loaded)
+
+    def load_item(self, con, sku):
+        """Runs on a database worker, returning the choices, the item and its stock available from now on,
+        net of the open shows which haven't finished with theirs."""
+        reference = self.database.get_categories(con), self.database.get_classifications(con)
+        if sku is None:
+            return reference, None, None
+        window = datetime.datetime.now(), None
+        return reference, self.database.get_item(con, sku), self.database.get_stock_levels(con, sku, window)[1]
+
+    def item_loaded(self, result):
+        (categories, classifications), self.item, available = result
+        for control, choices in ((self.category, categories), (self.classification, classifications)):
+            if control.GetCount() != len(choices) + 1:
+                control.Set(choices + [""])
+        self.panel.Layout()
 
-            if self.item is None:
+        if self.sku_val is not None:
+            if self.item is not None:
+                self.available.SetLabelText("  " + str(available))
+            else:
                 dlg = wx.MessageDialog(self, "Database Lookup Error\n\n"
                                              "Failed to find item {} in the database.".format(self.sku_val),
                                        style=wx.OK | wx.ICON_EXCLAMATION,
@@ -867,6 +1037,7 @@ class ItemViewer(wx.Frame):
                 return
         else:
             self.item = StockItem("generated")
+            self.item.mark_clean()
 
         self.live_item = deepcopy(self.item)
 
@@ -903,6 +1074,7 @@ class ItemViewer(wx.Frame):
                     elif type(c) in (wx.SpinCtrl, wx.SpinCtrlDouble):
                         val = 0
                 c.SetValue(val)
+        self.check_for_changes()
 
     def on_close(self, e=None):
         if self.unsaved_changes:
@@ -1047,12 +1219,16 @@ class ControlPanel(wx.Frame):
                 self.delete_user_button.Enable()
                 self.change_privilege_button.Enable()
 
+    @staticmethod
+    def load_user_names(con):
+        return con.all("SELECT name FROM users")
+
+    @database_action
     def add_new_user(self, e=None):
         if not self.validate_user():
             return
 
-        with self.database.open_database_connection() as con:
-            taken = con.all("SELECT name FROM users")
+        taken = DatabaseCall(self, self.database, self.load_user_names, read_only=True).wait()
 
         dlg = NewUserDialog(self, title=self.title + " - New User", taken=taken)
         resp = dlg.ShowModal()
@@ -1061,16 +1237,14 @@ class ControlPanel(wx.Frame):
 
         username, password, auth_level = dlg.GetValues()
 
-        with self.database.open_database_connection() as con:
-            self.database.create_user(con, username, password, auth_level)
-
-        self.refresh_user_list()
+        DatabaseCall(self, self.database, self.database.create_user, username, password, auth_level,
+                     done=self.refresh_user_list)
 
+    @database_action
     def change_username(self, e=None):
         if not self.validate_user():
             return
-        with self.database.open_database_connection() as con:
-            taken = con.all("SELECT name FROM users")
+        taken = DatabaseCall(self, self.database, self.load_user_names, read_only=True).wait()
         dlg = wx.TextEntryDialog(self,
                                  "Change username:",
                                  TITLE + " - Change Username",
@@ -1087,15 +1261,16 @@ class ControlPanel(wx.Frame):
         else:
             pass
         if error is False:
-            with self.database.open_database_connection() as con:
-                self.database.change_username(con, self.users[self.user_list.GetFirstSelected()].user_id, new_username)
+            DatabaseCall(self, self.database, self.database.change_username,
+                         self.users[self.user_list.GetFirstSelected()].user_id, new_username,
+                         done=self.refresh_user_list)
         else:
             dlg = wx.MessageDialog(self, "Invalid Username\n\n"
                                          "{}.".format(error),
                                    style=wx.OK | wx.ICON_EXCLAMATION,
                                    caption=TITLE + " - Invalid Username")
             dlg.ShowModal()
-        self.refresh_user_list()
+            self.refresh_user_list()
 
     def reset_password(self, e=None):
         if not self.validate_user():
@@ -1110,8 +1285,7 @@ class ControlPanel(wx.Frame):
         new_password = dlg.GetValue()
         assert new_password != ""
 
-        with self.database.open_database_connection() as con:
-            self.database.set_user_password(con, selected_user.user_id, new_password)
+        DatabaseCall(self, self.database, self.database.set_user_password, selected_user.user_id, new_password)
 
     def change_privilege(self, e=None):
         if not self.validate_user():
@@ -1126,9 +1300,8 @@ class ControlPanel(wx.Frame):
             return
         new_auth = dlg.GetSelection() + 1
         assert new_auth in range(1, len(AUTH_LEVELS))
-        with self.database.open_database_connection() as con:
-            self.database.change_auth_level(con, selected_user.user_id, new_auth)
-        self.refresh_user_list()
+        DatabaseCall(self, self.database, self.database.change_auth_level, selected_user.user_id, new_auth,
+                     done=self.refresh_user_list)
 
     # @is_user_validated
     def delete_user(self, e=None):
@@ -1144,9 +1317,8 @@ class ControlPanel(wx.Frame):
         resp = dlg.ShowModal()
         if resp != wx.ID_YES:
             return
-        with self.database.open_database_connection() as con:
-            self.database.delete_user(con, selected_user.user_id)
-        self.refresh_user_list()
+        DatabaseCall(self, self.database, self.database.delete_user, selected_user.user_id,
+                     done=self.refresh_user_list)
 
     def on_close(self, e=None):
         self.open = False
@@ -1154,10 +1326,11 @@ class ControlPanel(wx.Frame):
             e.Skip()
 
     def refresh_user_list(self, e=None):
-        self.user_list.DeleteAllItems()
+        DatabaseCall(self, self.database, self.database.get_users, read_only=True, done=self.users_loaded)
 
-        with self.database.open_database_connection() as con:
-            self.users = self.database.get_users(con)
+    def users_loaded(self, users):
+        self.user_list.DeleteAllItems()
+        self.users = users
 
         for u in self.users:
             if u.user_id == 0:
@@ -1169,6 +1342,7 @@ class ControlPanel(wx.Frame):
                 [u.name.title() + (" (you)" if self.database.signed_in_user().user_id == u.user_id else ""),
                  AUTH_LEVELS[u.auth_level]])
 
+    @database_action
     def validate_user(self):
         dlg = wx.PasswordEntryDialog(self,
                                      "Enter password for {} to continue:".format(
@@ -1179,8 +1353,8 @@ class ControlPanel(wx.Frame):
         if resp != wx.ID_OK:
             return False
 
-        with self.database.open_database_connection() as con:
-            valid = self.database.validate_user(con, self.database.signed_in_user().user_id, dlg.GetValue())
+        valid = DatabaseCall(self, self.database, self.database.validate_user, self.database.signed_in_user().user_id,
+                             dlg.GetValue(), message="Checking your password...").wait()
 
         if valid:
             return True
@@ -1208,15 +1382,14 @@ class ShowsList(wx.Frame):
 
         controls_panel = wx.Panel(self, -1)
 
-        with self.database.open_database_connection() as con:
-            self.shows = self.database.get_shows(con, False)
+        # Filled in by shows_loaded.
+        self.synced_seq = None
+        self.shows = []
         self.filter_flags = [True] * len(self.shows)
+        self.text_matches = None  # Positions of the shows matching the search box, None if it is empty.
+        self.search_filter = BackgroundFilter(self, self.search_shows, self.search_finished, self.search_refines)
 
         # Setup ListCtrl
-        self.shows_list = wx.ListCtrl(self,
-                                      size=(-1, -1),
-                                      style=wx.LC_REPORT | wx.LC_HRULES)
-
         self.table_headers = {"Show ID": ("show_id", lambda x: str(x).zfill(6), 60),
                               "Title": ("show_title", lambda x: x, 250),
                               "Supervisor": ("supervisor", lambda x: x, 70),
@@ -1224,9 +1397,7 @@ class ShowsList(wx.Frame):
                               }
         self.column_to_expand = 2
 
-        for i, h in enumerate(self.table_headers.keys()):
-            self.shows_list.InsertColumn(i, h)
-            self.shows_list.SetColumnWidth(i, self.table_headers[h][2])
+        self.shows_list = VirtualList(self, self.table_headers, self.shows)
 
         # Create and populate the controls area.
         controls_sizer = wx.BoxSizer(wx.VERTICAL)
@@ -1277,7 +1448,8 @@ class ShowsList(wx.Frame):
 
         # Bindings
         self.Bind(wx.EVT_CLOSE, self.on_close)
-        self.Bind(wx.EVT_TEXT, self.apply_filters, self.search_box)
+        self.Bind(wx.EVT_TEXT, self.search_changed, self.search_box)
+        self.Bind(wx.EVT_TEXT_ENTER, self.search_changed, self.search_box)
         self.Bind(wx.EVT_CHECKBOX, self.apply_filters, self.show_complete_box)
         self.Bind(wx.EVT_BUTTON, self.view_show, self.edit_button)
         self.Bind(wx.EVT_LIST_ITEM_ACTIVATED, self.view_show, self.shows_list)
@@ -1286,41 +1458,122 @@ class ShowsList(wx.Frame):
         self.populate_table()
         self.apply_filters()
         self.update_table_size(None)
+        DatabaseCall(self, self.database, self.load_shows, read_only=True, busy=False, done=self.shows_loaded)
 
     def view_show(self, e=None):
         if self.shows_list.GetFirstSelected() == -1:
             return
-        show_id = self.shows_list.GetItem(self.shows_list.GetFirstSelected(), 0).GetText()
-        self.parent.view_show(int(show_id))
+        show_id = self.shows_list.get_object(self.shows_list.GetFirstSelected()).show_id
+        self.parent.view_show(show_id)
 
-    def apply_filters(self, e=None):
+    def search_changed(self, e):
+        self.search_filter.request(self.search_box.GetValue().strip().lower(),
+                                   immediate=e.GetEventType() == wx.wxEVT_TEXT_ENTER)
+
+    @staticmethod
+    def search_refines(old_filter, new_filter):
+        # Only a plain text filter which extends the last one is sure to match a subset of it.
+        return new_filter.startswith(old_filter) and re.search(r"[.^$*+?{}\[\]\\|()]", new_filter) is None
+
+    def search_shows(self, text_filter, candidates, cancelled):
+        """Runs on the filter's worker thread, returning the positions of the candidates matching the text."""
         fields_to_text_filter = [("show_id", lambda x: str(x).zfill(6)),
-                                 ("show_title", lambda x: x.lower()),
+                                 ("show_title", lambda x: x.lower() if x is not None else ""),
                                  ("show_description", lambda x: x.lower() if x is not None else ""),
                                  ("supervisor", lambda x: x.lower() if x is not None else "")]
-        text_filter = self.search_box.GetValue().strip().lower()
-        search = re.compile(text_filter, re.MULTILINE)
+        try:
+            search = re.compile(text_filter, re.MULTILINE)
+        except re.error:
+            search = re.compile(re.escape(text_filter), re.MULTILINE)
+        if candidates is None:
+            candidates = range(len(self.shows))
+        matches = []
+        for n, i in enumerate(candidates):
+            if n % 1000 == 0 and cancelled.is_set():
+                return None
+            s = self.shows[i]
+            for f in fields_to_text_filter:
+                if search.search(f[1](getattr(s, f[0]))) is not None:
+                    matches.append(i)
+                    break
+        return matches
+
+    def search_finished(self, text_filter, matches):
+        self.text_matches = None if matches is None else set(matches)
+        self.apply_filters()
+
+    def apply_filters(self, e=None):
         for i, s in enumerate(self.shows):
             show = True
-            if text_filter is not "":
-                show = False
-                for f in fields_to_text_filter:
-                    val = f[1](getattr(s, f[0]))
-                    if search.search(val) is not None:
-                        show = True
-                        break
+            if self.text_matches is not None:
+                show = i in self.text_matches
             elif s.complete and not self.show_complete_box.GetValue():
                 show = False
             self.filter_flags[i] = show
         self.populate_table()
 
     def populate_table(self, e=None):
-        self.shows_list.DeleteAllItems()
-        for i, s in enumerate(self.shows):
-            if self.filter_flags[i]:
-                self.shows_list.Append(["" if getattr(s, self.table_headers[h][0]) is None else
-                                        self.table_headers[h][1](getattr(s, self.table_headers[h][0]))
-                                        for h in self.table_headers])
+        self.shows_list.set_index([i for i, f in enumerate(self.filter_flags) if f])
+
+    def load_shows(self, con):
+        """Runs on a database worker, returning the journal sequence number the shows were loaded at, and them."""
+        return self.database.latest_change(con), self.database.get_shows(con, False)
+
+    def shows_loaded(self, result):
+        self.search_filter.cancel()
+        self.synced_seq, self.shows = result
+        self.filter_flags = [True] * len(self.shows)
+        # Positions from before the load mean nothing now, so any search is rerun.
+        searching = self.text_matches is not None
+        self.text_matches = None
+        self.shows_list.set_rows(self.shows)
+        self.apply_filters()
+        if searching:
+            self.search_filter.forget()
+            self.search_filter.request(self.search_box.GetValue().strip().lower(), immediate=True)
+
+    def sync(self):
+        """Brings the list up to date with the shows changed since it was loaded or last synced."""
+        if self.synced_seq is None:
+            return
+        DatabaseCall(self, self.database, self.fetch_changes, self.synced_seq, read_only=True, busy=False,
+                     done=self.apply_changes)
+
+    def fetch_changes(self, con, synced_seq):
+        """Runs on a database worker, returning the changes and either the changed shows, or all of them when
+        the list has to be reloaded.
+        """
+        changes = self.database.changes_since(con, synced_seq)
+        if changes.reload or changes.deleted_ids("shows"):
+            return changes, None, self.load_shows(con)
+        return changes, self.database.get_shows_by_id(con, changes.show_ids()), None
+
+    def apply_changes(self, result):
+        changes, changed, reloaded = result
+        if changes.is_empty():
+            return
+        if reloaded is not None:
+            self.shows_loaded(reloaded)
+            return
+        self.synced_seq = changes.seq
+
+        positions = {s.show_id: p for p, s in enumerate(self.shows)}
+        replaced = {}
+        added = []
+        for show in changed:
+            if show.show_id in positions:
+                replaced[positions[show.show_id]] = show
+                self.shows[positions[show.show_id]] = show
+            else:
+                added.append(show)
+        self.shows.extend(added)
+        self.filter_flags = [True] * len(self.shows)
+        self.shows_list.replace_rows(replaced)
+        self.shows_list.append_rows(added)
+        self.apply_filters()
+        if self.text_matches is not None:
+            self.search_filter.forget()
+            self.search_filter.request(self.search_box.GetValue().strip().lower(), immediate=True)
 
     def update_table_size(self, e=None):
         list_size = self.shows_list.GetSize()
@@ -1336,7 +1589,7 @@ class ShowsList(wx.Frame):
             e.Skip()
 
     def Refresh(self, eraseBackground=True, rect=None):
-        self.populate_table()
+        self.sync()
         super().Refresh(eraseBackground, rect)
 
 
@@ -1355,10 +1608,10 @@ class ShowViewer(wx.Frame):
 
         controls_panel = wx.Panel(self, -1)
 
-        with self.database.open_database_connection() as con:
-            self.categories = self.database.get_categories(con)
-            self.classifications = self.database.get_classifications(con)
-            self.show_items = self.database.get_show_items(con, self.show_id)
+        # Filled in by show_loaded.
+        self.categories = []
+        self.classifications = []
+        self.show_items = []
 
         # Setup ListCtrl
         self.stock_list = wx.ListCtrl(self,
@@ -1397,6 +1650,16 @@ class ShowViewer(wx.Frame):
         self.Bind(wx.EVT_LIST_ITEM_ACTIVATED, self.item_clicked, self.stock_list)
 
         self.populate_table()
+        DatabaseCall(self, self.database, self.load_show, self.show_id, read_only=True, done=self.show_loaded)
+
+    def load_show(self, con, show_id):
+        return (self.database.get_categories(con),
+                self.database.get_classifications(con),
+                self.database.get_show_items(con, show_id))
+
+    def show_loaded(self, result):
+        self.categories, self.classifications, self.show_items = result
+        self.populate_table()
 
     def item_clicked(self, e=None):
         if self.stock_list.GetFirstSelected() == -1:
@@ -1430,6 +1693,278 @@ class ShowItemViewer(wx.Frame):
     pass
 
 
+class VirtualList(wx.ListCtrl):
+    """A virtual report list, which only formats the rows that are on screen.
+
+    columns is a dict of header: (attribute, formatter, width), as used for table_headers.
+    The rows shown, and their order, are set by an index of positions into rows, so filtering only
+    swaps the index. Each row's formatted cells are cached until invalidated."""
+
+    def __init__(self, parent, columns, rows=(), size=(-1, -1)):
+        super().__init__(parent,
+                         size=size,
+                         style=wx.LC_REPORT | wx.LC_HRULES | wx.LC_VIRTUAL)
+        self.columns = columns
+        self.rows = list(rows)
+        self.index = []
+        self._cell_cache = {}
+
+        for i, h in enumerate(self.columns.keys()):
+            self.InsertColumn(i, h)
+            self.SetColumnWidth(i, self.columns[h][2])
+
+    def set_rows(self, rows, index=None):
+        self.rows = list(rows)
+        self._cell_cache.clear()
+        self.set_index(range(len(self.rows)) if index is None else index)
+
+    def append_rows(self, rows):
+        """Adds rows after the existing ones, which keep their positions and cached cells."""
+        self.rows.extend(rows)
+
+    def replace_rows(self, rows):
+        """Takes a dict of position: row, and swaps those rows in, dropping only their cached cells."""
+        for p, row in rows.items():
+            self.rows[p] = row
+        self.invalidate(rows.keys())
+
+    def set_index(self, index):
+        self.index = list(index)
+        self.SetItemCount(len(self.index))
+        self.Refresh()
+
+    def append_index(self, positions):
+        """Shows more rows after the ones already shown."""
+        self.index.extend(positions)
+        self.SetItemCount(len(self.index))
+        self.Refresh()
+
+    def invalidate(self, positions=None):
+        """Drops the cached cells for the given row positions, or for every row."""
+        if positions is None:
+            self._cell_cache.clear()
+        else:
+            for p in positions:
+                self._cell_cache.pop(p, None)
+        self.Refresh()
+
+    def get_object(self, item):
+        return self.rows[self.index[item]]
+
+    def format_row(self, row):
+        cells = []
+        for attribute, formatter, width in self.columns.values():
+            value = getattr(row, attribute)
+            cells.append("" if value is None else formatter(value))
+        return cells
+
+    def OnGetItemText(self, item, column):
+        position = self.index[item]
+        cells = self._cell_cache.get(position)
+        if cells is None:
+            cells = self._cell_cache[position] = self.format_row(self.rows[position])
+        return cells[column]
+
+
+class DatabaseCall:
+    """Runs work(con, *args) on the database executor, so the UI thread never waits on the handle itself.
+
+    Used asynchronously, done(result) is called on the UI thread when it finishes, unless the window has been
+    closed, and failed(exception) if it raises, which by default shows the error. If busy is set and the call
+    takes longer than busy_delay ms, a busy dialog is shown whose Cancel button gives up waiting for the handle.
+    wait() is for the few handlers which need a result before they can carry on, such as a password check before
+    a dialog. It shows the busy dialog straight away and keeps the UI running until the result is ready."""
+
+    def __init__(self, window, database, work, *args, read_only=False, done=None, failed=None, busy=True,
+                 message="Waiting for the database...", busy_delay=500):
+        """
+        :type database: database_io.DatabaseHandler
+        """
+        self.window = window
+        self.database = database
+        self.done = done
+        self.failed = failed if failed is not None else lambda e: show_database_error(window, e)
+        self.message = message
+        self.busy_delay = busy_delay
+        self._waiting = False
+        self._dialog = None
+
+        self.task = database.executor.submit(work, *args, read_only=read_only)
+        self.task.add_done_callback(lambda task: wx.CallAfter(self._finished))
+        if busy:
+            wx.CallLater(busy_delay, self._show_busy)
+
+    def cancel(self):
+        self.task.cancel()
+
+    def wait(self):
+        """Returns the result, or raises the call's exception, or DatabaseCancelledError if it was cancelled."""
+        self._waiting = True
+        dialog = self._busy_dialog()
+        try:
+            while True:
+                try:
+                    return self.task.result(0.05)
+                except concurrent.futures.TimeoutError:
+                    # Pulse runs the event loop, so the UI is never left waiting on the task.
+                    if not dialog.Pulse(self._busy_message())[0]:
+                        self.cancel()
+        finally:
+            dialog.Destroy()
+
+    def _show_busy(self):
+        if self._waiting or self.task.done() or not self.window:
+            return
+        self._dialog = self._busy_dialog()
+        self._pulse()
+
+    def _pulse(self):
+        if self._dialog is None:
+            return
+        if not self._dialog.Pulse(self._busy_message())[0]:
+            self.cancel()
+        wx.CallLater(100, self._pulse)
+
+    def _busy_dialog(self):
+        return wx.ProgressDialog(TITLE + " - Busy",
+                                 self._busy_message(),
+                                 parent=self.window if self.window else None,
+                                 style=wx.PD_APP_MODAL | wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME)
+
+    def _busy_message(self):
+        lease = self.database.lock.lease()
+        if lease is None or lease[0] == self.database.uid:
+            return self.message
+        return "{}\nThe database is in use by {}.".format(self.message, lease[0])
+
+    def _finished(self):
+        if self._dialog is not None:
+            self._dialog.Destroy()
+            self._dialog = None
+        if self._waiting or not self.window:
+            return
+        try:
+            result = self.task.result()
+        except database_io.DatabaseCancelledError:
+            return
+        except Exception as e:
+            self.failed(e)
+            return
+        if self.done is not None:
+            self.done(result)
+
+
+def show_database_error(window, error):
+    dlg = wx.MessageDialog(window if window else None,
+                           "Database Error\n\n{}".format(error),
+                           style=wx.OK | wx.ICON_EXCLAMATION,
+                           caption=TITLE + " - Database Error")
+    dlg.ShowModal()
+
+
+def database_action(handler):
+    """Wraps an event handler which waits on the database with DatabaseCall.wait(), so that cancelling the wait
+    abandons the action and database errors are shown instead of raised."""
+    @functools.wraps(handler)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return handler(self, *args, **kwargs)
+        except database_io.DatabaseCancelledError:
+            return None
+        except (database_io.DatabaseTimeoutError, sqlite3.Error) as e:
+            show_database_error(self, e)
+            return None
+    return wrapper
+
+
+class BackgroundFilter:
+    """Runs a window's text filter after a pause in typing, on a worker thread.
+
+    scan(text, candidates, cancelled) is called on the worker with the row positions to test, or None for all
+    of them, and returns the positions which match, or None if cancelled was set part way through.
+    done(text, matches) is then called on the UI thread, with None for matches if the text is empty.
+    A newer request cancels any scan still running. When refines(old, new) says the new text can only match
+    a subset of the last completed one, only the last matches are rescanned.
+    If the scan raises, failed(exception) is called on the UI thread instead, which by default shows database
+    errors and re-raises anything else. An exception from a scan which was cancelled is ignored, as the rows
+    may have been swapped out from under it."""
+
+    def __init__(self, window, scan, done, refines=None, delay=250, failed=None):
+        self.window = window
+        self.scan = scan
+        self.done = done
+        self.failed = failed if failed is not None else self._report
+        self.refines = refines if refines is not None else lambda old, new: new.startswith(old)
+        self.delay = delay
+
+        self._timer = None
+        self._generation = 0
+        self._cancelled = threading.Event()
+        self._last_text = None
+        self._last_matches = None
+
+    def request(self, text, immediate=False):
+        if self._timer is not None and self._timer.IsRunning():
+            self._timer.Stop()
+        if immediate:
+            self.start(text)
+        else:
+            self._timer = wx.CallLater(self.delay, self.start, text)
+
+    def forget(self):
+        """Drops the last matches, for when the rows have changed, so the next scan covers all of them."""
+        self._last_text = None
+        self._last_matches = None
+
+    def cancel(self):
+        """Stops any scan still running, and drops its result. Call it before swapping out the rows scanned."""
+        self._cancelled.set()
+        self._generation += 1
+
+    def start(self, text):
+        self.cancel()
+        if text == "":
+            self._finish(self._generation, text, None)
+            return
+
+        candidates = None
+        if self._last_text is not None and self._last_matches is not None and self.refines(self._last_text, text):
+            candidates = self._last_matches
+        self._cancelled = threading.Event()
+        threading.Thread(target=self._run,
+                         args=(self._generation, text, candidates, self._cancelled),
+                         daemon=True).start()
+
+    def _run(self, generation, text, candidates, cancelled):
+        try:
+            matches = self.scan(text, candidates, cancelled)
+        except Exception as e:
+            if not cancelled.is_set():
+                wx.CallAfter(self._failed, generation, e)
+            return
+        if not cancelled.is_set() and matches is not None:
+            wx.CallAfter(self._finish, generation, text, matches)
+
+    def _finish(self, generation, text, matches):
+        if generation != self._generation or not self.window:
+            return
+        self._last_text = text
+        self._last_matches = matches
+        self.done(text, matches)
+
+    def _failed(self, generation, exception):
+        if generation != self._generation or not self.window:
+            return
+        self.forget()
+        self.failed(exception)
+
+    def _report(self, exception):
+        if isinstance(exception, (database_io.DatabaseTimeoutError, sqlite3.Error)):
+            show_database_error(self.window, exception)
+        else:
+            raise exception
+
+
 class LoginDialog(sized_controls.SizedDialog):
     def __init__(self, *args, **kwargs):
         super(LoginDialog, self).__init__(*args, **kwargs)
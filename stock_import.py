@@ -0,0 +1,403 @@
+import csv
+import json
+import os
+import re
+import sys
+import time
+import database_io
+from custom_globals import *
+
+ITEM_COLUMNS = ("product_id",
+                "description",
+                "category",
+                "classification",
+                "calibre",
+                "unit_cost",
+                "unit_weight",
+                "nec_weight",
+                "case_size",
+                "hse_no",
+                "ce_no",
+                "serial_no",
+                "duration",
+                "low_noise",
+                "notes",
+                "preview_link",
+                "hidden",
+                "stock_on_hand",
+                "shots")
+
+ITEM_DEFAULTS = {"hidden": False,
+                 "stock_on_hand": 0}
+# What must follow a value in an array for it to be complete.
+JSON_DELIMITER = re.compile(r"\s*[,\]]")
+
+
+def read_json_records(path, chunk_size=65536):
+    """Yields the objects in a file holding a JSON array, such as dict_stock.json, one at a time,
+    without reading the whole file into memory."""
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as fh:
+        buffer = ""
+        eof = False
+        while buffer == "" and not eof:
+            chunk = fh.read(chunk_size)
+            eof = chunk == ""
+            buffer = chunk.lstrip()
+        if not buffer.startswith("["):
+            raise ValueError("{} does not hold a JSON array.".format(path))
+        buffer = buffer[1:]
+        while True:
+            buffer = buffer.lstrip().lstrip(",").lstrip()
+            if buffer.startswith("]"):
+                return
+            try:
+                if buffer == "":
+                    raise json.JSONDecodeError("Expecting value", buffer, 0)
+                record, end = decoder.raw_decode(buffer)
+                # A value is only complete once the delimiter after it has been read. Until then a number,
+                # such as 12 read from 12345, may carry on in the next chunk.
+                if JSON_DELIMITER.match(buffer, end) is None:
+                    raise json.JSONDecodeError("Expecting ',' delimiter", buffer, end)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = fh.read(chunk_size)
+                eof = chunk == ""
+                buffer += chunk
+                continue
+            yield record
+            buffer = buffer[end:]
+
+
+def read_csv_records(path):
+    """Yields the rows of a spreadsheet exported as CSV, with a header row of stock_items column names."""
+    with open(path, "r", encoding="utf-8-sig", newline="") as fh:
+        for row in csv.DictReader(fh):
+            yield {k: (v if v != "" else None) for k, v in row.items()}
+
+
+def read_records(path):
+    if os.path.splitext(path)[1].lower() == ".csv":
+        return read_csv_records(path)
+    return read_json_records(path)
+
+
+def get_lookups(con):
+    """Returns dicts mapping lower case category and classification text to their ids.
+    Classifications are also keyed by their number, as "Cat" 4 is stored as CAT4.
+    :type con: database_io.NewSQL
+    """
+    categories = {r.category_text.lower(): r.category_no
+                  for r in con.all("SELECT category_no, category_text FROM stock_categories")}
+    classifications = {}
+    for r in con.all("SELECT classification_id, classification_text FROM stock_classifications"):
+        classifications[r.classification_text.lower()] = r.classification_id
+        number = re.fullmatch(r"cat\s*(\d+)", r.classification_text.lower())
+        if number is not None:
+            classifications[number.group(1)] = r.classification_id
+    return categories, classifications
+
+
+def record_to_row(record, categories, classifications):
+    """Maps a record of field: value to a tuple of values in ITEM_COLUMNS order."""
+    values = normalize_record(record, categories, classifications)
+    return tuple(values[c] if values.get(c) is not None else ITEM_DEFAULTS.get(c) for c in ITEM_COLUMNS)
+
+
+def normalize_record(record, categories, classifications):
+    """Returns the stock_items columns in a record, with category and classification text mapped to ids
+    and boolean text mapped to bools."""
+    values = {}
+    for c in ITEM_COLUMNS:
+        if c not in record:
+            continue
+        value = record[c]
+        if value is None:
+            pass
+        elif c == "category":
+            value = lookup_id(categories, value, c)
+        elif c == "classification":
+            value = lookup_id(classifications, value, c)
+        elif c in ("low_noise", "hidden") and type(value) is str:
+            value = parse_bool(value)
+        values[c] = value
+    return values
+
+
+def lookup_id(table, value, field):
+    try:
+        return table[str(value).strip().lower()]
+    except KeyError:
+        raise ValueError("Unknown {} '{}'.".format(field, value))
+
+
+def import_items(con, records, batch_size=1000, progress=None, progress_interval=1000):
+    """Inserts stock item records in one transaction, batched through executemany.
+    Calls progress(rows, rows_per_second) every progress_interval rows and at the end.
+    Returns the number of rows and the seconds taken.
+    :type con: database_io.NewSQL
+    """
+    q = "INSERT INTO stock_items ({}) VALUES ({})".format(", ".join(ITEM_COLUMNS),
+                                                          ", ".join("?" * len(ITEM_COLUMNS)))
+    categories, classifications = get_lookups(con)
+    start = time.monotonic()
+    count = 0
+    batch = []
+
+    def report():
+        if progress is not None:
+            progress(count, count / max(time.monotonic() - start, 1e-9))
+
+    with con.unit_of_work():
+        for record in records:
+            batch.append(record_to_row(record, categories, classifications))
+            if len(batch) == batch_size:
+                con.run(q, batch)
+                batch = []
+            count += 1
+            if count % progress_interval == 0:
+                report()
+        if len(batch) > 0:
+            con.run(q, batch)
+
+    report()
+    return count, time.monotonic() - start
+
+
+def parse_text(value):
+    value = str(value).strip()
+    return value if value != "" else None
+
+
+def parse_number(value):
+    """Reads the number out of a cell such as "50mm", "£1,200.50" or "0.3"."""
+    if type(value) in (int, float):
+        return value
+    match = re.search(r"-?\d[\d,]*(\.\d+)?|-?\.\d+", str(value))
+    if match is None:
+        return None
+    return float(match.group(0).replace(",", ""))
+
+
+def parse_int(value):
+    number = parse_number(value)
+    return int(number) if number is not None else None
+
+
+def parse_bool(value):
+    value = str(value).strip().lower()
+    if value in ("yes", "y", "true", "1"):
+        return True
+    if value in ("no", "n", "false", "0"):
+        return False
+    return None
+
+
+# Spreadsheet headers, matched case insensitively, and the column and parser for each.
+# nec_weight is the NEC of a single unit, like unit_cost and unit_weight, so it's read from NEC per Unit.
+# NEC Total is only read to recognise items whose nec_weight was imported as the total, see diff_records.
+# Stock Available is a derived figure, and there is no column for Hazard Type, so they're skipped.
+SPREADSHEET_COLUMNS = [(r"category", "category", parse_text),
+                       (r"product id", "product_id", parse_text),
+                       (r"description", "description", parse_text),
+                       (r"stock ordered\b.*|stock on hand", "stock_on_hand", parse_int),
+                       (r"calib(er|re)", "calibre", parse_number),
+                       (r"low noise", "low_noise", parse_bool),
+                       (r"cat|class(ification)?", "classification", parse_text),
+                       (r"nec per unit.*|nec weight.*", "nec_weight", parse_number),
+                       (r"nec total.*", "nec_total", parse_number),
+                       (r"unit cost.*", "unit_cost", parse_number),
+                       (r"unit weight.*", "unit_weight", parse_number),
+                       (r"case size", "case_size", parse_int),
+                       (r"shots", "shots", parse_int),
+                       (r"duration.*", "duration", parse_number),
+                       (r"hse (serial )?no", "hse_no", parse_text),
+                       (r"ce no", "ce_no", parse_text),
+                       (r"serial no", "serial_no", parse_text),
+                       (r"notes", "notes", parse_text)]
+
+
+def read_spreadsheet_records(path):
+    """Yields a record of normalized column values for each row of a spreadsheet dump, such as test_data.json,
+    which is a JSON array of rows, or a CSV file, with a header row in either case.
+    A JSON array of records, such as dict_stock.json, is yielded as it is."""
+    if os.path.splitext(path)[1].lower() == ".csv":
+        fh = open(path, "r", encoding="utf-8-sig", newline="")
+        rows = csv.reader(fh)
+    else:
+        fh = None
+        rows = read_json_records(path)
+    try:
+        parsers = None
+        for row in rows:
+            if type(row) is dict:
+                yield row
+                continue
+            if parsers is None:
+                parsers = [spreadsheet_column(h) for h in row]
+                continue
+            yield {p[0]: p[1](v) for p, v in zip(parsers, row) if p is not None}
+    finally:
+        if fh is not None:
+            fh.close()
+
+
+def spreadsheet_column(header):
+    for pattern, column, parser in SPREADSHEET_COLUMNS:
+        if re.fullmatch(pattern, header.strip().lower()):
+            return column, parser
+    return None
+
+
+class ImportDiff:
+    """The changes needed to bring stock_items into line with a spreadsheet.
+    inserts is a list of records, updates a list of (sku, {column: (old, new)})."""
+
+    def __init__(self):
+        self.inserts = []
+        self.updates = []
+        self.unchanged = 0
+
+    def is_empty(self):
+        return len(self.inserts) == 0 and len(self.updates) == 0
+
+    def __repr__(self):
+        return "{} new, {} changed, {} unchanged".format(len(self.inserts), len(self.updates), self.unchanged)
+
+
+def diff_records(con, records, convert_nec_totals=False):
+    """Matches each record to an existing item and works out which need inserting or updating.
+    Items are matched by product_id, or by hse_no or failing that description for rows without one.
+    Where several items share the product ID, the description and hse_no narrow them down,
+    and repeated rows take the matches in SKU order.
+    Older imports, such as dict_stock.json, stored the row's NEC Total as nec_weight. An item still holding it
+    is left as it is unless convert_nec_totals is set, when it's changed to the NEC per Unit.
+    :type con: database_io.NewSQL
+    """
+    categories, classifications = get_lookups(con)
+    existing = {}
+    by_product_id = {}
+    by_hse_no = {}
+    by_description = {}
+    for item in con.all("SELECT sku, {} FROM stock_items ORDER BY sku".format(", ".join(ITEM_COLUMNS))):
+        item = item._asdict()
+        existing[item["sku"]] = item
+        if item["product_id"]:
+            by_product_id.setdefault(match_key(item["product_id"]), []).append(item["sku"])
+        if item["hse_no"]:
+            by_hse_no.setdefault(match_key(item["hse_no"]), []).append(item["sku"])
+        by_description.setdefault(match_key(item["description"]), []).append(item["sku"])
+
+    diff = ImportDiff()
+    claimed = set()
+    for record in records:
+        values = normalize_record(record, categories, classifications)
+        if values.get("product_id"):
+            candidates = by_product_id.get(match_key(values["product_id"]), [])
+        elif values.get("hse_no"):
+            candidates = by_hse_no.get(match_key(values["hse_no"]), [])
+        elif values.get("description"):
+            candidates = by_description.get(match_key(values["description"]), [])
+        else:
+            candidates = []
+        for field in ("description", "hse_no"):
+            narrowed = [c for c in candidates if match_key(existing[c][field]) == match_key(values.get(field))]
+            if len(narrowed) > 0:
+                candidates = narrowed
+        candidates = [c for c in candidates if c not in claimed]
+
+        if len(candidates) == 0:
+            diff.inserts.append(values)
+            continue
+
+        sku = candidates[0]
+        claimed.add(sku)
+        changes = {c: (existing[sku][c], v) for c, v in values.items() if not same_value(existing[sku][c], v)}
+        if ("nec_weight" in changes and not convert_nec_totals and record.get("nec_total") is not None
+                and same_value(existing[sku]["nec_weight"], record["nec_total"])):
+            del changes["nec_weight"]
+        if len(changes) > 0:
+            diff.updates.append((sku, changes))
+        else:
+            diff.unchanged += 1
+
+    return diff
+
+
+def match_key(value):
+    return " ".join(str(value).lower().split()) if value is not None else ""
+
+
+def same_value(old, new):
+    if type(old) is str or type(new) is str:
+        return (old or "") == (new or "")
+    if old is None or new is None:
+        return old == new
+    if type(new) is bool:
+        return (old in (1, "True", True)) == new
+    return abs(float(old) - float(new)) < 1e-9
+
+
+def apply_diff(con, diff):
+    """Writes the inserts and updates in a diff in one transaction.
+    :type con: database_io.NewSQL
+    """
+    insert = "INSERT INTO stock_items ({}) VALUES ({})".format(", ".join(ITEM_COLUMNS),
+                                                               ", ".join("?" * len(ITEM_COLUMNS)))
+    updates = {}
+    for sku, changes in diff.updates:
+        columns = tuple(sorted(changes))
+        updates.setdefault(columns, []).append([changes[c][1] for c in columns] + [sku])
+
+    with con.unit_of_work():
+        if len(diff.inserts) > 0:
+            con.run(insert, [tuple(v.get(c) if v.get(c) is not None else ITEM_DEFAULTS.get(c) for c in ITEM_COLUMNS)
+                             for v in diff.inserts])
+        for columns, rows in updates.items():
+            con.run("UPDATE stock_items SET {} WHERE sku=?".format(", ".join(c + "=?" for c in columns)), rows)
+
+
+def reimport_file(database, path, apply=True, convert_nec_totals=False):
+    """Diffs a spreadsheet dump against stock_items, and applies the changes unless apply is False.
+    The file is read and diffed on a read only connection, so the handle is only held while the changes are
+    written. If stock_items changed in between, the diff is worked out again before writing.
+    See diff_records for convert_nec_totals.
+    :type database: database_io.DatabaseHandler
+    """
+    records = list(read_spreadsheet_records(path))
+    with database.open_database_connection(read_only=True) as con:
+        seq = database.latest_change(con)
+        diff = diff_records(con, records, convert_nec_totals)
+    if not apply or diff.is_empty():
+        return diff
+    with database.unit_of_work() as con:
+        changes = database.changes_since(con, seq)
+        if changes.reload or changes.changed_ids("stock_items") or changes.deleted_ids("stock_items"):
+            diff = diff_records(con, records, convert_nec_totals)
+        apply_diff(con, diff)
+    return diff
+
+
+def import_file(database, path, **kwargs):
+    """Streams the records in a JSON or CSV file into the database's stock_items.
+    :type database: database_io.DatabaseHandler
+    """
+    with database.open_database_connection() as con:
+        return import_items(con, read_records(path), **kwargs)
+
+
+if __name__ == "__main__":
+    database_io.load_config(CONFIG_PATH)
+    db = database_io.init()
+    if len(sys.argv) > 2 and sys.argv[1] in ("--reimport", "--diff"):
+        changes = reimport_file(db, sys.argv[2], apply=sys.argv[1] == "--reimport",
+                                convert_nec_totals="--convert-nec-totals" in sys.argv[3:])
+        for s, c in changes.updates:
+            print("{}: {}".format(str(s).zfill(6), ", ".join("{} {!r} -> {!r}".format(k, *c[k]) for k in c)))
+        print(changes)
+    else:
+        rows, seconds = import_file(db,
+                                    sys.argv[1],
+                                    progress=lambda n, rate: print("{} rows, {:.0f} rows/s".format(n, rate)))
+        print("Imported {} rows in {:.2f}s.".format(rows, seconds))
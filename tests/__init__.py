@@ -0,0 +1,6 @@
+import os
+
+# custom_globals and DatabaseHandler read these, which Windows always sets.
+os.environ.setdefault("APPDATA", os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("USERNAME", "tester")
+os.environ.setdefault("COMPUTERNAME", "test")
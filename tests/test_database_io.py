@@ -0,0 +1,727 @@
+import collections
+import datetime
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+import database_io
+import generate_data
+from database_io import NewSQL
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DAY = 24 * 3600 * 1000
+
+
+def make_random_changes(con, rng, count):
+    """Makes count random inserts, updates and deletes to stock_items, shows and show_items, for checking the
+    tables kept up to date by triggers against what they would be if worked out from scratch.
+    :type con: database_io.NewSQL
+    """
+    skus = con.all("SELECT sku FROM stock_items")
+    shows = con.all("SELECT show_id FROM shows")
+    for n in range(count):
+        op = rng.randrange(10)
+        if op == 0:
+            con.run("INSERT OR IGNORE INTO show_items (show_id, sku, quantity) VALUES (?, ?, ?)",
+                    (rng.choice(shows), rng.choice(skus), rng.randint(1, 9)))
+        elif op == 1:
+            con.run("DELETE FROM show_items WHERE rowid IN (SELECT rowid FROM show_items ORDER BY random() LIMIT 1)")
+        elif op == 2:
+            con.run("UPDATE OR IGNORE show_items SET quantity = ?, sku = ? WHERE rowid IN "
+                    "(SELECT rowid FROM show_items ORDER BY random() LIMIT 1)", (rng.randint(1, 9), rng.choice(skus)))
+        elif op == 3:
+            con.run("UPDATE stock_items SET nec_weight = ?, classification = ?, unit_cost = ?, description = ? "
+                    "WHERE sku = ?", (rng.random() * 3, rng.choice([0, 1, 2, 3, None]), rng.random() * 50,
+                                      "Test item {}".format(rng.random()), rng.choice(skus)))
+        elif op == 4:
+            con.run("UPDATE shows SET venue = ? WHERE show_id = ?",
+                    (rng.choice(generate_data.VENUES + (None,)), rng.choice(shows)))
+        elif op == 5:
+            con.run("UPDATE shows SET date_time = date_time + ? WHERE show_id = ?",
+                    (rng.randint(-3, 3) * DAY, rng.choice(shows)))
+        elif op == 6:
+            con.run("UPDATE shows SET complete = NOT complete WHERE show_id = ?", (rng.choice(shows),))
+        elif op == 7 and len(shows) > 1:
+            show_id = shows.pop(rng.randrange(len(shows)))
+            con.run("DELETE FROM show_items WHERE show_id = ?", (show_id,))
+            con.run("DELETE FROM shows WHERE show_id = ?", (show_id,))
+        elif op == 8:
+            shows.append(con.run("INSERT INTO shows (show_title, date_time, complete, venue) "
+                                 "VALUES ('Test show', ?, 0, ?)",
+                                 (int(time.time() * 1000) + rng.randint(-30, 30) * DAY,
+                                  rng.choice(generate_data.VENUES)), return_id=True))
+        elif op == 9:
+            skus.append(con.run("INSERT INTO stock_items (description, classification, nec_weight, unit_cost) "
+                                "VALUES (?, ?, ?, ?)", ("New item", rng.randrange(4), rng.random(),
+                                                        rng.random() * 10), return_id=True))
+            unbooked = con.all("SELECT sku FROM stock_items WHERE sku NOT IN (SELECT sku FROM show_items) "
+                               "ORDER BY random() LIMIT 1")
+            if unbooked:
+                con.run("DELETE FROM stock_items WHERE sku = ?", (unbooked[0],))
+                skus.remove(unbooked[0])
+
+
+def rollup_snapshot(con):
+    return (con.rows("SELECT show_id, classification, quantity, ROUND(nec_weight, 6), ROUND(cost, 6), shots, "
+                     "ROUND(duration, 6) FROM show_rollups ORDER BY show_id, classification")[1],
+            con.rows("SELECT venue, day, classification, quantity, ROUND(nec_weight, 6), ROUND(cost, 6), shots, "
+                     "ROUND(duration, 6) FROM venue_rollups ORDER BY venue, day, classification")[1])
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "database.sqlite")
+        self.database = None
+
+    def tearDown(self):
+        if self.database is not None:
+            self.database.executor.shutdown()
+            self.database.pool.close()
+        self.directory.cleanup()
+
+    def open_database(self):
+        """Returns another DatabaseHandler on the test database, as another workstation would have."""
+        database = database_io.DatabaseHandler(self.path)
+        self.addCleanup(database.pool.close)
+        self.addCleanup(database.executor.shutdown)
+        return database
+
+
+class GeneratedDatabaseTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.database = generate_data.generate_database(self.path, items=150, shows=20, items_per_show=10)
+
+    def check_random_changes(self, check, batches=6, batch_size=50):
+        """Makes batches of random changes in one transaction, calling check(con) before and after each."""
+        rng = random.Random(0)
+        with self.database.unit_of_work() as con:
+            check(con)
+            for _ in range(batches):
+                make_random_changes(con, rng, batch_size)
+                check(con)
+
+
+class AllocationTests(GeneratedDatabaseTestCase):
+    def assert_allocations(self, con):
+        self.assertEqual(con.rows("SELECT sku, allocated FROM stock_allocations WHERE allocated != 0 ORDER BY sku")[1],
+                         con.rows("SELECT sku, SUM(quantity) FROM show_items GROUP BY sku "
+                                  "HAVING SUM(quantity) != 0 ORDER BY sku")[1])
+
+    def test_random_changes(self):
+        self.check_random_changes(self.assert_allocations)
+
+    def test_stock_levels(self):
+        with self.database.open_database_connection(read_only=True) as con:
+            levels = self.database.get_stock_levels_bulk(con)
+            expected = {sku: (stock, stock - booked) for sku, stock, booked in con.rows(
+                "SELECT sku, stock_on_hand, (SELECT IFNULL(SUM(quantity), 0) FROM show_items AS i "
+                "WHERE i.sku = s.sku) FROM stock_items AS s")[1]}
+            self.assertEqual(levels, expected)
+            some = sorted(expected)[::7]
+            self.assertEqual(self.database.get_stock_levels_bulk(con, some), {sku: expected[sku] for sku in some})
+            self.assertEqual(self.database.get_stock_levels(con, some[0]), expected[some[0]])
+            self.assertEqual(self.database.get_stock_levels(con, 10 ** 9), (0, 0))
+
+
+class SearchIndexTests(GeneratedDatabaseTestCase):
+    def assert_index(self, con):
+        # Raises if the index doesn't match stock_items.
+        con.run("INSERT INTO stock_items_fts (stock_items_fts, rank) VALUES ('integrity-check', 1)")
+
+    def test_random_changes(self):
+        self.check_random_changes(self.assert_index)
+
+    def test_follows_edits(self):
+        with self.database.unit_of_work() as con:
+            sku = con.all("SELECT sku FROM stock_items LIMIT 1")[0]
+            con.run("UPDATE stock_items SET description = 'Zanzibar fountain' WHERE sku = ?", (sku,))
+        with self.database.open_database_connection(read_only=True) as con:
+            self.assertEqual(self.database.search_items(con, "zanzibar"), [sku])
+            self.assertEqual(self.database.search_items(con, "zanz fount"), [sku])
+        with self.database.unit_of_work() as con:
+            con.run("UPDATE stock_items SET description = 'Plain fountain' WHERE sku = ?", (sku,))
+        with self.database.open_database_connection(read_only=True) as con:
+            self.assertEqual(self.database.search_items(con, "zanzibar"), [])
+            self.assertEqual(self.database.search_items(con, " "), [])
+
+
+class ShowPeriodTests(GeneratedDatabaseTestCase):
+    def assert_periods(self, con):
+        self.assertEqual(con.rows("SELECT id, starts, ends FROM show_periods ORDER BY id")[1],
+                         con.rows("SELECT {} FROM shows AS NEW WHERE NEW.complete = 0 AND NEW.date_time IS NOT NULL "
+                                  "ORDER BY NEW.show_id".format(database_io.SHOW_PERIOD_VALUES))[1])
+
+    def test_random_changes(self):
+        self.check_random_changes(self.assert_periods)
+
+    def expected_levels(self, con, start, end):
+        """Works out the stock levels in a window from shows and show_items directly."""
+        booked = collections.Counter()
+        for sku, quantity, date_time in con.rows(
+                "SELECT i.sku, i.quantity, s.date_time FROM show_items AS i JOIN shows AS s ON s.show_id = i.show_id "
+                "WHERE s.complete = 0 AND s.date_time IS NOT NULL")[1]:
+            starts = date_time // 60000 - database_io.SHOW_STOCK_OUT_MINUTES
+            ends = (date_time + 59999) // 60000 + database_io.SHOW_STOCK_BACK_MINUTES
+            if ends >= database_io.to_minutes(start) and (end is None
+                                                          or starts <= database_io.to_minutes(end, round_up=True)):
+                booked[sku] += quantity
+        return {sku: (stock, stock - booked[sku])
+                for sku, stock in con.rows("SELECT sku, stock_on_hand FROM stock_items")[1]}
+
+    def test_windowed_stock_levels(self):
+        now = datetime.datetime.now()
+        windows = [(now, now + datetime.timedelta(days=3)), (now - datetime.timedelta(days=30), now), (now, None),
+                   (now + datetime.timedelta(days=365 * 50), None)]
+        with self.database.open_database_connection(read_only=True) as con:
+            for window in windows:
+                with self.subTest(window=window):
+                    expected = self.expected_levels(con, *window)
+                    self.assertEqual(self.database.get_stock_levels_bulk(con, window=window), expected)
+                    sku = sorted(expected)[3]
+                    self.assertEqual(self.database.get_stock_levels(con, sku, window), expected[sku])
+            # Nothing is booked that far ahead.
+            self.assertEqual({s: a for s, (_, a) in expected.items()}, {s: h for s, (h, _) in expected.items()})
+
+
+class RollupTests(GeneratedDatabaseTestCase):
+    def assert_rollups(self, con):
+        incremental = rollup_snapshot(con)
+        database_io.fill_rollups(con)
+        self.assertEqual(incremental, rollup_snapshot(con))
+
+    def test_random_changes(self):
+        self.check_random_changes(self.assert_rollups)
+
+    def test_get_rollups(self):
+        with self.database.open_database_connection(read_only=True) as con:
+            show_ids = con.all("SELECT show_id FROM shows ORDER BY show_id")
+            rollups = self.database.get_show_rollups(con, show_ids)
+            quantities = {(show_id, None if c == -1 else c): q for show_id, c, q in con.rows(
+                "SELECT i.show_id, IFNULL(s.classification, -1), SUM(i.quantity) FROM show_items AS i "
+                "JOIN stock_items AS s ON s.sku = i.sku GROUP BY i.show_id, IFNULL(s.classification, -1)")[1]}
+            self.assertEqual({(r.show_id, r.classification): r.quantity for rs in rollups.values() for r in rs},
+                             quantities)
+
+            venues = self.database.get_venue_rollups(con)
+            self.assertEqual(sum(r.quantity for r in venues), sum(quantities.values()))
+            venue = venues[0].venue
+            self.assertEqual([(r.day, r.classification) for r in self.database.get_venue_rollups(con, venue)],
+                             [(r.day, r.classification) for r in venues if r.venue == venue])
+
+
+class ChangeJournalTests(GeneratedDatabaseTestCase):
+    def test_change_journal(self):
+        with self.database.open_database_connection(read_only=True) as con:
+            seq = self.database.latest_change(con)
+        with self.database.unit_of_work() as con:
+            sku = con.run("INSERT INTO stock_items (description) VALUES ('Journalled')", return_id=True)
+            show_id, booked_sku = con.rows("SELECT show_id, sku FROM show_items LIMIT 1")[1][0]
+            con.run("DELETE FROM show_items WHERE show_id = ? AND sku = ?", (show_id, booked_sku))
+            con.run("UPDATE stock_categories SET category_text = 'Cake' WHERE category_no = 0")
+            con.run("UPDATE stock_items SET sku = ? WHERE sku = ?", (sku + 1000, sku))
+        with self.database.open_database_connection(read_only=True) as con:
+            changes = self.database.changes_since(con, seq)
+        self.assertFalse(changes.reload)
+        self.assertEqual(changes.changed_ids("stock_items"), {sku + 1000})
+        self.assertEqual(changes.deleted_ids("stock_items"), {sku})
+        self.assertEqual(changes.deleted_ids("show_items"), {(show_id, booked_sku)})
+        self.assertEqual(changes.changed_ids("stock_categories"), {0})
+        self.assertEqual(changes.show_ids(), {show_id})
+
+    def test_pruned_journal_asks_for_reload(self):
+        with self.database.open_database_connection(read_only=True) as con:
+            seq = self.database.latest_change(con)
+        for n in range(3):
+            with self.database.unit_of_work() as con:
+                con.run("UPDATE stock_items SET notes = ? WHERE sku = (SELECT MIN(sku) FROM stock_items)", (str(n),))
+        with self.database.open_database_connection() as con:
+            latest = self.database.latest_change(con)
+            self.assertGreater(self.database.prune_changes(con, latest), 0)
+            # The newest change is kept, so the sequence carries on from it.
+            self.assertEqual(con.all("SELECT seq FROM changes"), [latest])
+            self.assertTrue(self.database.changes_since(con, seq).reload)
+            self.assertTrue(self.database.changes_since(con, latest).is_empty())
+
+
+
+class MigrationTests(DatabaseTestCase):
+    def add_data(self, con):
+        """Adds rows to the tables every schema version has, for the later migrations to bring across."""
+        now = int(time.time() * 1000)
+        skus = [con.run("INSERT INTO stock_items (description, classification, nec_weight, unit_cost, shots, "
+                        "duration, stock_on_hand) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        ("Item {}".format(n), n % 4, 2.0 * (n + 1), 10.0 + n, 25, 30.0, n), return_id=True)
+                for n in range(5)]
+        shows = [con.run("INSERT INTO shows (show_title, date_time, complete, venue) VALUES (?, ?, ?, ?)",
+                         ("Show {}".format(n), now + (n - 1) * DAY, n == 0, "Harbour"), return_id=True)
+                 for n in range(3)]
+        con.run("INSERT INTO show_items (show_id, sku, quantity) VALUES (?, ?, ?)",
+                [(show_id, sku, 1 + (show_id + sku) % 3) for show_id in shows for sku in skus[:3]])
+
+    def assert_consistent(self, con):
+        """Checks the tables the migrations fill against what they would be if worked out from scratch.
+        :type con: NewSQL
+        """
+        self.assertEqual(con.rows("SELECT sku, allocated FROM stock_allocations WHERE allocated != 0 ORDER BY sku")[1],
+                         con.rows("SELECT sku, SUM(quantity) FROM show_items GROUP BY sku "
+                                  "HAVING SUM(quantity) != 0 ORDER BY sku")[1])
+        self.assertEqual(con.rows("SELECT id, starts, ends FROM show_periods ORDER BY id")[1],
+                         con.rows("SELECT {} FROM shows AS NEW WHERE NEW.complete = 0 AND NEW.date_time IS NOT NULL "
+                                  "ORDER BY NEW.show_id".format(database_io.SHOW_PERIOD_VALUES))[1])
+        # Raises if the index doesn't match stock_items.
+        con.run("INSERT INTO stock_items_fts (stock_items_fts, rank) VALUES ('integrity-check', 1)")
+        with con.unit_of_work():
+            migrated = rollup_snapshot(con)
+            database_io.fill_rollups(con)
+            self.assertEqual(migrated, rollup_snapshot(con))
+
+    def migrate_from(self, version):
+        with NewSQL(sqlite3.connect(self.path), None) as con:
+            with con.unit_of_work():
+                for migration in database_io.MIGRATIONS[:version]:
+                    migration(con)
+                con.run("PRAGMA user_version = {}".format(version))
+                if version > 0:
+                    self.add_data(con)
+            self.assertEqual(database_io.migration_pending(con), version < len(database_io.MIGRATIONS))
+            self.assertEqual(database_io.migrate(con), len(database_io.MIGRATIONS))
+            self.assertFalse(database_io.migration_pending(con))
+            self.assertEqual(con.one("SELECT COUNT(*) AS n FROM show_items"), 9 if version > 0 else 0)
+            self.assert_consistent(con)
+
+    def test_migrate_from_every_version(self):
+        for version in range(len(database_io.MIGRATIONS) + 1):
+            with self.subTest(version=version):
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                self.migrate_from(version)
+
+    def test_migrate_unversioned_database(self):
+        shutil.copy(os.path.join(REPO_DIR, "database.sqlite"), self.path)
+        with NewSQL(sqlite3.connect(self.path), None) as con:
+            items = con.one("SELECT COUNT(*) AS n FROM stock_items")
+            self.assertEqual(database_io.migrate(con), len(database_io.MIGRATIONS))
+            self.assertEqual(con.one("SELECT COUNT(*) AS n FROM stock_items"), items)
+            self.assert_consistent(con)
+
+    def test_migrate_is_idempotent(self):
+        database_io.create_database(self.path)
+        with NewSQL(sqlite3.connect(self.path), None) as con:
+            with con.unit_of_work():
+                self.add_data(con)
+            nec = con.all("SELECT nec_weight FROM stock_items ORDER BY sku")
+            self.assertEqual(database_io.migrate(con), len(database_io.MIGRATIONS))
+            self.assertEqual(con.all("SELECT nec_weight FROM stock_items ORDER BY sku"), nec)
+
+    def test_newer_database_is_refused(self):
+        with NewSQL(sqlite3.connect(self.path), None) as con:
+            con.run("PRAGMA user_version = {}".format(len(database_io.MIGRATIONS) + 1))
+            for check in (database_io.migration_pending, database_io.migrate):
+                with self.assertRaises(database_io.DatabaseVersionError):
+                    check(con)
+
+
+class InitTests(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        path = database_io.DATABASE_PATH
+        self.addCleanup(setattr, database_io, "DATABASE_PATH", path)
+        database_io.DATABASE_PATH = self.path
+
+    def test_creates_and_migrates(self):
+        self.database = database_io.init()
+        with self.database.open_database_connection(read_only=True) as con:
+            self.assertEqual(con.one("PRAGMA user_version"), len(database_io.MIGRATIONS))
+            self.assertFalse(database_io.migration_pending(con))
+
+    def test_opens_while_another_workstation_writes(self):
+        database_io.create_database(self.path)
+        other = self.open_database()
+        with other.open_database_connection() as con:
+            con.run("INSERT INTO stock_items (description) VALUES ('Held')")
+            start = time.monotonic()
+            self.database = database_io.init()
+            # Nothing to migrate, so startup doesn't wait for the handle, and skips pruning.
+            self.assertLess(time.monotonic() - start, 5)
+
+
+class ConfigTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "config.cfg")
+        for name in ["DATABASE_PATH"] + database_io.OPTIONAL_CONFIG:
+            self.addCleanup(setattr, database_io, name, getattr(database_io, name))
+
+    def test_save_keeps_optional_settings(self):
+        with open(self.path, "w") as fh:
+            fh.write("# Shared drive\nDATABASE_PATH=old.sqlite\nSLOW_QUERY_LOG=slow.log\nSLOW_QUERY_SECONDS=0.5")
+        database_io.load_config(self.path)
+        database_io.DATABASE_PATH = "new.sqlite"
+        database_io.save_config(self.path)
+        with open(self.path) as fh:
+            self.assertEqual(fh.read().splitlines(), ["# Shared drive", "DATABASE_PATH=new.sqlite",
+                                                      "SLOW_QUERY_LOG=slow.log", "SLOW_QUERY_SECONDS=0.5"])
+
+    def test_unset_optional_settings_are_not_written(self):
+        database_io.DATABASE_PATH = "new.sqlite"
+        database_io.SLOW_QUERY_LOG = ""
+        database_io.SLOW_QUERY_SECONDS = ""
+        database_io.save_config(self.path)
+        with open(self.path) as fh:
+            self.assertEqual(fh.read().splitlines(), ["DATABASE_PATH=new.sqlite"])
+
+
+class LeaseLockTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "database.sqlite-handle.dat")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def lock(self, uid, timeout=5):
+        # Each LeaseLock opens the file separately, as another workstation's would.
+        return database_io.LeaseLock(self.path, uid, timeout=timeout, base_delay=0.001, max_delay=0.01)
+
+    def test_mutual_exclusion(self):
+        locks = [self.lock("user{}@box".format(n)) for n in range(4)]
+        holders = []
+        overlaps = []
+
+        def work(lock):
+            for _ in range(20):
+                lock.acquire()
+                try:
+                    holders.append(lock.uid)
+                    if len(holders) > 1:
+                        overlaps.append(list(holders))
+                    self.assertEqual(lock.lease()[0], lock.uid)
+                    time.sleep(0.001)
+                    holders.remove(lock.uid)
+                finally:
+                    lock.release()
+
+        threads = [threading.Thread(target=work, args=(lock,)) for lock in locks]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(overlaps, [])
+        self.assertIsNone(locks[0].lease())
+
+    def test_reentrant(self):
+        lock = self.lock("user@box")
+        lock.acquire()
+        lock.acquire()
+        lock.release()
+        self.assertEqual(lock.lease()[0], "user@box")
+        lock.release()
+        self.assertIsNone(lock.lease())
+
+    def test_timeout_names_the_holder(self):
+        holder = self.lock("holder@box")
+        waiter = self.lock("waiter@box", timeout=0.2)
+        holder.acquire()
+        try:
+            start = time.monotonic()
+            with self.assertRaisesRegex(database_io.DatabaseTimeoutError, "holder@box"):
+                waiter.acquire()
+            self.assertLess(time.monotonic() - start, 2)
+        finally:
+            holder.release()
+        waiter.acquire()
+        waiter.release()
+
+    def test_cancelled_while_waiting(self):
+        holder = self.lock("holder@box")
+        waiter = self.lock("waiter@box")
+        cancelled = threading.Event()
+        holder.acquire()
+        try:
+            threading.Timer(0.1, cancelled.set).start()
+            with self.assertRaises(database_io.DatabaseCancelledError):
+                waiter.acquire(cancelled)
+        finally:
+            holder.release()
+
+
+
+class ItemsByCategoryTests(GeneratedDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        with self.database.unit_of_work() as con:
+            con.run("INSERT INTO stock_items (description, notes, category, classification, hidden) "
+                    "VALUES (?, ?, 1, 2, ?)", [("100% paper", None, 0), ("1000 shots", None, 0),
+                                               ("Plain", "a_b fuse", 1), ("Plain", "axb fuse", 0),
+                                               ("Back\\slash", None, 0)])
+        with self.database.open_database_connection(read_only=True) as con:
+            self.items = self.database.get_all_items(con)
+
+    def get(self, **kwargs):
+        with self.database.open_database_connection(read_only=True) as con:
+            return [i.sku for i in self.database.get_items_by_category(con, **kwargs)]
+
+    def expected(self, keep):
+        return sorted(i.sku for i in self.items if keep(i))
+
+    def test_filters(self):
+        self.assertEqual(self.get(), self.expected(lambda i: True))
+        self.assertEqual(self.get(categories=[0, 3]), self.expected(lambda i: i.category in (0, 3)))
+        self.assertEqual(self.get(categories=(1,), classifications=[2]),
+                         self.expected(lambda i: i.category == 1 and i.classification == 2))
+        self.assertEqual(self.get(categories=[]), [])
+        self.assertEqual(self.get(show_hidden=False), self.expected(lambda i: not i.hidden))
+        with self.assertRaises(ValueError):
+            self.get(categories=3)
+
+    def test_text_filter(self):
+        def contains(text):
+            return lambda i: any(text.lower() in (f or "").lower() for f in (i.description, i.notes))
+        self.assertEqual(len(self.get(text_filter="100%")), 1)
+        self.assertEqual(self.get(text_filter="100%"), self.expected(contains("100%")))
+        self.assertEqual(self.get(text_filter="a_b"), self.expected(contains("a_b")))
+        self.assertEqual(self.get(text_filter="A_B", show_hidden=False), [])
+        self.assertEqual(self.get(text_filter="k\\s"), self.expected(contains("k\\s")))
+        self.assertEqual(len(self.get(text_filter="k\\s")), 1)
+
+    def test_paging(self):
+        everything = self.expected(lambda i: i.category in (0, 1, 2))
+        for page_size in (1, 7, len(everything), len(everything) + 1):
+            with self.subTest(page_size=page_size):
+                self.assertEqual(self.get(categories=[0, 1, 2], page_size=page_size), everything)
+                self.assertEqual(self.get(categories=[0, 1, 2], page_size=page_size, limit=10), everything[:10])
+                self.assertEqual(self.get(categories=[0, 1, 2], page_size=page_size, after_sku=everything[4],
+                                          limit=9), everything[5:14])
+        self.assertEqual(self.get(limit=0), [])
+
+
+class UnitOfWorkTests(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        database_io.create_database(self.path)
+        self.database = database_io.DatabaseHandler(self.path)
+
+    def names(self):
+        with self.database.open_database_connection(read_only=True) as con:
+            return con.all("SELECT category_text FROM stock_categories WHERE category_no >= 100 ORDER BY category_no")
+
+    def add(self, con, n):
+        con.run("INSERT INTO stock_categories (category_no, category_text) VALUES (?, ?)", (n, str(n)))
+
+    def test_commits_once_at_the_end(self):
+        with self.database.unit_of_work() as con:
+            self.add(con, 100)
+            con.commit()  # Deferred to the end of the unit.
+            self.assertEqual(self.names(), [])
+            self.add(con, 101)
+        self.assertEqual(self.names(), ["100", "101"])
+
+    def test_rolls_back_on_error(self):
+        with self.assertRaises(ZeroDivisionError):
+            with self.database.unit_of_work() as con:
+                self.add(con, 100)
+                1 / 0
+        self.assertEqual(self.names(), [])
+
+    def test_nested_unit_rolls_back_on_its_own(self):
+        with self.database.unit_of_work() as con:
+            self.add(con, 100)
+            with self.assertRaises(sqlite3.IntegrityError):
+                with con.unit_of_work():
+                    self.add(con, 101)
+                    self.add(con, 100)
+            with con.unit_of_work():
+                self.add(con, 102)
+        self.assertEqual(self.names(), ["100", "102"])
+
+    def test_joins_an_open_transaction(self):
+        with self.database.open_database_connection() as con:
+            self.add(con, 100)
+            self.assertTrue(con.connection.in_transaction)
+            with con.unit_of_work():
+                self.add(con, 101)
+            # The unit was part of the caller's transaction, so it goes when that is rolled back.
+            self.assertEqual(self.names(), [])
+            con.connection.rollback()
+        self.assertEqual(self.names(), [])
+
+    def test_joined_unit_rolls_back_on_its_own(self):
+        with self.database.open_database_connection() as con:
+            self.add(con, 100)
+            with self.assertRaises(ZeroDivisionError):
+                with con.unit_of_work():
+                    self.add(con, 101)
+                    1 / 0
+            self.assertTrue(con.connection.in_transaction)
+            con.commit()
+        self.assertEqual(self.names(), ["100"])
+
+
+class UpdateItemTests(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        database_io.create_database(self.path)
+        self.database = database_io.DatabaseHandler(self.path)
+        with self.database.unit_of_work() as con:
+            self.sku = con.run("INSERT INTO stock_items (description, stock_on_hand) VALUES ('Shell', 5)",
+                               return_id=True)
+
+    def update(self, item):
+        """Saves the item, returning the UPDATE statements run on stock_items."""
+        statements = []
+        with self.database.open_database_connection() as con:
+            con.connection.set_trace_callback(statements.append)
+            try:
+                self.database.update_item(con, item)
+            finally:
+                con.connection.set_trace_callback(None)
+        # The statement is traced again for each trigger it fires.
+        return sorted(set(s for s in statements if s.startswith("UPDATE stock_items ")))
+
+    def get_item(self):
+        with self.database.open_database_connection(read_only=True) as con:
+            return self.database.get_item(con, self.sku)
+
+    def test_writes_only_dirty_columns(self):
+        item = self.get_item()
+        item.description = "Mine"
+        item.notes = "Loud"
+        # Saved by another workstation meanwhile, and not overwritten by this item's stale copy.
+        with self.database.unit_of_work() as con:
+            con.run("UPDATE stock_items SET stock_on_hand = 9 WHERE sku = ?", (self.sku,))
+        self.assertEqual(self.update(item),
+                         ["UPDATE stock_items SET description='Mine', notes='Loud' WHERE sku={}".format(self.sku)])
+        self.assertFalse(item.is_dirty())
+        saved = self.get_item()
+        self.assertEqual((saved.description, saved.notes, saved.stock_on_hand), ("Mine", "Loud", 9))
+
+    def test_clean_item_is_not_written(self):
+        item = self.get_item()
+        item.calibre = 0
+        item.description = "Shell"
+        self.assertEqual(self.update(item), [])
+
+
+class LRUCacheTests(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = database_io.LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.stats(), {"size": 2, "max_size": 2, "hits": 3, "misses": 1, "evictions": 1})
+
+    def test_pop_and_clear(self):
+        cache = database_io.LRUCache()
+        cache.put("a", 1)
+        self.assertEqual(cache.pop("a"), 1)
+        self.assertIsNone(cache.pop("a"))
+        cache.put("b", 2)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+class CacheTests(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        database_io.create_database(self.path)
+        self.database = database_io.DatabaseHandler(self.path)
+        # Only checked against the journal when forced, so a stale copy would be seen.
+        self.database.cache_check_interval = 3600
+        with self.database.unit_of_work() as con:
+            self.sku = con.run("INSERT INTO stock_items (description) VALUES ('Cached')", return_id=True)
+
+    def describe(self, database, description):
+        with database.unit_of_work() as con:
+            con.run("UPDATE stock_items SET description = ? WHERE sku = ?", (description, self.sku))
+
+    def get_item(self, database=None):
+        database = database or self.database
+        with database.open_database_connection(read_only=True) as con:
+            return database.get_item(con, self.sku)
+
+    def test_items_are_cached_as_copies(self):
+        item = self.get_item()
+        item.description = "Edited"
+        self.assertEqual(self.get_item().description, "Cached")
+        self.assertEqual(self.database.item_cache.stats()["hits"], 1)
+
+    def test_update_item_drops_the_cached_copy(self):
+        item = self.get_item()
+        item.description = "Saved"
+        with self.database.open_database_connection() as con:
+            self.database.update_item(con, item)
+        self.assertEqual(self.get_item().description, "Saved")
+
+    def test_changes_from_other_workstations_are_dropped(self):
+        other = self.open_database()
+        self.get_item()
+        with self.database.open_database_connection(read_only=True) as con:
+            self.assertEqual(self.database.get_categories(con)[0], "Shell")
+        self.describe(other, "Changed elsewhere")
+        with other.unit_of_work() as con:
+            con.run("UPDATE stock_categories SET category_text = 'Cake' WHERE category_no = 0")
+        self.assertEqual(self.get_item().description, "Cached")
+
+        with self.database.open_database_connection(read_only=True) as con:
+            self.database.check_caches(con, force=True)
+            self.assertEqual(self.database.get_item(con, self.sku).description, "Changed elsewhere")
+            self.assertEqual(self.database.get_categories(con)[0], "Cake")
+
+    def test_pruned_journal_clears_everything(self):
+        other = self.open_database()
+        self.get_item()
+        with self.database.open_database_connection(read_only=True) as con:
+            self.database.check_caches(con, force=True)
+        self.describe(other, "First")
+        self.describe(other, "Second")
+        with other.open_database_connection() as con:
+            other.prune_changes(con, other.latest_change(con))
+        with self.database.open_database_connection(read_only=True) as con:
+            self.database.check_caches(con, force=True)
+        self.assertEqual(len(self.database.item_cache), 0)
+        self.assertEqual(self.get_item().description, "Second")
+
+    def test_row_read_before_an_invalidation_isn_t_cached(self):
+        with self.database.open_database_connection(read_only=True) as con:
+            self.database.check_caches(con, force=True)
+            read = con.one_as
+
+            def read_then_save(*args):
+                # Another worker saves the item between this read and the put.
+                row = read(*args)
+                self.describe(self.database, "Newer")
+                self.database._drop_item(self.sku)
+                return row
+
+            con.one_as = read_then_save
+            self.assertEqual(self.database.get_item(con, self.sku).description, "Cached")
+        self.assertIsNone(self.database.item_cache.get(self.sku))
+        self.assertEqual(self.get_item().description, "Newer")
+
+    def test_bypassed_inside_a_transaction(self):
+        self.get_item()
+        with self.assertRaises(ZeroDivisionError):
+            with self.database.unit_of_work() as con:
+                con.run("UPDATE stock_items SET description = 'Uncommitted' WHERE sku = ?", (self.sku,))
+                self.assertEqual(self.database.get_item(con, self.sku).description, "Uncommitted")
+                with con.unit_of_work():
+                    self.assertEqual(self.database.get_categories(con)[0], "Shell")
+                1 / 0
+        self.assertEqual(self.get_item().description, "Cached")
+        self.assertIsNone(self.database.reference_cache.get("stock_categories"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import copy
+import pickle
+import unittest
+
+from database_structs import StockCatalog, StockItem, stock_table_columns
+
+
+class StockItemTests(unittest.TestCase):
+    def loaded(self, **fields):
+        item = StockItem(1, description="Shell", nec_weight=0.5, **fields)
+        item.mark_clean()
+        return item
+
+    def test_new_item_is_all_dirty(self):
+        self.assertEqual(StockItem(None).dirty_fields(), list(StockItem.FIELDS))
+
+    def test_tracks_changes(self):
+        item = self.loaded()
+        self.assertFalse(item.is_dirty())
+        item.description = "Mine"
+        item.nec_weight = 0.5
+        self.assertEqual(item.dirty_fields(), ["description"])
+        item.description = "Shell"
+        self.assertFalse(item.is_dirty())
+
+    def test_empty_control_values_are_not_changes(self):
+        item = self.loaded()
+        item.calibre = 0
+        item.notes = ""
+        self.assertFalse(item.is_dirty())
+        item.calibre = 75
+        self.assertEqual(item.dirty_fields(), ["calibre"])
+        item.mark_clean()
+        item.calibre = 0
+        self.assertEqual(item.dirty_fields(), ["calibre"])
+
+    def test_copies_keep_the_tracking(self):
+        item = self.loaded()
+        item.notes = "Edited"
+        for duplicate in (item.copy(), copy.deepcopy(item), pickle.loads(pickle.dumps(item))):
+            with self.subTest(duplicate=duplicate):
+                self.assertEqual(duplicate.dirty_fields(), ["notes"])
+                duplicate.notes = None
+                self.assertFalse(duplicate.is_dirty())
+                duplicate.description = "Other"
+                self.assertEqual(duplicate.dirty_fields(), ["description"])
+        # The copies are independent of the original.
+        self.assertEqual(item.dirty_fields(), ["notes"])
+        self.assertEqual(item.description, "Shell")
+
+
+class StockCatalogTests(unittest.TestCase):
+    def setUp(self):
+        self.items = [StockItem(n,
+                                category=None if n % 5 == 0 else n * 100,
+                                hidden=n % 2 == 0,
+                                stock_on_hand=None if n % 3 == 0 else n,
+                                nec_weight=n / 4)
+                      for n in range(1, 11)]
+        self.catalog = StockCatalog(self.items)
+
+    def expected(self, keep):
+        return [p for p, item in enumerate(self.items) if keep(item)]
+
+    def test_code_mask(self):
+        # Ids past a byte, and None, must not collide.
+        mask = self.catalog.code_mask("category", (300, 900, None))
+        self.assertEqual(self.catalog.positions(mask), self.expected(lambda i: i.category in (300, 900, None)))
+        self.assertEqual(self.catalog.positions(self.catalog.code_mask("category", (255,))), [])
+        mask = self.catalog.code_mask("hidden", (False, None))
+        self.assertEqual(self.catalog.select(mask), [i for i in self.items if not i.hidden])
+
+    def test_range_mask(self):
+        in_range = self.catalog.range_mask("stock_on_hand", 4, 8)
+        self.assertEqual(self.catalog.positions(in_range),
+                         self.expected(lambda i: i.stock_on_hand is not None and 4 <= i.stock_on_hand <= 8))
+        self.assertEqual(self.catalog.positions(self.catalog.range_mask("stock_on_hand", 1)),
+                         self.expected(lambda i: i.stock_on_hand is not None))
+        self.assertEqual(self.catalog.positions(self.catalog.range_mask("stock_on_hand", high=2)), [0, 1])
+
+    def test_total(self):
+        self.assertEqual(self.catalog.total("stock_on_hand"),
+                         sum(i.stock_on_hand for i in self.items if i.stock_on_hand is not None))
+        mask = self.catalog.all_of(self.catalog.code_mask("hidden", (False,)),
+                                   self.catalog.range_mask("stock_on_hand", 1))
+        self.assertEqual(self.catalog.total("nec_weight", mask),
+                         sum(i.nec_weight for i in self.items if not i.hidden and i.stock_on_hand is not None))
+        self.assertEqual(StockCatalog().total("nec_weight"), 0)
+
+    def test_masks_from_start(self):
+        # Filtering rows as they are added must give the same as filtering them all at the end.
+        whole = [self.catalog.code_mask("category", (300, None)), self.catalog.range_mask("stock_on_hand", 2, 7),
+                 self.catalog.position_mask({1, 4, 8})]
+        catalog = StockCatalog()
+        pieces = [bytearray() for _ in whole]
+        for start in range(0, len(self.items), 3):
+            catalog.extend(self.items[start:start + 3])
+            for piece, mask in zip(pieces, [catalog.code_mask("category", (300, None), start),
+                                            catalog.range_mask("stock_on_hand", 2, 7, start),
+                                            catalog.position_mask({p for p in (1, 4, 8) if p < len(catalog)},
+                                                                  start)]):
+                self.assertEqual(len(mask), len(catalog) - start)
+                piece += mask
+        self.assertEqual(pieces, whole)
+        mask = self.catalog.code_mask("hidden", (False,), 4)
+        self.assertEqual(self.catalog.total("stock_on_hand", mask, 4),
+                         sum(i.stock_on_hand for i in self.items[4:] if not i.hidden and i.stock_on_hand is not None))
+
+    def test_replace(self):
+        self.catalog.replace(0, StockItem(1, category=7, stock_on_hand=50))
+        self.assertEqual(self.catalog.positions(self.catalog.code_mask("category", (7,))), [0])
+        self.assertEqual(self.catalog.positions(self.catalog.range_mask("stock_on_hand", 50)), [0])
+
+
+class StockTableColumnsTests(unittest.TestCase):
+    def test_formats_every_column(self):
+        names = ["Shells", "Cakes"]
+        columns = stock_table_columns(lambda x: names[x], ["F1", "F2", "F3", "F4"].__getitem__)
+        item = StockItem(42, product_id="AB-1", description="Two\nlines", category=1, classification=3,
+                         unit_cost=2.5, unit_weight=1, nec_weight=0.25, calibre=30, duration=12, low_noise=True)
+        names[1] = "Barrages"
+        self.assertEqual([f(getattr(item, a)) for a, f, _ in columns.values()],
+                         ["000042", "AB-1", "Two lines", "Barrages", "F4", "£2.50", "1.00kg", "0.25kg", "30mm",
+                          "12s", "Yes"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import json
+import os
+import tempfile
+import unittest
+
+import database_io
+import stock_import
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RECORDS = [{"sku": 12345, "description": "Shell, 75mm [red]", "nec_weight": -1.5e3, "notes": None},
+           {"description": "Quote \" and \\ and é", "hidden": True, "low_noise": False},
+           123456789,
+           -0.25,
+           "a string with ] and , in it",
+           [1, [2, [3]], {}],
+           {},
+           True,
+           None]
+
+
+class ReadJsonRecordsTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "records.json")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, text):
+        with open(self.path, "w", encoding="utf-8") as fh:
+            fh.write(text)
+
+    def test_small_chunks(self):
+        for text in (json.dumps(RECORDS), json.dumps(RECORDS, indent=4), "  \n" + json.dumps(RECORDS) + "\n"):
+            self.write(text)
+            for chunk_size in range(1, 40):
+                with self.subTest(chunk_size=chunk_size, text=text[:10]):
+                    self.assertEqual(list(stock_import.read_json_records(self.path, chunk_size)), RECORDS)
+
+    def test_empty_array(self):
+        for text in ("[]", " [ ] ", "[\n]\n"):
+            self.write(text)
+            for chunk_size in (1, 2, 65536):
+                self.assertEqual(list(stock_import.read_json_records(self.path, chunk_size)), [])
+
+    def test_not_an_array(self):
+        for text in ("", "   ", '{"sku": 1}'):
+            self.write(text)
+            with self.assertRaises(ValueError):
+                list(stock_import.read_json_records(self.path, 4))
+
+    def test_truncated(self):
+        text = json.dumps(RECORDS)
+        for end in (len(text) - 1, text.index("123456789") + 4, text.index("-0.25") + 3):
+            self.write(text[:end])
+            for chunk_size in (1, 3, 65536):
+                with self.subTest(end=end, chunk_size=chunk_size):
+                    with self.assertRaises(json.JSONDecodeError):
+                        list(stock_import.read_json_records(self.path, chunk_size))
+
+    def test_stock_file(self):
+        path = os.path.join(REPO_DIR, "dict_stock.json")
+        with open(path, encoding="utf-8") as fh:
+            expected = json.load(fh)
+        self.assertEqual(list(stock_import.read_json_records(path, 7)), expected)
+
+
+class ReimportTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, "database.sqlite")
+        database_io.create_database(path)
+        self.database = database_io.DatabaseHandler(path)
+
+    def tearDown(self):
+        self.database.executor.shutdown()
+        self.database.pool.close()
+        self.directory.cleanup()
+
+    def nec_weights(self):
+        with self.database.open_database_connection(read_only=True) as con:
+            return dict(con.rows("SELECT product_id, nec_weight FROM stock_items")[1])
+
+    def test_unchanged_file_gives_an_empty_diff(self):
+        for name in ("test_data.json", "dict_stock.json"):
+            with self.subTest(name=name):
+                path = os.path.join(REPO_DIR, name)
+                stock_import.reimport_file(self.database, path)
+                again = stock_import.reimport_file(self.database, path, apply=False)
+                self.assertTrue(again.is_empty(), again)
+
+    def test_only_changed_rows_are_written(self):
+        path = os.path.join(self.directory.name, "sheet.csv")
+        with open(path, "w", encoding="utf-8") as fh:
+            fh.write("Category,Product ID,Description,Stock on hand,Low Noise,Cat\n"
+                     "Shell,A1,First,10,No,4\n"
+                     "Mine,B2,Second,5,Yes,2\n")
+        self.assertEqual(len(stock_import.reimport_file(self.database, path).inserts), 2)
+        with open(path, "w", encoding="utf-8") as fh:
+            fh.write("Category,Product ID,Description,Stock on hand,Low Noise,Cat\n"
+                     "Shell,A1,First,12,No,4\n"
+                     "Mine,B2,Second,5,Yes,2\n"
+                     "Candle,C3,Third,1,No,3\n")
+        diff = stock_import.reimport_file(self.database, path)
+        self.assertEqual(len(diff.inserts), 1)
+        self.assertEqual([changes for sku, changes in diff.updates], [{"stock_on_hand": (10, 12)}])
+        self.assertEqual(diff.unchanged, 1)
+
+    def test_nec_totals_are_kept_unless_converted(self):
+        # dict_stock.json holds each row's NEC Total as nec_weight, test_data.json has both figures.
+        stock_import.import_file(self.database, os.path.join(REPO_DIR, "dict_stock.json"))
+        totals = self.nec_weights()
+        sheet = os.path.join(REPO_DIR, "test_data.json")
+        self.assertTrue(stock_import.reimport_file(self.database, sheet).is_empty())
+        self.assertEqual(self.nec_weights(), totals)
+
+        diff = stock_import.reimport_file(self.database, sheet, convert_nec_totals=True)
+        self.assertTrue(all(set(changes) == {"nec_weight"} for sku, changes in diff.updates))
+        self.assertEqual(self.nec_weights()["MFAS-65BCCS"], 0.06)
+        self.assertTrue(stock_import.reimport_file(self.database, sheet, apply=False).is_empty())
+
+
+if __name__ == "__main__":
+    unittest.main()